@@ -0,0 +1,380 @@
+"""
+Cache semantica delle risposte.
+
+Per le domande frequenti l'intera pipeline (embedding, ricerca Qdrant, messaggio nel thread,
+run, polling, lettura dei messaggi) produce sempre la stessa risposta. Questa cache confronta
+l'embedding della nuova domanda con quelli delle domande già risposte (similarità coseno) e,
+sopra una soglia configurabile, restituisce la risposta memorizzata senza creare una run.
+
+La cache viene invalidata quando upload_pdf.py carica nuovi documenti: lo script aggiorna
+la versione del corpus, che la cache ricontrolla periodicamente. La versione è salvata in un
+file marker (CORPUS_VERSION_FILE) e, se il backend di stato è condiviso (Redis), anche nel
+backend, così l'invalidazione raggiunge tutti i worker e tutte le repliche.
+
+Con il backend condiviso anche le voci stanno nel backend (SharedAnswerStore): una risposta
+memorizzata da un worker serve a tutti gli altri. La ricerca per similarità resta in memoria
+su una copia locale delle voci, aggiornata allo stesso controllo periodico della versione.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from state_backend import get_state_backend
+
+logger = logging.getLogger(__name__)
+
+# File marker della versione del corpus documentale (aggiornato da upload_pdf.py)
+CORPUS_VERSION_FILE = os.getenv('CORPUS_VERSION_FILE', '.corpus_version')
+# Chiave della versione del corpus nel backend di stato condiviso
+CORPUS_VERSION_KEY = 'corpus_version'
+# Chiave dell'indice delle risposte nel backend di stato condiviso
+ANSWER_INDEX_KEY = 'answer_cache:index'
+
+def read_corpus_version(path: str = CORPUS_VERSION_FILE) -> Optional[str]:
+    """Legge la versione corrente del corpus (None se il marker non esiste)."""
+    backend = get_state_backend()
+    if backend.shared:
+        value = backend.get(CORPUS_VERSION_KEY)
+        return value.decode('utf-8') if value else None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def bump_corpus_version(path: str = CORPUS_VERSION_FILE) -> str:
+    """Segnala che il corpus è cambiato: le cache di risposte verranno invalidate."""
+    version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(version)
+    backend = get_state_backend()
+    if backend.shared:
+        backend.set(CORPUS_VERSION_KEY, version.encode('utf-8'))
+    logger.info(f"Versione corpus aggiornata: {version}")
+    return version
+
+@dataclass
+class CachedAnswer:
+    """Risposta memorizzata per una domanda."""
+    question: str
+    answer: str
+    expires_at: float
+
+class SharedAnswerStore:
+    """
+    Voci della cache sul backend di stato (vedi state_backend.py), condivise tra worker e repliche.
+
+    Ogni voce (domanda, risposta ed embedding) è una chiave con TTL. Un indice con id e scadenza
+    delle voci, aggiornato in modo atomico, dice a ogni processo quali voci copiare in locale:
+    i vettori passano dalla rete solo quando una voce è nuova, non a ogni domanda.
+    """
+
+    def __init__(self, backend, ttl: float, max_size: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @staticmethod
+    def _entry_key(key: str) -> str:
+        return f"answer_cache:entry:{key}"
+
+    def index(self, version: Optional[str]) -> Optional[Dict[str, float]]:
+        """
+        Id e scadenza delle voci valide per la versione del corpus, in ordine di inserimento
+        (None se l'indice non si può leggere o non esiste ancora).
+        """
+        blob = self.backend.get(ANSWER_INDEX_KEY)
+        if blob is None:
+            return None
+        index = json.loads(blob)
+        if index["version"] != version:
+            return {}
+        now = time.time()
+        return {key: expires_at for key, expires_at in index["entries"] if expires_at > now}
+
+    def get(self, key: str) -> Optional[Tuple[CachedAnswer, np.ndarray]]:
+        blob = self.backend.get(self._entry_key(key))
+        if blob is None:
+            return None
+        header, _, vector = blob.partition(b'\0')
+        data = json.loads(header)
+        return (CachedAnswer(data["question"], data["answer"], data["expires_at"]),
+                np.frombuffer(vector, dtype=np.float32).copy())
+
+    def put(self, key: str, entry: CachedAnswer, vector: np.ndarray, version: Optional[str]) -> List[str]:
+        """
+        Salva la voce e la aggiunge all'indice (che riparte da zero se la versione del corpus
+        è cambiata).
+
+        Returns:
+            Id delle voci rimosse dall'indice perché scadute o oltre max_size
+        """
+        # L'header JSON è ASCII (ensure_ascii), quindi non contiene il separatore \0
+        header = json.dumps({"question": entry.question, "answer": entry.answer,
+                             "expires_at": entry.expires_at}).encode('utf-8')
+        self.backend.set(self._entry_key(key), header + b'\0' + vector.astype(np.float32).tobytes(), ttl=self.ttl)
+        removed: List[str] = []
+
+        def add(blob: Optional[bytes]) -> bytes:
+            removed.clear()
+            index = json.loads(blob) if blob is not None else {"version": version, "entries": []}
+            entries = index["entries"]
+            if index["version"] != version:
+                removed.extend(k for k, _ in entries)
+                entries = []
+            now = time.time()
+            kept = []
+            for k, expires_at in entries:
+                if k == key:
+                    continue
+                if expires_at <= now:
+                    removed.append(k)
+                else:
+                    kept.append([k, expires_at])
+            kept.append([key, entry.expires_at])
+            while len(kept) > self.max_size:
+                removed.append(kept.pop(0)[0])
+            return json.dumps({"version": version, "entries": kept}).encode('utf-8')
+
+        self.backend.update(ANSWER_INDEX_KEY, add, ttl=self.ttl)
+        for k in removed:
+            self.backend.delete(self._entry_key(k))
+        return list(removed)
+
+    def clear(self):
+        self.backend.delete(ANSWER_INDEX_KEY)
+
+class AnswerCache:
+    """
+    Cache semantica domanda -> risposta con soglia di similarità coseno,
+    eviction LRU, TTL e invalidazione alla modifica del corpus.
+    Con `shared` le voci sono condivise sul backend di stato e la copia locale viene
+    sincronizzata ogni `version_check_interval` secondi.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_size: int = 500, ttl: float = 3600,
+                 version_path: str = CORPUS_VERSION_FILE, version_check_interval: float = 5.0,
+                 shared: Optional[SharedAnswerStore] = None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_path = version_path
+        self.version_check_interval = version_check_interval
+        self.shared = shared
+        self._entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[str] = []
+        self._matrix_expires: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+        self._version = read_corpus_version(version_path)
+        self._next_version_check = time.monotonic() + version_check_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls) -> "AnswerCache":
+        """
+        Crea la cache leggendo ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_SIZE e ANSWER_CACHE_TTL;
+        le voci sono condivise se il backend di stato è condiviso (Redis).
+        """
+        max_size = int(os.getenv('ANSWER_CACHE_SIZE', '500'))
+        ttl = float(os.getenv('ANSWER_CACHE_TTL', '3600'))
+        backend = get_state_backend()
+        shared = SharedAnswerStore(backend, ttl, max_size) if backend.shared else None
+        if shared:
+            logger.info("Cache risposte condivisa sul backend di stato")
+        return cls(
+            threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.95')),
+            max_size=max_size,
+            ttl=ttl,
+            shared=shared,
+        )
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self):
+        """
+        Invalida la cache se upload_pdf.py ha aggiornato il corpus e, con le voci condivise,
+        sincronizza la copia locale (controllo throttled). Versione e voci vengono lette fuori
+        dal lock: con Redis sono chiamate di rete.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_version_check:
+                return
+            self._next_version_check = now + self.version_check_interval
+        version = read_corpus_version(self.version_path)
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                if self._entries:
+                    logger.info("Corpus documentale aggiornato: invalidazione cache risposte")
+                    self._clear()
+        if self.shared:
+            self._sync(version)
+
+    def _sync(self, version: Optional[str]):
+        """Copia in locale le voci nuove (o sostituite) dell'indice condiviso e rimuove le altre."""
+        index = self.shared.index(version)
+        if index is None:
+            return
+        with self._lock:
+            missing = [key for key, expires_at in index.items()
+                       if key not in self._entries or self._entries[key].expires_at != expires_at]
+        fetched = {}
+        for key in missing:
+            item = self.shared.get(key)
+            if item is not None:
+                fetched[key] = item
+        with self._lock:
+            if version != self._version:
+                return
+            for key in [key for key in self._entries if key not in index]:
+                self._remove(key)
+            for key, (entry, vector) in fetched.items():
+                self._entries[key] = entry
+                self._vectors[key] = vector
+            self._trim()
+            self._matrix = None
+
+    def _clear(self):
+        self._entries.clear()
+        self._vectors.clear()
+        self._matrix = None
+        self.invalidations += 1
+
+    def _rebuild_matrix(self):
+        self._matrix_keys = list(self._entries.keys())
+        if self._matrix_keys:
+            self._matrix = np.stack([self._vectors[k] for k in self._matrix_keys])
+            self._matrix_expires = np.array([self._entries[k].expires_at for k in self._matrix_keys])
+        else:
+            self._matrix = None
+            self._matrix_expires = None
+
+    def _best_match(self, query: np.ndarray, now: float) -> Optional[Tuple[str, float]]:
+        """
+        Voce valida più simile alla domanda (da chiamare con il lock). Le voci scadute vengono
+        escluse prima di scegliere la migliore e rimosse.
+        """
+        if self._matrix is None and self._entries:
+            self._rebuild_matrix()
+        if self._matrix is None:
+            return None
+        valid = self._matrix_expires > now
+        if not valid.all():
+            expired = [key for key, ok in zip(self._matrix_keys, valid) if not ok]
+            for key in expired:
+                self._remove(key)
+            if not self._entries:
+                return None
+            self._rebuild_matrix()
+        similarities = self._matrix @ query
+        best = int(np.argmax(similarities))
+        return self._matrix_keys[best], float(similarities[best])
+
+    def lookup(self, embedding: List[float]) -> Optional[Tuple[str, float]]:
+        """
+        Cerca una risposta per una domanda semanticamente equivalente.
+
+        Args:
+            embedding: Embedding della domanda
+
+        Returns:
+            Tuple (risposta, similarità) oppure None
+        """
+        if embedding is None:
+            return None
+        query = self._normalize(embedding)
+        self._check_version()
+
+        with self._lock:
+            match = self._best_match(query, time.time())
+            if match is None or match[1] < self.threshold:
+                self.misses += 1
+                return None
+
+            key, similarity = match
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        logger.info(f"Cache risposte: hit (similarità {similarity:.3f}) per '{entry.question[:50]}'")
+        return entry.answer, similarity
+
+    def store(self, question: str, embedding: List[float], answer: str):
+        """
+        Memorizza la risposta a una domanda. Se c'è già una domanda equivalente (similarità
+        sopra la soglia) la sua voce viene sostituita invece di aggiungerne un duplicato.
+        Con le voci condivise la risposta viene scritta anche sul backend di stato.
+        """
+        if embedding is None or not answer:
+            return
+        vector = self._normalize(embedding)
+        self._check_version()
+        with self._lock:
+            now = time.time()
+            match = self._best_match(vector, now)
+            if match is not None and match[1] >= self.threshold:
+                key = match[0]
+                self._entries.move_to_end(key)
+            else:
+                key = uuid.uuid4().hex
+            entry = CachedAnswer(question, answer, now + self.ttl)
+            self._entries[key] = entry
+            self._vectors[key] = vector
+            self._trim()
+            self._matrix = None
+            version = self._version
+        if self.shared:
+            removed = self.shared.put(key, entry, vector, version)
+            if removed:
+                with self._lock:
+                    for removed_key in removed:
+                        self._remove(removed_key)
+
+    def _trim(self):
+        while len(self._entries) > self.max_size:
+            oldest, _ = self._entries.popitem(last=False)
+            del self._vectors[oldest]
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        self._vectors.pop(key, None)
+        self._matrix = None
+
+    def invalidate(self):
+        """Svuota la cache (es. dopo il caricamento di nuovi documenti)."""
+        with self._lock:
+            self._clear()
+        if self.shared:
+            self.shared.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "invalidations": self.invalidations,
+                "shared": self.shared is not None,
+            }
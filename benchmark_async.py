@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark di concorrenza per l'endpoint /chat contro un server OpenAI finto locale.
+
+Confronta:
+- "prima": il flusso originale con il client OpenAI sincrono chiamato dentro coroutine
+  (ogni chiamata di rete blocca l'event loop)
+- "dopo": main:app con AsyncOpenAI e pool di connessioni condiviso
+
+Uso:
+    python benchmark_async.py --concurrency 50
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+PORT = int(os.getenv('FAKE_OPENAI_PORT', '9100'))
+BASE_URL = f"http://127.0.0.1:{PORT}/v1"
+
+# Il chatbot deve puntare al server finto e non usare Qdrant
+os.environ['OPENAI_BASE_URL'] = BASE_URL
+os.environ['OPENAI_API_KEY'] = 'fake-key'
+os.environ['ASSISTANT_ID'] = 'asst_fake'
+os.environ['QDRANT_API_KEY'] = ''
+
+import httpx
+from openai import OpenAI
+
+import fake_openai_server
+
+QUESTION = "Cos'è DataClinic?"
+
+async def sync_conversation(sync_client: OpenAI):
+    """Replica il flusso originale di /start + /chat con il client sincrono."""
+    thread = sync_client.beta.threads.create()
+    sync_client.beta.threads.messages.create(thread_id=thread.id, role="user", content=QUESTION)
+    run = sync_client.beta.threads.runs.create(thread_id=thread.id, assistant_id="asst_fake")
+    while True:
+        run_status = sync_client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+        if run_status.status == 'completed':
+            break
+        await asyncio.sleep(1)
+    messages = sync_client.beta.threads.messages.list(thread_id=thread.id)
+    return messages.data[0].content[0].text.value
+
+async def app_conversation(http: httpx.AsyncClient):
+    """Esegue /start + /chat su main:app (client asincrono)."""
+    response = await http.get("/start")
+    response.raise_for_status()
+    thread_id = response.json()["thread_id"]
+    response = await http.post("/chat", json={"thread_id": thread_id, "message": QUESTION})
+    response.raise_for_status()
+    return response.json()["response"]
+
+async def run_load(make_conversation, concurrency: int, total: int) -> dict:
+    """Esegue `total` conversazioni con al massimo `concurrency` in parallelo."""
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            try:
+                await make_conversation()
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    return {
+        "conversations": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_s": round(total / elapsed, 2),
+    }
+
+async def main_async(args):
+    sync_client = OpenAI(api_key='fake-key', base_url=BASE_URL)
+    before = await run_load(lambda: sync_conversation(sync_client), args.concurrency, args.total)
+    print(f"Prima (client sincrono):   {before}")
+
+    import main
+    import security
+    # Il benchmark usa un solo IP: disattiviamo il rate limiting
+    security._rate_limiter = security.create_rate_limiter(per_minute=sys.maxsize, per_hour=sys.maxsize)
+    logging.disable(logging.WARNING)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://chatbot", timeout=120) as http:
+        after = await run_load(lambda: app_conversation(http), args.concurrency, args.total)
+    print(f"Dopo (AsyncOpenAI + pool): {after}")
+
+    speedup = after["throughput_per_s"] / before["throughput_per_s"] if before["throughput_per_s"] else 0
+    print(f"Speedup throughput: {speedup:.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=50, help="Conversazioni in parallelo")
+    parser.add_argument('--total', type=int, default=100, help="Conversazioni totali")
+    args = parser.parse_args()
+
+    server = fake_openai_server.run_in_thread(port=PORT)
+    try:
+        asyncio.run(main_async(args))
+    finally:
+        server.should_exit = True
+
+if __name__ == "__main__":
+    sys.exit(main())
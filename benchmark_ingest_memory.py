@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Benchmark della memoria di picco dell'ingestion su un PDF sintetico molto grande.
+
+Genera un PDF di N pagine (default 1000) e lo carica con due pipeline, ciascuna in un
+processo separato così la memoria di una non influenza l'altra:
+- "prima": tutte le pagine estratte come Document, tutti i chunk in una lista e tutti gli
+  embedding calcolati prima dell'upsert (comportamento precedente)
+- "dopo": upload_pdf.ingest in streaming, a finestre di --pages-per-task pagine
+
+Gli embedding vengono dal server OpenAI finto (vettori di 1536 dimensioni, come
+text-embedding-3-small) e l'upsert scarta i punti, così si misura solo la pipeline e non
+lo storage di Qdrant. Per ogni variante si riporta il picco di RSS del processo principale
+(oltre al valore dopo gli import) e dei processi del pool.
+
+Uso:
+    python benchmark_ingest_memory.py --pages 1000
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import List
+
+FAKE_PORT = 9140
+EMBEDDING_DIM = 1536
+
+def make_synthetic_pdf(path: Path, pages: int, lines_per_page: int = 45):
+    """Scrive un PDF valido di `pages` pagine di testo (font standard, nessuna dipendenza)."""
+    objects: List[bytes] = [b"", b""]  # 1: catalogo, 2: albero delle pagine
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    font_id = len(objects)
+    page_ids = []
+    for page in range(pages):
+        lines = [
+            f"Capitolo {page // 20 + 1}, pagina {page + 1}, riga {line + 1}: DataClinic analizza i dati "
+            f"sanitari del paziente {page * lines_per_page + line} e prepara il report per il reparto."
+            for line in range(lines_per_page)
+        ]
+        stream = ("BT /F1 8 Tf 30 810 Td 10 TL " + " ".join(f"({text}) '" for text in lines) + " ET").encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (len(objects), font_id)
+        )
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % i for i in page_ids), pages)
+
+    with open(path, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        f.writelines(b"%010d 00000 n \n" % offset for offset in offsets)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+def peak_rss_mb(who: int) -> float:
+    # ru_maxrss è in KB su Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+class DiscardingVectorStore:
+    """Vector store che scarta i punti: l'upsert non trattiene memoria."""
+
+    async def async_add(self, nodes) -> List[str]:
+        return [node.id_ for node in nodes]
+
+def legacy_extract_chunks(pdf_path: str) -> list:
+    """Estrazione e chunking come prima: tutte le pagine e tutti i chunk in memoria."""
+    import upload_pdf
+    documents = list(upload_pdf.iter_pages(pdf_path))
+    return upload_pdf.chunk_documents(documents)
+
+async def run_variant(variant: str, pdf_path: Path, workdir: Path, pages_per_task: int, workers: int) -> dict:
+    from concurrent.futures import ProcessPoolExecutor
+    from openai import AsyncOpenAI
+    from qdrant_client import AsyncQdrantClient
+    import upload_pdf
+
+    baseline = peak_rss_mb(resource.RUSAGE_SELF)
+    openai_client = AsyncOpenAI(api_key="fake", base_url=f"http://127.0.0.1:{FAKE_PORT}/v1", max_retries=0)
+    qdrant_aclient = AsyncQdrantClient(location=":memory:")
+    vector_store = DiscardingVectorStore()
+    start = time.perf_counter()
+
+    if variant == "prima":
+        pipeline = upload_pdf.IngestionPipeline(vector_store, qdrant_aclient, openai_client)
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            nodes = await loop.run_in_executor(pool, legacy_extract_chunks, str(pdf_path))
+        chunks = await pipeline.ingest_nodes(pdf_path.name, nodes)
+    else:
+        manifest = upload_pdf.IngestManifest(str(workdir / "manifest.json"))
+        checkpoint = upload_pdf.IngestCheckpoint(str(workdir / "checkpoint.sqlite"))
+        await upload_pdf.ingest(
+            [pdf_path], workers=workers, manifest=manifest, checkpoint=checkpoint, vector_store=vector_store,
+            qdrant_aclient=qdrant_aclient, openai_client=openai_client, pages_per_task=pages_per_task,
+            use_embedding_store=False,
+        )
+        chunks = manifest.files[pdf_path.name]["chunks"]
+
+    return {
+        "variant": variant,
+        "chunks": chunks,
+        "seconds": round(time.perf_counter() - start, 2),
+        "rss_after_imports_mb": round(baseline, 1),
+        "peak_rss_main_mb": round(peak_rss_mb(resource.RUSAGE_SELF), 1),
+        "peak_rss_workers_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+    }
+
+def child(args):
+    """Esegue una variante nel processo corrente e stampa il risultato in JSON."""
+    os.environ['FAKE_OPENAI_LATENCY'] = str(args.latency)
+    os.environ['FAKE_OPENAI_EMBEDDING_DIM'] = str(EMBEDDING_DIM)
+    import fake_openai_server
+    import upload_pdf  # noqa: F401 (import prima della misura di base)
+    logging.disable(logging.WARNING)
+    server = fake_openai_server.run_in_thread(port=FAKE_PORT)
+    try:
+        result = asyncio.run(run_variant(
+            args.variant, Path(args.pdf), Path(args.workdir), args.pages_per_task, args.workers
+        ))
+    finally:
+        server.should_exit = True
+    print(json.dumps(result))
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=1000, help="Pagine del PDF sintetico")
+    parser.add_argument('--pages-per-task', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--latency', type=float, default=0.1, help="Latenza simulata delle richieste di embedding (s)")
+    parser.add_argument('--variant', choices=["prima", "dopo"], help=argparse.SUPPRESS)
+    parser.add_argument('--pdf', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.variant:
+        return child(args)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        pdf_path = Path(workdir) / "manuale_sintetico.pdf"
+        make_synthetic_pdf(pdf_path, args.pages)
+        print(f"PDF sintetico: {args.pages} pagine, {pdf_path.stat().st_size / 1024 / 1024:.1f} MB, "
+              f"embedding di {EMBEDDING_DIM} dimensioni, {args.workers} worker")
+        results = []
+        for variant in ("prima", "dopo"):
+            output = subprocess.run(
+                [sys.executable, __file__, '--variant', variant, '--pdf', str(pdf_path), '--workdir', workdir,
+                 '--pages-per-task', str(args.pages_per_task), '--workers', str(args.workers),
+                 '--latency', str(args.latency)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    labels = {"prima": "Prima (tutto in memoria)", "dopo": f"Dopo (streaming, {args.pages_per_task} pagine per finestra)"}
+    for result in results:
+        print(f"\n{labels[result['variant']]}")
+        print(f"  chunk: {result['chunks']}, tempo: {result['seconds']}s")
+        print(f"  RSS processo principale: {result['peak_rss_main_mb']} MB di picco "
+              f"(+{result['peak_rss_main_mb'] - result['rss_after_imports_mb']:.1f} MB dopo gli import)")
+        print(f"  RSS worker del pool: {result['peak_rss_workers_mb']} MB di picco")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+Test di carico di main:app senza servizi esterni.
+
+Avvia nello stesso processo:
+- il server OpenAI finto (fake_openai_server.py): threads, messages, run ed embedding con
+  latenza configurabile
+- un Qdrant in memoria con un corpus sintetico, servito dal backend 'qdrant' di retrieval
+- main:app con uvicorn, come in produzione (lifespan, warm-up, /ready)
+
+poi lo carica con utenti concorrenti (/start e poi --turns messaggi per conversazione, su
+/chat o /chat/stream) a uno o più livelli di concorrenza e riporta per ogni livello latenze
+p50/p95/p99 per endpoint, throughput ed error rate. Il report JSON si può confrontare tra
+commit con --compare (esce con codice 1 se p95 o throughput peggiorano oltre --max-regression).
+
+Le latenze includono il client di carico, che gira nello stesso processo: i numeri servono
+a confrontare due versioni sulla stessa macchina, non come valori assoluti.
+
+Uso:
+    python benchmark_load.py --concurrency 1 10 50 --requests 200 --output load.json
+    python benchmark_load.py --stream-ratio 0.5 --run-duration 1.0 --latency 0.1
+    python benchmark_load.py --concurrency 10 50 --compare load.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import warnings
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from typing import Dict, List, Optional
+
+FAKE_OPENAI_PORT = int(os.getenv('FAKE_OPENAI_PORT', '9100'))
+CHATBOT_PORT = int(os.getenv('BENCHMARK_CHATBOT_PORT', '9101'))
+COLLECTION_NAME = "benchmark_load"
+
+# Argomenti del corpus sintetico: ogni chunk e ogni domanda parlano di uno di questi
+TOPICS = [
+    ("report mensile", "esportazione in PDF ed Excel, filtri per reparto e invio automatico via email"),
+    ("cartella clinica", "storico delle visite, allegati, referti firmati e accesso per ruolo"),
+    ("prenotazioni", "agenda condivisa, promemoria SMS, disdette e liste d'attesa"),
+    ("fatturazione", "fatture elettroniche, note di credito, esenzioni e codici IVA"),
+    ("privacy", "consenso informato, registro dei trattamenti, GDPR e conservazione dei dati"),
+    ("integrazioni", "API REST, webhook, esportazione HL7 FHIR e import da CSV"),
+    ("dashboard", "indicatori di qualità, tempi di attesa, grafici per periodo e confronto tra sedi"),
+    ("utenti", "creazione degli account, autenticazione a due fattori, permessi e reset password"),
+]
+QUESTION_TEMPLATES = [
+    "Come funziona {topic} in DataClinic?",
+    "Dove trovo le impostazioni di {topic}?",
+    "Quali opzioni ci sono per {topic}?",
+    "DataClinic gestisce {detail}?",
+]
+
+def build_corpus(chunks: int, seed: int = 42) -> List[Dict]:
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(chunks):
+        topic, detail = TOPICS[i % len(TOPICS)]
+        words = detail.split(", ")
+        rng.shuffle(words)
+        corpus.append({
+            "text": f"Sezione {i} - {topic}: DataClinic permette di gestire {', '.join(words)}. "
+                    f"Per configurare {topic} apri il menu Impostazioni e scegli la voce dedicata.",
+            "source": f"manuale_{i % 5}.pdf",
+        })
+    return corpus
+
+def build_questions(count: int, seed: int = 7) -> List[str]:
+    """Domande distinte (numerate) sugli argomenti del corpus."""
+    rng = random.Random(seed)
+    questions = []
+    for i in range(count):
+        topic, detail = rng.choice(TOPICS)
+        template = rng.choice(QUESTION_TEMPLATES)
+        questions.append(f"{template.format(topic=topic, detail=detail.split(', ')[0])} (domanda {i})")
+    return questions
+
+def configure_environment(args):
+    """Variabili lette da main.py e retrieve_context.py all'import: vanno impostate prima."""
+    os.environ.update({
+        'OPENAI_BASE_URL': f"http://127.0.0.1:{FAKE_OPENAI_PORT}/v1",
+        'OPENAI_API_KEY': 'fake-key',
+        'ASSISTANT_ID': 'asst_fake',
+        # Il retrieval deve risultare configurato; il backend viene poi sostituito con set_backend
+        'QDRANT_API_KEY': 'fake-key',
+        'QDRANT_URL': ':memory:',
+        'COLLECTION_NAME': COLLECTION_NAME,
+        'RETRIEVAL_BACKEND': 'qdrant',
+        'EMBEDDING_DIM': str(args.embedding_dim),
+        'RUN_WAITER': args.run_waiter,
+        'ANSWER_CACHE_ENABLED': 'true' if args.answer_cache else 'false',
+        'HYBRID_SEARCH': 'true' if args.hybrid else 'false',
+        'STATE_BACKEND': 'memory',
+        'CHAT_BACKEND': args.chat_backend,
+        # Archivio delle conversazioni usa e getta, per non accumulare thread tra un'esecuzione e l'altra
+        'CONVERSATION_DB_PATH': os.path.join(tempfile.mkdtemp(prefix='benchmark_load_'), 'conversations.sqlite'),
+    })
+
+def configure_fake_openai(args):
+    import fake_openai_server
+    fake_openai_server.FAKE_LATENCY = args.latency
+    fake_openai_server.FAKE_RUN_DURATION = args.run_duration
+    fake_openai_server.FAKE_TOKEN_DELAY = args.token_delay
+    fake_openai_server.FAKE_EMBEDDING_DIM = args.embedding_dim
+    return fake_openai_server
+
+async def create_backend(corpus: List[Dict], hybrid: bool, dim: int):
+    """Backend 'qdrant' su un Qdrant in memoria, con gli embedding del server finto."""
+    from openai import AsyncOpenAI
+    from qdrant_client import AsyncQdrantClient, models
+
+    from fake_openai_server import fake_embedding
+    from hybrid_search import SPARSE_VECTOR_NAME, encode_document
+    from qdrant_collection import CollectionSettings, create_collection
+    from retrieval_backends import QdrantBackend
+
+    aclient = AsyncQdrantClient(location=":memory:")
+    settings = CollectionSettings(vector_size=dim, quantization="none",
+                                  sparse_vector=SPARSE_VECTOR_NAME if hybrid else None)
+    await create_collection(aclient, COLLECTION_NAME, settings, recreate=True)
+    points = []
+    for i, chunk in enumerate(corpus):
+        vector = fake_embedding(chunk["text"], dim)
+        if hybrid:
+            indices, values = encode_document(chunk["text"])
+            vector = {"": vector, SPARSE_VECTOR_NAME: models.SparseVector(indices=indices, values=values)}
+        points.append(models.PointStruct(id=i, vector=vector, payload=chunk))
+    await aclient.upsert(COLLECTION_NAME, points=points)
+    # Solo il percorso asincrono, quello usato da main.py: il client sincrono non serve
+    return QdrantBackend(
+        None, COLLECTION_NAME, os.environ.get('EMBEDDING_MODEL', 'text-embedding-3-small'),
+        async_openai_client=AsyncOpenAI(), qdrant_aclient=aclient, hybrid=hybrid,
+    )
+
+def serve_in_thread(app, port: int):
+    """Avvia `app` con uvicorn in un thread e attende che sia in ascolto."""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+async def wait_until_ready(http, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if (await http.get("/ready")).status_code == 200:
+            return
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"main:app non pronto entro {timeout}s")
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[int(q * (len(sorted_values) - 1))]
+
+def latency_summary(samples: List[float]) -> Dict:
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 0.50), 2),
+        "p95_ms": round(percentile(samples, 0.95), 2),
+        "p99_ms": round(percentile(samples, 0.99), 2),
+        "max_ms": round(samples[-1], 2),
+    }
+
+class LoadRecorder:
+    """Latenze ed errori di un livello di carico."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Counter = Counter()
+        self.requests = 0
+
+    def observe(self, name: str, start: float):
+        self.latencies.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+
+    def record(self, endpoint: str, start: float, error: Optional[str] = None):
+        """Esito di una richiesta: latenza se riuscita, altrimenti errore per endpoint e classe."""
+        self.requests += 1
+        if error:
+            self.errors[f"{endpoint} {error}"] += 1
+        else:
+            self.observe(endpoint, start)
+
+    def report(self, concurrency: int, elapsed: float) -> Dict:
+        errors = sum(self.errors.values())
+        return {
+            "concurrency": concurrency,
+            "requests": self.requests,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_per_s": round(self.requests / elapsed, 2),
+            "error_rate": round(errors / self.requests, 4) if self.requests else 0.0,
+            "errors": dict(self.errors),
+            "endpoints": {endpoint: latency_summary(samples) for endpoint, samples in sorted(self.latencies.items())},
+        }
+
+async def timed_request(http, recorder: LoadRecorder, method: str, endpoint: str, **kwargs) -> Optional[dict]:
+    start = time.perf_counter()
+    try:
+        response = await http.request(method, endpoint, **kwargs)
+    except Exception as e:
+        recorder.record(endpoint, start, type(e).__name__)
+        return None
+    if response.status_code >= 400:
+        recorder.record(endpoint, start, str(response.status_code))
+        return None
+    recorder.record(endpoint, start)
+    return response.json()
+
+async def timed_stream(http, recorder: LoadRecorder, payload: dict):
+    """/chat/stream: latenza fino al primo token e fino alla fine dello stream."""
+    start = time.perf_counter()
+    first_token = False
+    try:
+        async with http.stream("POST", "/chat/stream", json=payload) as response:
+            if response.status_code >= 400:
+                recorder.record("/chat/stream", start, str(response.status_code))
+                return
+            async for line in response.aiter_lines():
+                if line == "event: error":
+                    recorder.record("/chat/stream", start, "error_event")
+                    return
+                if line == "event: token" and not first_token:
+                    recorder.observe("/chat/stream first_token", start)
+                    first_token = True
+    except Exception as e:
+        recorder.record("/chat/stream", start, type(e).__name__)
+        return
+    recorder.record("/chat/stream", start)
+
+async def run_level(http, questions: List[str], concurrency: int, requests: int, turns: int,
+                    stream_ratio: float, seed: int, fake_stats: Optional[Dict] = None) -> Dict:
+    """Esegue `requests` messaggi con `concurrency` utenti, ognuno con conversazioni da `turns` messaggi."""
+    recorder = LoadRecorder()
+    rng = random.Random(seed)
+    remaining = requests
+
+    async def user():
+        nonlocal remaining
+        while remaining > 0:
+            thread = await timed_request(http, recorder, "GET", "/start")
+            if thread is None:
+                continue
+            for _ in range(turns):
+                if remaining <= 0:
+                    return
+                remaining -= 1
+                payload = {"thread_id": thread["thread_id"], "message": rng.choice(questions)}
+                if rng.random() < stream_ratio:
+                    await timed_stream(http, recorder, payload)
+                else:
+                    await timed_request(http, recorder, "POST", "/chat", json=payload)
+
+    openai_requests = fake_stats["requests"] if fake_stats else 0
+    start = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    report = recorder.report(concurrency, time.perf_counter() - start)
+    if fake_stats:
+        # Chiamate ricevute dal server OpenAI finto per messaggio di chat (/start compreso)
+        report["openai_requests_per_message"] = round((fake_stats["requests"] - openai_requests) / requests, 2)
+    return report
+
+def compare_reports(baseline: Dict, current: Dict, max_regression: float) -> bool:
+    """Stampa le differenze per livello ed endpoint; False se qualcosa peggiora oltre la soglia."""
+    ok = True
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    print(f"\nConfronto con {baseline.get('commit') or 'baseline'} (soglia {max_regression:.0%}):")
+    for level in current["levels"]:
+        before = baseline_levels.get(level["concurrency"])
+        if before is None:
+            continue
+        checks = [("throughput", before["throughput_per_s"], level["throughput_per_s"], False)]
+        for endpoint, summary in level["endpoints"].items():
+            if endpoint in before["endpoints"]:
+                checks.append((f"{endpoint} p95", before["endpoints"][endpoint]["p95_ms"], summary["p95_ms"], True))
+        for name, old, new, lower_is_better in checks:
+            change = (new - old) / old if old else 0.0
+            worse = change > max_regression if lower_is_better else change < -max_regression
+            ok = ok and not worse
+            print(f"  c={level['concurrency']:<4} {name:<30} {old:>9.2f} -> {new:>9.2f} "
+                  f"({change:+.1%}){'  PEGGIORATO' if worse else ''}")
+    return ok
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+async def run(args) -> List[Dict]:
+    import httpx
+    import fake_openai_server
+    import main
+    import retrieve_context
+    import security
+
+    # Un solo IP per tutto il carico: il rate limiting non deve intervenire
+    security._rate_limiter = security.create_rate_limiter(per_minute=sys.maxsize, per_hour=sys.maxsize)
+    retrieve_context.set_backend(await create_backend(build_corpus(args.chunks), args.hybrid, args.embedding_dim))
+    server = serve_in_thread(main.app, CHATBOT_PORT)
+
+    levels = []
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{CHATBOT_PORT}", timeout=args.timeout,
+                                     limits=limits) as http:
+            await wait_until_ready(http)
+            questions = build_questions(args.questions)
+            if args.warmup:
+                await run_level(http, questions, 1, args.warmup, args.turns, args.stream_ratio, seed=0)
+            for i, concurrency in enumerate(args.concurrency, start=1):
+                level = await run_level(http, questions, concurrency, args.requests, args.turns,
+                                        args.stream_ratio, seed=i, fake_stats=fake_openai_server._stats)
+                levels.append(level)
+                print_level(level)
+    finally:
+        server.should_exit = True
+    return levels
+
+def print_level(level: Dict):
+    print(f"concorrenza {level['concurrency']}: {level['requests']} richieste in {level['elapsed_s']}s, "
+          f"{level['throughput_per_s']} req/s, errori {level['error_rate']:.2%}, "
+          f"chiamate OpenAI per messaggio {level.get('openai_requests_per_message', '-')}")
+    for endpoint, summary in level["endpoints"].items():
+        print(f"  {endpoint:<26} p50 {summary['p50_ms']:8.1f} ms   p95 {summary['p95_ms']:8.1f} ms   "
+              f"p99 {summary['p99_ms']:8.1f} ms   (n={summary['count']})")
+    for error, count in level["errors"].items():
+        print(f"  errore {error}: {count}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50], help="Livelli di concorrenza")
+    parser.add_argument('--requests', type=int, default=200, help="Messaggi di chat per livello")
+    parser.add_argument('--turns', type=int, default=3, help="Messaggi per conversazione (dopo /start)")
+    parser.add_argument('--stream-ratio', type=float, default=0.0, help="Quota di messaggi su /chat/stream")
+    parser.add_argument('--questions', type=int, default=500, help="Domande distinte")
+    parser.add_argument('--chunks', type=int, default=2000, help="Chunk del corpus in Qdrant")
+    parser.add_argument('--hybrid', action='store_true', help="Ricerca ibrida (densa + BM25)")
+    parser.add_argument('--answer-cache', action='store_true', help="Attiva la cache semantica delle risposte")
+    parser.add_argument('--run-waiter', choices=['polling', 'streaming'], default='polling')
+    parser.add_argument('--chat-backend', choices=['assistants', 'completions'], default='assistants')
+    parser.add_argument('--latency', type=float, default=0.05, help="Latenza di ogni chiamata OpenAI finta (s)")
+    parser.add_argument('--run-duration', type=float, default=0.5, help="Durata di una run finta (s)")
+    parser.add_argument('--token-delay', type=float, default=0.02, help="Ritardo tra i token in streaming (s)")
+    parser.add_argument('--embedding-dim', type=int, default=256)
+    parser.add_argument('--warmup', type=int, default=5, help="Messaggi di riscaldamento, esclusi dal report")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--output', help="Salva il report in JSON")
+    parser.add_argument('--compare', help="Report JSON di riferimento (es. del commit precedente)")
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help="Peggioramento massimo di p95 e throughput con --compare")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    fake_openai = configure_fake_openai(args)
+    logging.basicConfig(level=logging.WARNING)
+    fake_server = fake_openai.run_in_thread(port=FAKE_OPENAI_PORT)
+    # main.py configura il logging a INFO all'import: per il carico bastano gli errori
+    import main  # noqa: F401
+    logging.disable(logging.WARNING)
+    warnings.filterwarnings('ignore', message='Payload indexes have no effect')
+
+    print(f"Carico: livelli {args.concurrency}, {args.requests} messaggi per livello, {args.turns} per "
+          f"conversazione, stream {args.stream_ratio:.0%}, run finta {args.run_duration}s, "
+          f"latenza {args.latency}s, {args.chunks} chunk{' (ibrida)' if args.hybrid else ''}, "
+          f"backend {args.chat_backend}\n")
+    try:
+        levels = asyncio.run(run(args))
+    finally:
+        fake_server.should_exit = True
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        "levels": levels,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare_reports(baseline, report, args.max_regression):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark del rate limiter con molti IP distinti.
+
+Simula richieste da N indirizzi IP diversi (default 100.000) e confronta:
+- "prima": liste di datetime per identificatore, mai rimosse (implementazione precedente)
+- "dopo": SlidingWindowRateLimiter (contatori O(1), chiavi limitate, eviction delle inattive)
+
+Per ciascuno riporta la memoria allocata (tracemalloc) a intervalli regolari e il costo
+medio per chiamata. Il tempo è simulato, così anche l'eviction delle chiavi inattive
+(dopo un'ora senza richieste) è visibile senza attendere.
+
+Uso:
+    python benchmark_rate_limit.py --ips 100000 --step 0.5
+"""
+
+import sys
+import time
+import logging
+import argparse
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import security
+from rate_limiter import SlidingWindowRateLimiter
+
+class LegacyRateLimiter:
+    """Copia dell'implementazione precedente, con orologio simulato."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.store = defaultdict(list)
+
+    def check(self, identifier: str):
+        now = datetime.fromtimestamp(self.clock())
+        self.store[identifier] = [
+            req_time for req_time in self.store[identifier]
+            if now - req_time < timedelta(hours=1)
+        ]
+        recent_requests = [
+            req_time for req_time in self.store[identifier]
+            if now - req_time < timedelta(minutes=1)
+        ]
+        if len(recent_requests) >= security.MAX_REQUESTS_PER_MINUTE:
+            return False, "minute"
+        if len(self.store[identifier]) >= security.MAX_REQUESTS_PER_HOUR:
+            return False, "hour"
+        self.store[identifier].append(now)
+        return True, None
+
+class SimulatedClock:
+    """Orologio simulato: ogni richiesta fa avanzare il tempo di `step` secondi."""
+
+    def __init__(self, step: float):
+        self.now = 1_000_000.0
+        self.step = step
+
+    def __call__(self) -> float:
+        return self.now
+
+    def tick(self):
+        self.now += self.step
+
+def simulate(limiter, clock: SimulatedClock, ips: int, requests_per_ip: int, on_ip=None) -> int:
+    calls = 0
+    for n in range(ips):
+        ip = f"ip_10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"
+        for _ in range(requests_per_ip):
+            limiter.check(ip)
+            calls += 1
+        clock.tick()
+        if on_ip is not None:
+            on_ip(n + 1)
+    return calls
+
+def run(name: str, factory, step: float, ips: int, requests_per_ip: int, checkpoints: int):
+    """Esegue la simulazione due volte: con tracemalloc per la memoria e senza per i tempi."""
+    clock = SimulatedClock(step)
+    limiter = factory(clock)
+    every = max(1, ips // checkpoints)
+    samples = []
+
+    def sample(count: int):
+        if count % every == 0:
+            samples.append((count, (tracemalloc.get_traced_memory()[0] - baseline) / 1024 / 1024))
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    simulate(limiter, clock, ips, requests_per_ip, sample)
+    tracemalloc.stop()
+
+    clock = SimulatedClock(step)
+    timed_limiter = factory(clock)
+    start = time.perf_counter()
+    calls = simulate(timed_limiter, clock, ips, requests_per_ip)
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{name}")
+    for count, mb in samples:
+        print(f"  {count:>8} IP: {mb:8.2f} MB")
+    print(f"  costo medio: {elapsed / calls * 1e6:.2f} µs/chiamata")
+    return limiter
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ips', type=int, default=100_000, help="IP distinti simulati")
+    parser.add_argument('--requests-per-ip', type=int, default=3)
+    parser.add_argument('--max-keys', type=int, default=security.RATE_LIMIT_MAX_KEYS,
+                        help="Chiavi massime del nuovo limiter")
+    parser.add_argument('--step', type=float, default=0.5, help="Secondi simulati tra un IP e il successivo")
+    parser.add_argument('--checkpoints', type=int, default=5)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print(f"{args.ips} IP distinti, {args.requests_per_ip} richieste ciascuno, "
+          f"{args.step}s simulati tra un IP e il successivo")
+
+    run("Prima (liste di datetime, chiavi mai rimosse)", LegacyRateLimiter,
+        args.step, args.ips, args.requests_per_ip, args.checkpoints)
+
+    limiter = run(
+        f"Dopo (finestra scorrevole, max {args.max_keys} chiavi)",
+        lambda clock: SlidingWindowRateLimiter(
+            [(60, security.MAX_REQUESTS_PER_MINUTE, "minute"), (3600, security.MAX_REQUESTS_PER_HOUR, "hour")],
+            max_keys=args.max_keys,
+            clock=clock,
+        ),
+        args.step, args.ips, args.requests_per_ip, args.checkpoints
+    )
+    print(f"  {limiter.stats()}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark dell'overhead Python del retrieval.
+
+Confronta, su un Qdrant in memoria con embedding già calcolati:
+- "prima": index.as_retriever() ricreato a ogni chiamata + conversione con hasattr/getattr
+- "dopo": retriever dal registry (LlamaIndexBackend.get_retriever) + conversione diretta
+
+Uso:
+    python benchmark_retriever.py --calls 2000
+"""
+
+import sys
+import time
+import random
+import logging
+import argparse
+
+from retrieval_backends import LlamaIndexBackend
+from llama_index.core import VectorStoreIndex, QueryBundle
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client import QdrantClient
+
+DIM = 64
+
+def legacy_retrieve(index, query_bundle, top_k):
+    """Percorso originale: retriever ricreato e conversione difensiva."""
+    retriever = index.as_retriever(similarity_top_k=top_k)
+    nodes = retriever.retrieve(query_bundle)
+    results = []
+    for node_with_score in nodes:
+        node = node_with_score.node if hasattr(node_with_score, 'node') else node_with_score
+        score = getattr(node_with_score, 'score', 0.0)
+        text = getattr(node, 'text', '') if hasattr(node, 'text') else str(node)
+        metadata = getattr(node, 'metadata', {}) if hasattr(node, 'metadata') else {}
+        results.append({
+            'text': text,
+            'source': metadata.get('source', 'unknown'),
+            'score': float(score) if score else 0.0
+        })
+    return results
+
+def current_retrieve(backend, query_bundle, top_k):
+    """Percorso attuale: retriever dal registry e conversione diretta."""
+    retriever = backend.get_retriever(top_k)
+    return backend.nodes_to_contexts(retriever.retrieve(query_bundle))
+
+def measure(fn, calls: int) -> float:
+    """Restituisce il tempo medio per chiamata in microsecondi."""
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000, help="Chiamate per variante")
+    parser.add_argument('--chunks', type=int, default=200, help="Chunk nella collection in memoria")
+    parser.add_argument('--top-k', type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    rng = random.Random(42)
+    vector_store = QdrantVectorStore(client=QdrantClient(location=":memory:"), collection_name="bench")
+    vector_store.add([
+        TextNode(
+            text=f"Chunk di prova numero {i}",
+            metadata={'source': f"doc_{i % 10}.pdf"},
+            embedding=[rng.random() for _ in range(DIM)]
+        )
+        for i in range(args.chunks)
+    ])
+    embed_model = MockEmbedding(embed_dim=DIM)
+    index = VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
+    backend = LlamaIndexBackend(index, embed_model)
+
+    query_bundle = QueryBundle(query_str="Cos'è DataClinic?", embedding=[rng.random() for _ in range(DIM)])
+
+    assert legacy_retrieve(index, query_bundle, args.top_k) == current_retrieve(backend, query_bundle, args.top_k)
+
+    # Riscaldamento
+    measure(lambda: legacy_retrieve(index, query_bundle, args.top_k), 50)
+    measure(lambda: current_retrieve(backend, query_bundle, args.top_k), 50)
+
+    before = measure(lambda: legacy_retrieve(index, query_bundle, args.top_k), args.calls)
+    after = measure(lambda: current_retrieve(backend, query_bundle, args.top_k), args.calls)
+
+    # Solo l'overhead Python (senza la ricerca): costruzione retriever + conversione
+    nodes = backend.get_retriever(args.top_k).retrieve(query_bundle)
+    build_before = measure(lambda: index.as_retriever(similarity_top_k=args.top_k), args.calls)
+    build_after = measure(lambda: backend.get_retriever(args.top_k), args.calls)
+    convert_after = measure(lambda: backend.nodes_to_contexts(nodes), args.calls)
+
+    print(f"Retrieval completo  prima: {before:8.1f} µs/chiamata   dopo: {after:8.1f} µs/chiamata")
+    print(f"Costruzione retriever prima: {build_before:6.1f} µs   dopo (registry): {build_after:6.2f} µs")
+    print(f"Conversione risultati dopo: {convert_after:6.2f} µs")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark del tempo di avvio (import) e della memoria di un worker.
+
+Esegue `python -X importtime -c "import main"` in un processo separato e riporta:
+- tempo totale di import di main.py
+- import diretti più pesanti
+- memoria residente massima (RSS) dopo l'import
+- se LlamaIndex è stato importato (non deve esserlo: viene caricato solo dal backend 'llamaindex')
+
+Come confronto misura anche l'import eager di LlamaIndex, come faceva retrieve_context.py
+prima dell'import lazy.
+
+Uso:
+    python benchmark_startup.py                # stampa il report
+    python benchmark_startup.py --record       # aggiorna startup_baseline.json
+    python benchmark_startup.py --check        # fallisce se peggiora oltre la tolleranza
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+BASELINE_FILE = Path(__file__).parent / 'startup_baseline.json'
+# Peggioramento massimo accettato rispetto alla baseline registrata
+TOLERANCE = 0.25
+
+PROBE = (
+    "import sys, resource\n"
+    "{imports}\n"
+    "print('LLAMA_INDEX_LOADED=' + str(any(m.startswith('llama_index') for m in sys.modules)))\n"
+    "print('MAX_RSS_KB=' + str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))\n"
+)
+
+def measure(imports: str, runs: int) -> dict:
+    """Esegue il probe `runs` volte e restituisce la mediana dei tempi di import."""
+    env = dict(os.environ)
+    # Evitiamo chiamate di rete e log rumorosi durante l'import
+    env.setdefault('OPENAI_API_KEY', '')
+    env.setdefault('QDRANT_API_KEY', '')
+
+    totals, rss, heaviest, llama_loaded = [], [], {}, False
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROBE.format(imports=imports)],
+            capture_output=True, text=True, env=env, cwd=Path(__file__).parent
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr[-2000:])
+
+        total_us = 0
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+            if depth == 0:
+                # Modulo top-level (non importato da un altro modulo)
+                total_us += int(cumulative)
+            elif depth == 1:
+                # Dipendenze importate direttamente (es. da main.py)
+                module = name.strip()
+                heaviest[module] = max(heaviest.get(module, 0), int(cumulative))
+        totals.append(total_us / 1000)
+
+        for line in proc.stdout.splitlines():
+            if line.startswith('MAX_RSS_KB='):
+                rss.append(int(line.split('=')[1]) / 1024)
+            elif line.startswith('LLAMA_INDEX_LOADED='):
+                llama_loaded = line.split('=')[1] == 'True'
+
+    totals.sort()
+    rss.sort()
+    top = sorted(heaviest.items(), key=lambda item: item[1], reverse=True)[:8]
+    return {
+        "import_ms": round(totals[len(totals) // 2], 1),
+        "max_rss_mb": round(rss[len(rss) // 2], 1),
+        "llama_index_loaded": llama_loaded,
+        "heaviest_modules_ms": {name: round(us / 1000, 1) for name, us in top},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="Ripetizioni (si usa la mediana)")
+    parser.add_argument('--record', action='store_true', help="Salva i risultati come nuova baseline")
+    parser.add_argument('--check', action='store_true', help="Confronta con la baseline e fallisce se peggiora")
+    args = parser.parse_args()
+
+    current = measure("import main", args.runs)
+    eager = measure(
+        "import main\n"
+        "import llama_index.core, llama_index.vector_stores.qdrant, llama_index.embeddings.openai",
+        args.runs
+    )
+
+    print(f"import main (lazy):          {current['import_ms']:8.1f} ms   RSS {current['max_rss_mb']:7.1f} MB"
+          f"   llama_index caricato: {current['llama_index_loaded']}")
+    print(f"import main + LlamaIndex:    {eager['import_ms']:8.1f} ms   RSS {eager['max_rss_mb']:7.1f} MB")
+    print("Import diretti più pesanti (import main):")
+    for name, ms in current["heaviest_modules_ms"].items():
+        print(f"  {name:40s} {ms:8.1f} ms")
+
+    if args.record:
+        BASELINE_FILE.write_text(json.dumps({
+            "import_ms": current["import_ms"],
+            "max_rss_mb": current["max_rss_mb"],
+            "eager_llama_index_import_ms": eager["import_ms"],
+            "eager_llama_index_max_rss_mb": eager["max_rss_mb"],
+        }, indent=2) + "\n")
+        print(f"Baseline salvata in {BASELINE_FILE.name}")
+
+    if args.check:
+        baseline = json.loads(BASELINE_FILE.read_text())
+        failures = []
+        if current["llama_index_loaded"]:
+            failures.append("llama_index viene importato all'avvio")
+        for key in ("import_ms", "max_rss_mb"):
+            limit = baseline[key] * (1 + TOLERANCE)
+            if current[key] > limit:
+                failures.append(f"{key}: {current[key]} oltre il limite {limit:.1f} (baseline {baseline[key]})")
+        if failures:
+            print("❌ Regressione dell'avvio:\n  " + "\n  ".join(failures))
+            return 1
+        print("✅ Avvio entro la baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+Costruzione del contesto da inserire nel prompt entro un budget di token.
+
+Invece di concatenare sempre i primi 3 chunk, qualunque siano score e lunghezza:
+- si recuperano CONTEXT_CANDIDATES chunk e si scartano quelli sotto la soglia di score
+- i chunk dello stesso file che si sovrappongono (l'overlap di CHUNK_OVERLAP tra chunk
+  consecutivi) vengono uniti in un unico passaggio senza ripetere la parte in comune;
+  i chunk già contenuti in un passaggio incluso vengono scartati
+- i passaggi vengono aggiunti in ordine di score finché stanno in CONTEXT_MAX_TOKENS,
+  contati con tiktoken sul testo formattato (intestazioni comprese)
+
+Configurazione:
+    CONTEXT_MAX_TOKENS=1000       budget di token del contesto
+    CONTEXT_CANDIDATES=6          chunk recuperati da Qdrant tra cui scegliere
+    CONTEXT_MIN_SCORE=0.2         score coseno minimo (ricerca densa)
+    CONTEXT_MIN_RRF_SCORE=0       score RRF minimo (ricerca ibrida, vedi hybrid_search.py)
+    CONTEXT_TOKENIZER=o200k_base  encoding di tiktoken (quello dei modelli gpt-4o)
+
+tiktoken scarica l'encoding al primo uso (o lo legge da TIKTOKEN_CACHE_DIR): se non è
+disponibile i token vengono stimati in 4 caratteri per token.
+"""
+
+import os
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', '1000'))
+CONTEXT_CANDIDATES = int(os.getenv('CONTEXT_CANDIDATES', '6'))
+CONTEXT_MIN_SCORE = float(os.getenv('CONTEXT_MIN_SCORE', '0.2'))
+CONTEXT_MIN_RRF_SCORE = float(os.getenv('CONTEXT_MIN_RRF_SCORE', '0'))
+CONTEXT_TOKENIZER = os.getenv('CONTEXT_TOKENIZER', 'o200k_base')
+
+CONTEXT_HEADER = "\n\n--- Informazioni rilevanti da DataClinic ---\n\n"
+CONTEXT_FOOTER = "--- Fine informazioni ---\n\n"
+
+# Sovrapposizione minima (in caratteri) perché due chunk vengano considerati consecutivi
+MIN_OVERLAP_CHARS = 50
+# Stima usata quando l'encoding di tiktoken non è disponibile
+CHARS_PER_TOKEN = 4
+
+def format_block(source: str, text: str) -> str:
+    return f"[Fonte: {source}]\n{text}\n\n"
+
+def format_context(passages: List[Dict]) -> str:
+    """Testo del contesto nel formato atteso dal prompt (vedi security.create_safe_prompt)."""
+    if not passages:
+        return ""
+    return CONTEXT_HEADER + "".join(format_block(p['source'], p['text']) for p in passages) + CONTEXT_FOOTER
+
+def _overlap(first: str, second: str, min_overlap: int = MIN_OVERLAP_CHARS) -> int:
+    """Lunghezza del più lungo suffisso di `first` che è anche prefisso di `second` (0 se < min_overlap)."""
+    probe = second[:min_overlap]
+    if len(probe) < min_overlap:
+        return 0
+    pos = first.find(probe, max(0, len(first) - len(second)))
+    while pos != -1:
+        if second.startswith(first[pos:]):
+            return len(first) - pos
+        pos = first.find(probe, pos + 1)
+    return 0
+
+def merge_overlapping(first: str, second: str, min_overlap: int = MIN_OVERLAP_CHARS) -> Optional[str]:
+    """
+    Unisce due chunk che si sovrappongono (in qualunque ordine) senza ripetere la parte comune.
+
+    Returns:
+        Il testo unito, oppure None se i chunk non si sovrappongono
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    overlap = _overlap(first, second, min_overlap)
+    if overlap:
+        return first + second[overlap:]
+    overlap = _overlap(second, first, min_overlap)
+    if overlap:
+        return second + first[overlap:]
+    return None
+
+class TokenCounter:
+    """Conteggio dei token con tiktoken, caricato al primo uso; stima per caratteri se non disponibile."""
+
+    def __init__(self, encoding_name: str = CONTEXT_TOKENIZER):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Carica l'encoding (da chiamare al warm-up: il primo caricamento può scaricare file)."""
+        if self._loaded:
+            return self._encoding
+        with self._lock:
+            if not self._loaded:
+                try:
+                    import tiktoken
+                    self._encoding = tiktoken.get_encoding(self.encoding_name)
+                except Exception as e:
+                    logger.warning(f"Encoding tiktoken '{self.encoding_name}' non disponibile ({e}): "
+                                   f"i token del contesto verranno stimati")
+                self._loaded = True
+        return self._encoding
+
+    @property
+    def exact(self) -> bool:
+        return self.load() is not None
+
+    def count(self, text: str) -> int:
+        encoding = self.load()
+        if encoding is None:
+            return -(-len(text) // CHARS_PER_TOKEN)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Primi `max_tokens` token del testo."""
+        encoding = self.load()
+        if encoding is None:
+            return text[:max_tokens * CHARS_PER_TOKEN]
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+@dataclass
+class BuiltContext:
+    """Contesto per il prompt e statistiche di costruzione."""
+    text: str = ""
+    # Passaggi inclusi ('source', 'text', 'score', 'tokens'), con i chunk consecutivi già uniti
+    passages: List[Dict] = field(default_factory=list)
+    tokens: int = 0
+    candidates: int = 0
+    below_min_score: int = 0
+    # Chunk uniti a un passaggio sovrapposto o già contenuti in uno incluso
+    merged: int = 0
+    over_budget: int = 0
+    truncated: bool = False
+
+    def summary(self) -> str:
+        return (f"{len(self.passages)} passaggi, {self.tokens} token (candidati {self.candidates}, "
+                f"sotto soglia {self.below_min_score}, uniti {self.merged}, fuori budget {self.over_budget}"
+                f"{', troncato' if self.truncated else ''})")
+
+class ContextBuilder:
+    """Seleziona, deduplica e impagina i chunk recuperati entro un budget di token."""
+
+    def __init__(self, max_tokens: int = CONTEXT_MAX_TOKENS, min_score: float = CONTEXT_MIN_SCORE,
+                 min_rrf_score: float = CONTEXT_MIN_RRF_SCORE, token_counter: Optional[TokenCounter] = None):
+        self.max_tokens = max_tokens
+        self.min_score = min_score
+        self.min_rrf_score = min_rrf_score
+        self.token_counter = token_counter or TokenCounter()
+
+    def build(self, contexts: List[Dict], hybrid: bool = False) -> BuiltContext:
+        """
+        Costruisce il contesto dai chunk recuperati.
+
+        Args:
+            contexts: Chunk con 'text', 'source', 'score' (come restituiti dal retrieval)
+            hybrid: True se gli score sono RRF (ricerca ibrida) invece che coseno
+        """
+        result = BuiltContext(candidates=len(contexts))
+        min_score = self.min_rrf_score if hybrid else self.min_score
+        count = self.token_counter.count
+        used = count(CONTEXT_HEADER) + count(CONTEXT_FOOTER)
+        passages: List[Dict] = []
+
+        for context in sorted(contexts, key=lambda c: c['score'], reverse=True):
+            if context['score'] < min_score:
+                result.below_min_score += 1
+                continue
+            text = context['text'].strip()
+            if not text:
+                continue
+
+            # Chunk sovrapposto a un passaggio dello stesso file: si aggiunge solo la parte nuova
+            passage, merged_text = None, None
+            for candidate in passages:
+                if candidate['source'] == context['source']:
+                    merged_text = merge_overlapping(candidate['text'], text)
+                    if merged_text is not None:
+                        passage = candidate
+                        break
+            if passage is not None:
+                if merged_text != passage['text']:
+                    tokens = count(format_block(passage['source'], merged_text))
+                    if used - passage['tokens'] + tokens > self.max_tokens:
+                        # La parte nuova non sta nel budget: il chunk conta solo come fuori budget
+                        result.over_budget += 1
+                        continue
+                    used += tokens - passage['tokens']
+                    passage.update(text=merged_text, tokens=tokens)
+                result.merged += 1
+                continue
+
+            tokens = count(format_block(context['source'], text))
+            if used + tokens > self.max_tokens:
+                if passages:
+                    # Un chunk più corto con score più basso potrebbe ancora starci
+                    result.over_budget += 1
+                    continue
+                # Anche il chunk migliore supera il budget: lo si tronca invece di non dare contesto
+                overhead = count(format_block(context['source'], ""))
+                text = self.token_counter.truncate(text, max(0, self.max_tokens - used - overhead))
+                if not text:
+                    result.over_budget += 1
+                    continue
+                tokens = count(format_block(context['source'], text))
+                result.truncated = True
+            used += tokens
+            passages.append({'source': context['source'], 'text': text, 'score': context['score'], 'tokens': tokens})
+
+        result.passages = passages
+        if passages:
+            result.text = format_context(passages)
+            # Conteggio sul testo finale (i confini tra blocchi possono spostare qualche token)
+            result.tokens = count(result.text)
+        return result
@@ -0,0 +1,515 @@
+"""
+Archivio locale delle conversazioni: finestra dei messaggi recenti, riassunto progressivo
+dei messaggi più vecchi e token consumati per thread.
+
+Senza archivio ogni turno aggiungeva al thread di OpenAI la domanda con tutto il contesto di
+Qdrant, quindi i token in input (e latenza e costo) crescevano a ogni turno. Con l'archivio:
+- si salvano la domanda dell'utente e il contesto iniettato separatamente: nella cronologia
+  che arriva al modello c'è solo la domanda, il contesto vale per il turno corrente
+- al modello arrivano solo i messaggi non ancora riassunti (al massimo
+  CONVERSATION_WINDOW_MESSAGES + CONVERSATION_SUMMARY_BATCH) più il riassunto dei precedenti
+- quando i messaggi non riassunti superano la finestra di CONVERSATION_SUMMARY_BATCH, i più
+  vecchi vengono fusi nel riassunto con una chiamata a Chat Completions, in background
+  dopo la risposta
+- i token di ogni risposta (e dei riassunti) vengono sommati per thread
+
+Con l'Assistants API la finestra è applicata con truncation_strategy e riassunto e contesto
+passano negli additional_instructions della run; con Chat Completions (vedi chat_completions.py)
+la cronologia viene letta solo da qui.
+
+Archivi disponibili:
+- SQLiteConversationStore: file SQLite (default con lo stato in memoria), conserva tutti i
+  messaggi finché il thread è attivo
+- SharedConversationStore: sul backend di stato (default con STATE_BACKEND=redis, condiviso tra
+  repliche), conserva solo i messaggi non ancora riassunti
+
+In entrambi un thread scade dopo CONVERSATION_TTL secondi di inattività e si scrive solo nei
+thread creati da /start: un thread_id sconosciuto inviato dal client non crea righe. L'archivio
+SQLite tiene al più CONVERSATION_MAX_THREADS thread (i meno usati di recente vengono rimossi).
+
+Configurazione:
+    CONVERSATION_STORE=sqlite|state        (default: 'state' se il backend di stato è condiviso)
+    CONVERSATION_DB_PATH=.conversations.sqlite
+    CONVERSATION_TTL=86400                 (CHAT_HISTORY_TTL per compatibilità)
+    CONVERSATION_MAX_THREADS=100000        (solo archivio 'sqlite', 0 = nessun limite)
+    CONVERSATION_WINDOW_MESSAGES=6         messaggi recenti sempre inviati per intero
+                                           (default CHAT_HISTORY_MAX_MESSAGES - CONVERSATION_SUMMARY_BATCH)
+    CONVERSATION_SUMMARY_BATCH=4           messaggi oltre la finestra che fanno scattare il riassunto
+    CONVERSATION_SUMMARY_MODEL=gpt-4o-mini
+    CONVERSATION_SUMMARY_MAX_TOKENS=300
+"""
+
+import os
+import json
+import asyncio
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from metrics import stage, record_prompt_tokens
+from state_backend import get_state_backend
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', '').lower()
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', '.conversations.sqlite')
+# CHAT_HISTORY_TTL e CHAT_HISTORY_MAX_MESSAGES sono i nomi della cronologia di Chat Completions
+# prima dell'archivio delle conversazioni: restano validi se le nuove variabili non sono impostate
+CONVERSATION_TTL = float(os.getenv('CONVERSATION_TTL', os.getenv('CHAT_HISTORY_TTL', '86400')))
+CONVERSATION_MAX_THREADS = int(os.getenv('CONVERSATION_MAX_THREADS', '100000'))
+CONVERSATION_SUMMARY_BATCH = int(os.getenv('CONVERSATION_SUMMARY_BATCH', '4'))
+CONVERSATION_WINDOW_MESSAGES = int(os.getenv(
+    'CONVERSATION_WINDOW_MESSAGES',
+    max(2, int(os.getenv('CHAT_HISTORY_MAX_MESSAGES', '10')) - CONVERSATION_SUMMARY_BATCH)
+))
+CONVERSATION_SUMMARY_MODEL = os.getenv('CONVERSATION_SUMMARY_MODEL', os.getenv('CHAT_MODEL', 'gpt-4o-mini'))
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_MAX_TOKENS', '300'))
+
+SUMMARY_INSTRUCTIONS = (
+    "Aggiorna il riassunto di una conversazione tra un utente e l'assistente di DataClinic. "
+    "Conserva argomenti, richieste, dati forniti dall'utente e risposte date; ometti i dettagli "
+    "non necessari per rispondere alle domande successive. Scrivi in italiano, in terza persona, "
+    "in meno di 200 parole. Restituisci solo il riassunto."
+)
+
+USAGE_FIELDS = ("turns", "prompt_tokens", "completion_tokens", "summary_prompt_tokens",
+                "summary_completion_tokens", "last_prompt_tokens")
+
+@dataclass
+class Conversation:
+    """Stato di una conversazione: riassunto e messaggi non ancora riassunti."""
+    thread_id: str
+    summary: str = ""
+    # Id dell'ultimo messaggio incluso nel riassunto
+    summarized_upto: int = 0
+    # Messaggi successivi al riassunto: 'id', 'role', 'content' (la domanda senza contesto)
+    messages: List[Dict] = field(default_factory=list)
+    usage: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(USAGE_FIELDS, 0))
+    # False se il thread non è nell'archivio (es. creato prima dell'archivio delle conversazioni)
+    stored: bool = True
+    # Messaggi non ancora riassunti nell'archivio (anche quelli esclusi da `messages`)
+    unsummarized: int = 0
+
+class SQLiteConversationStore:
+    """
+    Conversazioni su SQLite: un thread per riga, un messaggio per riga (con il contesto a parte).
+    I thread inattivi da più di `ttl` secondi vengono rimossi con i loro messaggi e, oltre
+    `max_threads` (0 = nessun limite), si rimuovono i thread usati meno di recente.
+    """
+
+    name = "sqlite"
+    # File locale: con più repliche ogni istanza vede solo i turni che ha servito
+    shared = False
+    # Oltre il limite si scende a questa frazione, così la pulizia non scatta a ogni nuovo thread
+    PRUNE_TARGET = 0.9
+    # Ogni quanti secondi cercare i thread scaduti
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(self, path: str = CONVERSATION_DB_PATH, ttl: float = CONVERSATION_TTL,
+                 max_threads: int = CONVERSATION_MAX_THREADS):
+        self.path = path
+        self.ttl = ttl
+        self.max_threads = max_threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        usage_columns = "".join(f" {name} INTEGER NOT NULL DEFAULT 0," for name in USAGE_FIELDS)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            " thread_id TEXT PRIMARY KEY,"
+            " summary TEXT NOT NULL DEFAULT '',"
+            " summarized_upto INTEGER NOT NULL DEFAULT 0,"
+            f"{usage_columns}"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " thread_id TEXT NOT NULL,"
+            " role TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " context TEXT,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS threads_updated ON threads (updated_at)")
+        self._conn.commit()
+        self._threads, = self._conn.execute("SELECT COUNT(*) FROM threads").fetchone()
+        self._next_prune = 0.0
+        self.expired = 0
+        self.evicted = 0
+
+    def _delete_threads(self, where: str, params: tuple) -> int:
+        """Rimuove i thread selezionati da `where` e i loro messaggi."""
+        self._conn.execute(f"DELETE FROM messages WHERE thread_id IN (SELECT thread_id FROM threads WHERE {where})",
+                           params)
+        removed = self._conn.execute(f"DELETE FROM threads WHERE {where}", params).rowcount
+        self._threads -= removed
+        return removed
+
+    def _prune(self, now: float):
+        """Thread scaduti (sempre) e, oltre max_threads, i meno usati di recente."""
+        self._next_prune = time.monotonic() + self.PRUNE_INTERVAL
+        if self.ttl:
+            self.expired += self._delete_threads("updated_at < ?", (now - self.ttl,))
+        if self.max_threads and self._threads > self.max_threads:
+            excess = self._threads - int(self.max_threads * self.PRUNE_TARGET)
+            self.evicted += self._delete_threads(
+                "thread_id IN (SELECT thread_id FROM threads ORDER BY updated_at LIMIT ?)", (excess,)
+            )
+            logger.info(f"Archivio conversazioni {self.path}: {self._threads} thread dopo la rimozione dei meno usati")
+        self._conn.commit()
+
+    def _touch(self, thread_id: str, now: float) -> bool:
+        """Aggiorna updated_at di un thread ancora valido; False se il thread non c'è o è scaduto."""
+        return self._conn.execute(
+            "UPDATE threads SET updated_at = ? WHERE thread_id = ? AND updated_at >= ?",
+            (now, thread_id, now - self.ttl if self.ttl else 0)
+        ).rowcount > 0
+
+    def create(self, thread_id: str):
+        now = time.time()
+        with self._lock:
+            if self.ttl:
+                # Un thread scaduto ma non ancora rimosso riparte vuoto
+                self._delete_threads("thread_id = ? AND updated_at < ?", (thread_id, now - self.ttl))
+            self._threads += self._conn.execute(
+                "INSERT INTO threads (thread_id, created_at, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(thread_id) DO NOTHING",
+                (thread_id, now, now)
+            ).rowcount
+            self._conn.commit()
+            if time.monotonic() >= self._next_prune or (self.max_threads and self._threads > self.max_threads):
+                self._prune(now)
+
+    def load(self, thread_id: str) -> Optional[Conversation]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT summary, summarized_upto, updated_at, {', '.join(USAGE_FIELDS)} FROM threads WHERE thread_id = ?",
+                (thread_id,)
+            ).fetchone()
+            if row is None or (self.ttl and row[2] < time.time() - self.ttl):
+                return None
+            messages = self._conn.execute(
+                "SELECT id, role, content FROM messages WHERE thread_id = ? AND id > ? ORDER BY id",
+                (thread_id, row[1])
+            ).fetchall()
+        return Conversation(
+            thread_id, row[0], row[1],
+            [{"id": id_, "role": role, "content": content} for id_, role, content in messages],
+            dict(zip(USAGE_FIELDS, row[3:])),
+        )
+
+    def append(self, thread_id: str, messages: List[Dict]) -> bool:
+        now = time.time()
+        with self._lock:
+            if not self._touch(thread_id, now):
+                return False
+            self._conn.executemany(
+                "INSERT INTO messages (thread_id, role, content, context, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(thread_id, m['role'], m['content'], m.get('context'), now) for m in messages]
+            )
+            self._conn.commit()
+        return True
+
+    def set_summary(self, thread_id: str, summary: str, upto: int):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE threads SET summary = ?, summarized_upto = ? WHERE thread_id = ? AND summarized_upto < ?",
+                (summary, upto, thread_id, upto)
+            )
+            self._conn.commit()
+
+    def add_usage(self, thread_id: str, usage: Dict[str, int]) -> bool:
+        """Somma i contatori indicati (last_prompt_tokens viene sostituito)."""
+        assignments = ", ".join(
+            f"{name} = ?" if name == "last_prompt_tokens" else f"{name} = {name} + ?" for name in usage
+        )
+        with self._lock:
+            if not self._touch(thread_id, time.time()):
+                return False
+            self._conn.execute(f"UPDATE threads SET {assignments} WHERE thread_id = ?", (*usage.values(), thread_id))
+            self._conn.commit()
+        return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            messages, = self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()
+        return {"store": self.name, "path": self.path, "threads": self._threads, "messages": messages,
+                "ttl": self.ttl, "max_threads": self.max_threads, "expired": self.expired, "evicted": self.evicted}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class SharedConversationStore:
+    """
+    Conversazioni sul backend di stato (vedi state_backend.py), condivise tra worker e repliche.
+    Ogni thread è un documento JSON con TTL, modificato con aggiornamenti atomici; i messaggi già
+    riassunti e il contesto non vengono conservati.
+    """
+
+    name = "state"
+
+    def __init__(self, backend=None, ttl: float = CONVERSATION_TTL):
+        self._backend = backend
+        self.ttl = ttl
+
+    @property
+    def backend(self):
+        # Risolto al primo uso, così vale il backend impostato con set_state_backend
+        return self._backend or get_state_backend()
+
+    @property
+    def shared(self) -> bool:
+        return self.backend.shared
+
+    @staticmethod
+    def _key(thread_id: str) -> str:
+        return f"conversation:{thread_id}"
+
+    def _read(self, thread_id: str) -> Optional[Dict]:
+        value = self.backend.get(self._key(thread_id))
+        return json.loads(value) if value is not None else None
+
+    def _write(self, thread_id: str, document: Dict):
+        self.backend.set(self._key(thread_id), json.dumps(document, ensure_ascii=False).encode('utf-8'),
+                         ttl=self.ttl)
+
+    def _update(self, thread_id: str, change: Callable[[Dict], bool]) -> bool:
+        """
+        Modifica il documento del thread in modo atomico (vedi update del backend di stato): il
+        riassunto in background e il turno successivo dello stesso thread non si sovrascrivono.
+
+        Args:
+            change: Modifica il documento e restituisce False se non c'è nulla da scrivere;
+                può essere chiamata più volte se un altro processo scrive nel frattempo
+
+        Returns:
+            True se il documento esiste ed è stato aggiornato
+        """
+        def apply(value: Optional[bytes]) -> Optional[bytes]:
+            if value is None:
+                return None
+            document = json.loads(value)
+            if not change(document):
+                return None
+            return json.dumps(document, ensure_ascii=False).encode('utf-8')
+
+        return self.backend.update(self._key(thread_id), apply, ttl=self.ttl) is not None
+
+    @staticmethod
+    def _new_document() -> Dict:
+        return {"summary": "", "summarized_upto": 0, "next_id": 1, "messages": [],
+                "usage": dict.fromkeys(USAGE_FIELDS, 0)}
+
+    def create(self, thread_id: str):
+        self._write(thread_id, self._new_document())
+
+    def load(self, thread_id: str) -> Optional[Conversation]:
+        document = self._read(thread_id)
+        if document is None:
+            return None
+        return Conversation(thread_id, document["summary"], document["summarized_upto"],
+                            document["messages"], document["usage"])
+
+    def append(self, thread_id: str, messages: List[Dict]) -> bool:
+        def change(document: Dict) -> bool:
+            for message in messages:
+                document["messages"].append({"id": document["next_id"], "role": message['role'],
+                                             "content": message['content']})
+                document["next_id"] += 1
+            return True
+
+        return self._update(thread_id, change)
+
+    def set_summary(self, thread_id: str, summary: str, upto: int):
+        def change(document: Dict) -> bool:
+            if document["summarized_upto"] >= upto:
+                return False
+            document.update(summary=summary, summarized_upto=upto,
+                            messages=[m for m in document["messages"] if m["id"] > upto])
+            return True
+
+        self._update(thread_id, change)
+
+    def add_usage(self, thread_id: str, usage: Dict[str, int]) -> bool:
+        def change(document: Dict) -> bool:
+            for name, value in usage.items():
+                document["usage"][name] = value if name == "last_prompt_tokens" else document["usage"][name] + value
+            return True
+
+        return self._update(thread_id, change)
+
+    def stats(self) -> Dict:
+        return {"store": self.name, "ttl": self.ttl}
+
+    def close(self):
+        pass
+
+def create_conversation_store(kind: Optional[str] = None):
+    """
+    Crea l'archivio indicato da `kind` (default: variabile CONVERSATION_STORE; se non è impostata
+    'state' quando il backend di stato è condiviso tra processi, altrimenti 'sqlite').
+    """
+    kind = (kind or CONVERSATION_STORE or ('state' if get_state_backend().shared else 'sqlite')).lower()
+    if kind == 'state':
+        return SharedConversationStore()
+    if kind != 'sqlite':
+        logger.warning(f"CONVERSATION_STORE '{kind}' non valido, uso 'sqlite'")
+    return SQLiteConversationStore()
+
+class ConversationMemory:
+    """Finestra, riassunto progressivo e token per thread sopra un archivio di conversazioni."""
+
+    def __init__(self, store=None, window_messages: int = CONVERSATION_WINDOW_MESSAGES,
+                 summary_batch: int = CONVERSATION_SUMMARY_BATCH, summary_model: str = CONVERSATION_SUMMARY_MODEL,
+                 summary_max_tokens: int = CONVERSATION_SUMMARY_MAX_TOKENS):
+        self.store = store if store is not None else create_conversation_store()
+        self.window_messages = window_messages
+        self.summary_batch = summary_batch
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        # Thread con un riassunto in corso in questo processo
+        self._summarizing = set()
+        # Archivio locale a un processo mentre lo stato è condiviso tra più processi o repliche:
+        # ogni istanza vede solo i turni che ha servito, quindi la finestra può essere incompleta
+        self.partial_history = not self.store.shared and get_state_backend().shared
+        if self.partial_history:
+            logger.warning(f"Archivio delle conversazioni '{self.store.name}' locale con STATE_BACKEND condiviso: "
+                           "la cronologia dei thread dell'assistente non viene troncata. "
+                           "Usa CONVERSATION_STORE=state per condividere la finestra tra le repliche")
+
+    @property
+    def max_history_messages(self) -> int:
+        """Messaggi della cronologia inviati al più al modello (anche se il riassunto è in ritardo)."""
+        return self.window_messages + self.summary_batch
+
+    def create(self, thread_id: Optional[str] = None) -> str:
+        thread_id = thread_id or f"thread_{uuid.uuid4().hex[:24]}"
+        self.store.create(thread_id)
+        return thread_id
+
+    def load(self, thread_id: str) -> Conversation:
+        """Riassunto e cronologia da inviare (una conversazione vuota se il thread non è nell'archivio)."""
+        conversation = self.store.load(thread_id) or Conversation(thread_id, stored=False)
+        conversation.unsummarized = len(conversation.messages)
+        history = conversation.messages[-self.max_history_messages:]
+        # La cronologia deve iniziare con una domanda, non con una risposta rimasta senza domanda
+        while history and history[0]['role'] != 'user':
+            history = history[1:]
+        conversation.messages = history
+        return conversation
+
+    @staticmethod
+    def history_messages(conversation: Conversation) -> List[Dict]:
+        """Cronologia nel formato di Chat Completions."""
+        return [{"role": m['role'], "content": m['content']} for m in conversation.messages]
+
+    def record_exchange(self, thread_id: str, question: str, answer: str, context: Optional[str] = None):
+        """
+        Salva la domanda (con il contesto iniettato a parte) e la risposta mostrata all'utente.
+        Nei thread che l'archivio non conosce (o scaduti) non viene salvato nulla.
+        """
+        self.store.append(thread_id, [
+            {"role": "user", "content": question, "context": context or None},
+            {"role": "assistant", "content": answer},
+        ])
+
+    def record_usage(self, thread_id: str, usage, summary: bool = False):
+        """Somma i token di una risposta (o di un riassunto) ai contatori del thread."""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        if summary:
+            self.store.add_usage(thread_id, {"summary_prompt_tokens": prompt_tokens,
+                                             "summary_completion_tokens": completion_tokens})
+        else:
+            record_prompt_tokens(prompt_tokens)
+            self.store.add_usage(thread_id, {"turns": 1, "prompt_tokens": prompt_tokens,
+                                             "completion_tokens": completion_tokens,
+                                             "last_prompt_tokens": prompt_tokens})
+
+    def usage(self, thread_id: str) -> Optional[Dict]:
+        conversation = self.store.load(thread_id)
+        if conversation is None:
+            return None
+        usage = dict(conversation.usage)
+        usage["total_tokens"] = sum(usage[name] for name in USAGE_FIELDS if name.endswith("_tokens")
+                                    and name != "last_prompt_tokens")
+        usage["unsummarized_messages"] = len(conversation.messages)
+        usage["summary_chars"] = len(conversation.summary)
+        return usage
+
+    def needs_summary(self, conversation: Conversation) -> bool:
+        """
+        True se, salvato lo scambio del turno corrente (domanda e risposta), i messaggi oltre la
+        finestra raggiungono summary_batch: solo allora conviene pianificare summarize.
+        """
+        return (self.summary_batch > 0 and conversation.stored
+                and conversation.unsummarized + 2 >= self.window_messages + self.summary_batch)
+
+    def is_first_turn(self, conversation: Conversation) -> bool:
+        """
+        True se il thread non ha ancora né cronologia né riassunto: la risposta dipende solo dalla
+        domanda e dai documenti, quindi può essere condivisa tra conversazioni (cache semantica).
+        False anche se l'archivio non conosce il thread o ne ha solo una parte dei turni.
+        """
+        return (conversation.stored and not self.partial_history
+                and conversation.unsummarized == 0 and not conversation.summary)
+
+    async def summarize(self, client, thread_id: str) -> bool:
+        """
+        Fonde nel riassunto i messaggi oltre la finestra, se sono almeno summary_batch.
+        Da eseguire dopo la risposta (BackgroundTasks): non rallenta il turno.
+
+        Returns:
+            True se il riassunto è stato aggiornato
+        """
+        if self.summary_batch <= 0 or thread_id in self._summarizing:
+            return False
+        # Le letture e scritture dell'archivio (SQLite o Redis) sono sincrone: vanno in un thread
+        conversation = await asyncio.to_thread(self.store.load, thread_id)
+        if conversation is None or len(conversation.messages) < self.window_messages + self.summary_batch:
+            return False
+        older = conversation.messages[:len(conversation.messages) - self.window_messages]
+        # Il riassunto termina con una risposta: la finestra inizia sempre con una domanda
+        while older and older[-1]['role'] != 'assistant':
+            older.pop()
+        if not older:
+            return False
+
+        self._summarizing.add(thread_id)
+        try:
+            transcript = "\n".join(
+                f"{'Utente' if m['role'] == 'user' else 'Assistente'}: {m['content']}" for m in older
+            )
+            with stage("summarize"):
+                response = await client.chat.completions.create(
+                    model=self.summary_model,
+                    max_tokens=self.summary_max_tokens,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                        {"role": "user", "content": f"Riassunto finora:\n{conversation.summary or '(nessuno)'}\n\n"
+                                                    f"Nuovi messaggi:\n{transcript}"},
+                    ],
+                )
+            summary = (response.choices[0].message.content or "").strip()
+            await asyncio.to_thread(self.record_usage, thread_id, response.usage, True)
+            if summary:
+                await asyncio.to_thread(self.store.set_summary, thread_id, summary, older[-1]['id'])
+                logger.info(f"Riassunto del thread {thread_id} aggiornato ({len(older)} messaggi)")
+                return True
+            return False
+        except Exception as e:
+            # Non bloccante: la cronologia resta limitata a max_history_messages
+            logger.warning(f"Riassunto del thread {thread_id} non riuscito: {e}")
+            return False
+        finally:
+            self._summarizing.discard(thread_id)
@@ -0,0 +1,489 @@
+"""
+Cache degli embedding delle query.
+
+Il traffico del chatbot è dominato da domande quasi identiche ("Cos'è DataClinic?"),
+quindi ricalcolare l'embedding della query a ogni richiesta costa un round-trip
+verso OpenAI evitabile. Questo modulo fornisce:
+- EmbeddingCache: cache in memoria con eviction LRU, TTL e contatori hit/miss
+- SQLiteEmbeddingStore: archivio persistente su disco (sopravvive ai riavvii), condiviso con
+  l'ingestion dei PDF, con limiti di dimensione ed export/import
+- SharedEmbeddingStore: livello condiviso tra worker e repliche sul backend di stato (Redis)
+"""
+
+import os
+import sys
+import asyncio
+import gzip
+import json
+import time
+import base64
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Archivio persistente: con EMBEDDING_CACHE_PATH lo usano anche le query del chatbot,
+# l'ingestion lo usa sempre (default .embedding_cache.sqlite)
+EMBEDDING_STORE_PATH = os.getenv('EMBEDDING_CACHE_PATH') or '.embedding_cache.sqlite'
+EMBEDDING_STORE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '0'))  # 0 = nessun limite
+EMBEDDING_STORE_MAX_MB = float(os.getenv('EMBEDDING_CACHE_MAX_MB', '2048'))  # 0 = nessun limite
+
+def text_hash(text: str) -> str:
+    """
+    Hash SHA-256 del testo (chiave compatta e di lunghezza fissa). È l'unica chiave degli
+    embedding, per le query come per l'ingestion: testo diverso, anche solo nelle maiuscole,
+    ha un embedding diverso.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class SQLiteEmbeddingStore:
+    """
+    Archivio persistente di embedding su SQLite, indicizzato per (modello, hash del testo).
+    I vettori sono salvati come blob float32.
+
+    È content-addressed: lo stesso testo con lo stesso modello ha sempre lo stesso embedding,
+    quindi l'archivio può essere condiviso tra query del chatbot e ingestion (upload_pdf.py)
+    e sopravvive a cambi di chunking e a collection ricreate. La dimensione è limitata da
+    `max_entries` e `max_bytes` (0 = nessun limite): oltre il limite vengono rimossi gli
+    embedding usati meno di recente.
+    """
+
+    # Oltre il limite si scende a questa frazione, così la pulizia non scatta a ogni scrittura
+    PRUNE_TARGET = 0.9
+    # Aggiornamenti di last_used accumulati e scritti insieme (dopo TOUCH_BATCH letture o
+    # TOUCH_INTERVAL secondi), invece di un commit a ogni lettura
+    TOUCH_BATCH = 100
+    TOUCH_INTERVAL = 30.0
+
+    def __init__(self, path: str, max_entries: int = 0, max_bytes: int = 0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # timeout: ingestion e server possono usare lo stesso file
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (model, key))"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")}
+        if 'last_used' not in columns:
+            # Archivi creati prima dei limiti di dimensione
+            self._conn.execute("ALTER TABLE embeddings ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+            self._conn.execute("UPDATE embeddings SET last_used = created_at")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._entries, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        self.evicted = 0
+        self._touches: Dict[tuple, float] = {}
+        self._touch_reads = 0
+        self._last_touch_flush = time.monotonic()
+
+    def get(self, model: str, key: str) -> Optional[List[float]]:
+        return self.get_many(model, [key]).get(key)
+
+    def set(self, model: str, key: str, embedding: List[float]):
+        self.set_many(model, {key: embedding})
+
+    def get_many(self, model: str, keys: List[str]) -> Dict[str, List[float]]:
+        """Embedding presenti per le chiavi indicate (le chiavi mancanti sono assenti dal risultato)."""
+        found = {}
+        now = time.time()
+        with self._lock:
+            # Limite di SQLite sul numero di parametri per query
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [model, *chunk],
+                )
+                for key, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            for key in found:
+                self._touches[(model, key)] = now
+            self._touch_reads += len(found)
+            if (self._touch_reads >= self.TOUCH_BATCH
+                    or time.monotonic() - self._last_touch_flush >= self.TOUCH_INTERVAL):
+                self._flush_touches()
+        return found
+
+    def _flush_touches(self):
+        """Scrive gli aggiornamenti di last_used in sospeso (da chiamare con il lock)."""
+        self._last_touch_flush = time.monotonic()
+        self._touch_reads = 0
+        if not self._touches:
+            return
+        self._conn.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+            [(used, model, key) for (model, key), used in self._touches.items()],
+        )
+        self._conn.commit()
+        self._touches.clear()
+
+    def set_many(self, model: str, embeddings: Dict[str, List[float]]):
+        """Salva più embedding in una sola transazione, poi applica i limiti di dimensione."""
+        now = time.time()
+        rows = [(model, key, array('f', embedding).tobytes(), now, now) for key, embedding in embeddings.items()]
+        with self._lock:
+            self._insert(rows, replace=True)
+            self._enforce_limits()
+
+    def _insert(self, rows: list, replace: bool):
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        before = self._conn.total_changes
+        self._conn.executemany(
+            f"{verb} INTO embeddings (model, key, vector, created_at, last_used) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self._conn.commit()
+        # Stima incrementale (le sostituzioni contano come nuove): il valore esatto viene
+        # ricalcolato quando si supera il limite
+        inserted = self._conn.total_changes - before
+        if rows and inserted:
+            self._entries += inserted
+            self._bytes += inserted * sum(len(row[2]) for row in rows) // len(rows)
+
+    def _over_limit(self, factor: float = 1.0) -> bool:
+        return ((self.max_entries and self._entries > self.max_entries * factor)
+                or (self.max_bytes and self._bytes > self.max_bytes * factor))
+
+    def _enforce_limits(self):
+        if not self._over_limit():
+            return
+        # L'ordine di rimozione deve tenere conto delle letture recenti
+        self._flush_touches()
+        self._entries, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        while self._entries and self._over_limit(self.PRUNE_TARGET):
+            excess = []
+            if self.max_entries:
+                excess.append(self._entries - int(self.max_entries * self.PRUNE_TARGET))
+            if self.max_bytes:
+                average = self._bytes / self._entries
+                excess.append(int((self._bytes - self.max_bytes * self.PRUNE_TARGET) / average) + 1)
+            removed_entries, removed_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM ("
+                " SELECT vector FROM embeddings ORDER BY last_used LIMIT ?)", (max(1, max(excess)),)
+            ).fetchone()
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (max(1, max(excess)),)
+            )
+            self._conn.commit()
+            self._entries -= removed_entries
+            self._bytes -= removed_bytes
+            self.evicted += removed_entries
+        logger.info(f"Archivio embedding {self.path}: {self._entries} embedding, "
+                    f"{self._bytes / 1024 / 1024:.1f} MB dopo la rimozione dei meno usati")
+
+    def prune(self):
+        """Applica subito i limiti di dimensione (es. dopo averli ridotti)."""
+        with self._lock:
+            self._enforce_limits()
+
+    def export(self, path: str, model: Optional[str] = None) -> int:
+        """
+        Esporta gli embedding in JSON Lines ({"model", "key", "vector"} con il vettore float32
+        in base64), compresso se il nome termina con .gz.
+
+        Returns:
+            Numero di embedding esportati
+        """
+        query = "SELECT model, key, vector FROM embeddings"
+        params: tuple = ()
+        if model:
+            query += " WHERE model = ?"
+            params = (model,)
+        count = 0
+        with self._lock, _open_dump(path, 'wt') as f:
+            for row_model, key, blob in self._conn.execute(query, params):
+                f.write(json.dumps({"model": row_model, "key": key,
+                                    "vector": base64.b64encode(blob).decode('ascii')}) + "\n")
+                count += 1
+        return count
+
+    def import_(self, path: str) -> int:
+        """
+        Importa un file creato con export(). Gli embedding già presenti non vengono modificati.
+
+        Returns:
+            Numero di embedding aggiunti
+        """
+        added = 0
+        now = time.time()
+        with self._lock, _open_dump(path, 'rt') as f:
+            batch = []
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                batch.append((item["model"], item["key"], base64.b64decode(item["vector"]), now, now))
+                if len(batch) >= 1000:
+                    before = self._entries
+                    self._insert(batch, replace=False)
+                    added += self._entries - before
+                    batch = []
+            if batch:
+                before = self._entries
+                self._insert(batch, replace=False)
+                added += self._entries - before
+            self._enforce_limits()
+        return added
+
+    def stats(self) -> Dict:
+        with self._lock:
+            models = dict(self._conn.execute("SELECT model, COUNT(*) FROM embeddings GROUP BY model"))
+            return {
+                "path": self.path,
+                "entries": self._entries,
+                "size_mb": round(self._bytes / 1024 / 1024, 2),
+                "max_entries": self.max_entries,
+                "max_mb": round(self.max_bytes / 1024 / 1024, 2),
+                "evicted": self.evicted,
+                "models": models,
+            }
+
+    def close(self):
+        with self._lock:
+            self._flush_touches()
+            self._conn.close()
+
+def _open_dump(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def open_embedding_store(path: Optional[str] = None) -> SQLiteEmbeddingStore:
+    """Apre l'archivio persistente con i limiti di dimensione configurati nell'ambiente."""
+    return SQLiteEmbeddingStore(
+        path or EMBEDDING_STORE_PATH,
+        max_entries=EMBEDDING_STORE_MAX_ENTRIES,
+        max_bytes=int(EMBEDDING_STORE_MAX_MB * 1024 * 1024),
+    )
+
+class SharedEmbeddingStore:
+    """
+    Livello condiviso sul backend di stato (vedi state_backend.py): un embedding calcolato
+    da un worker è subito disponibile agli altri worker e alle altre repliche.
+    """
+
+    def __init__(self, backend, ttl: Optional[float] = None):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, model: str, key: str) -> Optional[List[float]]:
+        blob = self.backend.get(f"emb:{model}:{key}")
+        if blob is None:
+            return None
+        vector = array('f')
+        vector.frombytes(blob)
+        return vector.tolist()
+
+    def set(self, model: str, key: str, embedding: List[float]):
+        self.backend.set(f"emb:{model}:{key}", array('f', embedding).tobytes(), ttl=self.ttl)
+
+    def close(self):
+        pass
+
+class EmbeddingCache:
+    """
+    Cache LRU + TTL degli embedding in memoria, con livello persistente opzionale.
+
+    Le chiavi sono (modello, text_hash del testo), le stesse dell'ingestion, quindi i livelli
+    persistenti sono condivisi con upload_pdf.py e cambiare modello di embedding non
+    restituisce mai vettori incompatibili. aget/aset leggono e scrivono il livello persistente
+    in un thread, per non bloccare l'event loop.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 86400,
+                 store: Optional[SQLiteEmbeddingStore] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingCache":
+        """
+        Crea la cache leggendo EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL e EMBEDDING_CACHE_PATH.
+        Senza EMBEDDING_CACHE_PATH, se il backend di stato è condiviso (Redis) lo usa come
+        secondo livello.
+        """
+        from state_backend import get_state_backend
+
+        path = os.getenv('EMBEDDING_CACHE_PATH')
+        ttl = float(os.getenv('EMBEDDING_CACHE_TTL', '86400'))
+        store = None
+        if path:
+            try:
+                store = open_embedding_store(path)
+                logger.info(f"Cache embedding persistente attiva: {path}")
+            except Exception as e:
+                logger.warning(f"Impossibile aprire la cache embedding persistente {path}: {e}")
+        elif get_state_backend().shared:
+            store = SharedEmbeddingStore(get_state_backend(), ttl=ttl)
+            logger.info("Cache embedding condivisa sul backend di stato")
+        return cls(
+            max_size=int(os.getenv('EMBEDDING_CACHE_SIZE', '1024')),
+            ttl=ttl,
+            store=store,
+        )
+
+    def _key(self, model: str, text: str) -> tuple:
+        return model, text_hash(text)
+
+    def _get_memory(self, key: tuple) -> Optional[List[float]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, embedding = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+        return None
+
+    def _get_store(self, key: tuple) -> Optional[List[float]]:
+        if self.store is None:
+            return None
+        try:
+            embedding = self.store.get(*key)
+        except Exception as e:
+            logger.warning(f"Errore lettura cache embedding persistente: {e}")
+            return None
+        if embedding is not None:
+            self._remember(key, embedding)
+            with self._lock:
+                self.hits += 1
+                self.persistent_hits += 1
+        return embedding
+
+    def _set_store(self, key: tuple, embedding: List[float]):
+        try:
+            self.store.set(*key, embedding)
+        except Exception as e:
+            logger.warning(f"Errore scrittura cache embedding persistente: {e}")
+
+    def _record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Restituisce l'embedding in cache oppure None."""
+        key = self._key(model, text)
+        embedding = self._get_memory(key)
+        if embedding is None:
+            embedding = self._get_store(key)
+        if embedding is None:
+            self._record_miss()
+        return embedding
+
+    async def aget(self, model: str, text: str) -> Optional[List[float]]:
+        """Come get, ma il livello persistente viene letto in un thread."""
+        key = self._key(model, text)
+        embedding = self._get_memory(key)
+        if embedding is None and self.store is not None:
+            embedding = await asyncio.to_thread(self._get_store, key)
+        if embedding is None:
+            self._record_miss()
+        return embedding
+
+    def set(self, model: str, text: str, embedding: List[float]):
+        """Salva l'embedding in memoria (e su disco se configurato)."""
+        key = self._key(model, text)
+        self._remember(key, embedding)
+        if self.store is not None:
+            self._set_store(key, embedding)
+
+    async def aset(self, model: str, text: str, embedding: List[float]):
+        """Come set, ma il livello persistente viene scritto in un thread."""
+        key = self._key(model, text)
+        self._remember(key, embedding)
+        if self.store is not None:
+            await asyncio.to_thread(self._set_store, key, embedding)
+
+    def get_or_compute(self, model: str, text: str, compute: Callable[[], List[float]]) -> List[float]:
+        """Restituisce l'embedding in cache o lo calcola con `compute` e lo memorizza."""
+        embedding = self.get(model, text)
+        if embedding is None:
+            embedding = compute()
+            self.set(model, text, embedding)
+        return embedding
+
+    def _remember(self, key: tuple, embedding: List[float]):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "persistent_hits": self.persistent_hits,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "persistent": self.store is not None,
+            }
+
+def main():
+    """Gestione dell'archivio persistente: statistiche, export, import e pulizia."""
+    parser = argparse.ArgumentParser(description="Archivio persistente degli embedding")
+    parser.add_argument('--path', default=EMBEDDING_STORE_PATH, help="File SQLite dell'archivio")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help="Mostra dimensione e modelli presenti")
+    export_parser = commands.add_parser('export', help="Esporta in JSON Lines (.gz per comprimere)")
+    export_parser.add_argument('file')
+    export_parser.add_argument('--model', help="Solo gli embedding di questo modello")
+    import_parser = commands.add_parser('import', help="Importa un file creato con export")
+    import_parser.add_argument('file')
+    commands.add_parser('prune', help="Applica i limiti di dimensione configurati")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    store = open_embedding_store(args.path)
+    try:
+        if args.command == 'export':
+            print(f"Esportati {store.export(args.file, args.model)} embedding in {args.file}")
+        elif args.command == 'import':
+            print(f"Importati {store.import_(args.file)} embedding nuovi da {args.file}")
+        elif args.command == 'prune':
+            store.prune()
+        if args.command != 'export':
+            print(json.dumps(store.stats(), indent=2))
+    finally:
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
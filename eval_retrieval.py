@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Valutazione offline del retrieval: hit-rate, MRR, latenza e dimensione del contesto
+per la ricerca densa e per quella ibrida (densa + BM25 con RRF) su domande etichettate.
+
+Il file delle domande è in JSONL, una domanda per riga:
+    {"question": "Come si esporta il report mensile?", "source": "manuale.pdf", "contains": ["esporta"]}
+
+- source (opzionale): il chunk giusto deve venire da questo file
+- contains (opzionale): il chunk giusto deve contenere almeno una di queste stringhe
+  (senza distinzione tra maiuscole e minuscole)
+
+Una domanda è un "hit" a top_k se almeno uno dei primi top_k contesti soddisfa entrambe le
+condizioni. Gli embedding delle domande vengono calcolati una volta sola, quindi la latenza
+riportata è quella della sola ricerca su Qdrant. La colonna "contesto" è la lunghezza media in
+caratteri dei contesti restituiti: è quella che finisce nel prompt.
+
+Senza argomenti usa eval/questions.sample.jsonl, un insieme di esempio sul documento
+dataclinic.pdf: va esteso (o sostituito) con domande reali e le etichette dei propri documenti.
+
+Usa la configurazione del chatbot (QDRANT_URL, QDRANT_API_KEY, OPENAI_API_KEY, RETRIEVAL_BACKEND,
+QDRANT_SEARCH_*). La modalità ibrida richiede la collection con il vettore sparso (HYBRID_SEARCH).
+
+Uso:
+    python eval_retrieval.py --top-k 1 3 5
+    python eval_retrieval.py eval_questions.jsonl --modes dense hybrid --output eval.json
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+logger = logging.getLogger(__name__)
+
+MODES = ('dense', 'hybrid')
+# Domande etichettate di esempio (versionate con il codice)
+DEFAULT_QUESTIONS = str(Path(__file__).resolve().parent / 'eval' / 'questions.sample.jsonl')
+
+def load_questions(path: str) -> List[Dict]:
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get('question'):
+                raise ValueError(f"{path}:{line_number}: campo 'question' mancante")
+            if not item.get('source') and not item.get('contains'):
+                raise ValueError(f"{path}:{line_number}: serve almeno uno tra 'source' e 'contains'")
+            questions.append(item)
+    return questions
+
+def is_relevant(context: Dict, item: Dict) -> bool:
+    """True se il contesto soddisfa le etichette della domanda."""
+    if item.get('source') and context.get('source') != item['source']:
+        return False
+    expected = item.get('contains')
+    if expected:
+        if isinstance(expected, str):
+            expected = [expected]
+        text = context.get('text', '').lower()
+        return any(value.lower() in text for value in expected)
+    return True
+
+def evaluate(backend, questions: List[Dict], embeddings: List[List[float]], top_k: int) -> Dict:
+    """Esegue tutte le domande con `backend` e calcola le metriche a top_k."""
+    hits, reciprocal_ranks, latencies, context_chars = 0, [], [], []
+    for item, embedding in zip(questions, embeddings):
+        start = time.perf_counter()
+        contexts = backend.search(item['question'], embedding, top_k, item.get('filters'))
+        latencies.append((time.perf_counter() - start) * 1000)
+        context_chars.append(sum(len(context['text']) for context in contexts))
+        rank = next((i for i, context in enumerate(contexts, start=1) if is_relevant(context, item)), None)
+        if rank is not None:
+            hits += 1
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+
+    latencies.sort()
+    return {
+        "top_k": top_k,
+        "hit_rate": round(hits / len(questions), 4),
+        "mrr": round(statistics.mean(reciprocal_ranks), 4),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(0.95 * (len(latencies) - 1))], 2),
+        "avg_context_chars": round(statistics.mean(context_chars)),
+    }
+
+def run_evaluation(backends: Dict[str, object], questions: List[Dict], top_ks: Sequence[int]) -> List[Dict]:
+    """
+    Valuta ogni backend (modalità -> backend) a ogni top_k. Gli embedding delle domande
+    vengono calcolati una volta con il primo backend e riusati da tutti.
+    """
+    first = next(iter(backends.values()))
+    embeddings = [first.embed_query(item['question']) for item in questions]
+    results = []
+    for mode, backend in backends.items():
+        # Una ricerca a vuoto per aprire le connessioni prima di misurare
+        backend.search(questions[0]['question'], embeddings[0], max(top_ks))
+        for top_k in top_ks:
+            results.append({"mode": mode, **evaluate(backend, questions, embeddings, top_k)})
+    return results
+
+def print_report(results: List[Dict]):
+    print(f"{'modalità':<8} {'top_k':>5} {'hit-rate':>9} {'MRR':>6} {'p50 ms':>8} {'p95 ms':>8} {'contesto':>9}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['top_k']:>5} {r['hit_rate']:>9.3f} {r['mrr']:>6.3f} "
+              f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['avg_context_chars']:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('questions', nargs='?', default=DEFAULT_QUESTIONS,
+                        help="File JSONL con le domande etichettate (default: eval/questions.sample.jsonl)")
+    parser.add_argument('--top-k', type=int, nargs='+', default=[1, 3, 5])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--output', help="Salva i risultati in JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    import retrieve_context
+    from retrieval_backends import BACKENDS
+
+    if not retrieve_context.is_retrieval_configured():
+        logger.error("QDRANT_API_KEY o OPENAI_API_KEY non configurate")
+        return 1
+    questions = load_questions(args.questions)
+    if not questions:
+        logger.error(f"Nessuna domanda in {args.questions}")
+        return 1
+
+    backend_class = BACKENDS[retrieve_context.RETRIEVAL_BACKEND]
+    backends = {}
+    for mode in args.modes:
+        backend = backend_class.create(
+            url=retrieve_context.QDRANT_URL, api_key=retrieve_context.QDRANT_API_KEY,
+            openai_api_key=retrieve_context.OPENAI_API_KEY, collection_name=retrieve_context.COLLECTION_NAME,
+            embedding_model=retrieve_context.EMBEDDING_MODEL, async_client=False,
+            search_params=retrieve_context.SEARCH_PARAMS, hybrid=mode == 'hybrid',
+        )
+        if mode == 'hybrid' and not backend.hybrid:
+            logger.error("Modalità ibrida non disponibile sulla collection: valutata solo la ricerca densa")
+            continue
+        backends[mode] = backend
+
+    print(f"{len(questions)} domande, backend {retrieve_context.RETRIEVAL_BACKEND}, "
+          f"collection {retrieve_context.COLLECTION_NAME}\n")
+    results = run_evaluation(backends, questions, args.top_k)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"questions": len(questions), "results": results}, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
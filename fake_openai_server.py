@@ -0,0 +1,402 @@
+"""
+Server OpenAI finto per benchmark e test di carico offline.
+Implementa il sottoinsieme dell'Assistants API usato da main.py (threads, messages, runs),
+Chat Completions (CHAT_BACKEND=completions) e l'endpoint degli embedding usato da retrieval e ingestion, con una latenza configurabile, così da misurare il comportamento del server senza
+chiamare (e pagare) OpenAI.
+
+Avvio manuale:
+    uvicorn fake_openai_server:app --port 9100
+
+Poi avvia il chatbot puntando al server finto:
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=fake ASSISTANT_ID=asst_fake uvicorn main:app
+"""
+
+import os
+import re
+import time
+import uuid
+import math
+import asyncio
+import base64
+import hashlib
+import json
+import threading
+from array import array
+from typing import Dict, List
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Latenza simulata per ogni chiamata HTTP (secondi)
+FAKE_LATENCY = float(os.getenv('FAKE_OPENAI_LATENCY', '0.05'))
+# Durata simulata di una run prima di passare a 'completed' (secondi)
+FAKE_RUN_DURATION = float(os.getenv('FAKE_OPENAI_RUN_DURATION', '0.5'))
+# Stato finale delle run (completed, failed, expired, cancelled, incomplete), per provare la
+# gestione delle run che terminano senza risposta
+FAKE_RUN_STATUS = os.getenv('FAKE_OPENAI_RUN_STATUS', 'completed')
+# Ritardo tra un token e il successivo nelle run in streaming (secondi)
+FAKE_TOKEN_DELAY = float(os.getenv('FAKE_OPENAI_TOKEN_DELAY', '0.02'))
+# Testo restituito dall'assistente finto
+FAKE_ANSWER = os.getenv(
+    'FAKE_OPENAI_ANSWER',
+    "DataClinic è una società che offre servizi di analisi dati e consulenza."
+)
+
+# Dimensione dei vettori restituiti da /v1/embeddings
+FAKE_EMBEDDING_DIM = int(os.getenv('FAKE_OPENAI_EMBEDDING_DIM', '256'))
+# Una richiesta di embedding ogni N risponde 429 (0 = mai), per provare retry e backoff
+FAKE_EMBEDDING_ERROR_EVERY = int(os.getenv('FAKE_OPENAI_EMBEDDING_ERROR_EVERY', '0'))
+
+app = FastAPI(title="Fake OpenAI Assistants API")
+
+# Stato in memoria
+_threads: Dict[str, List[dict]] = {}
+_runs: Dict[str, dict] = {}
+# Contatori delle chiamate agli embedding (per verificare cache e ingestion incrementale)
+_stats = {"embedding_requests": 0, "embedded_inputs": 0, "embedding_errors": 0, "chat_completions": 0, "requests": 0}
+# Messaggi dell'ultima richiesta a Chat Completions (per verificare la cronologia inviata)
+_last_chat_messages: List[dict] = []
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+def _message(thread_id: str, role: str, text: str, run_id: str = None) -> dict:
+    return {
+        "id": _new_id("msg"),
+        "object": "thread.message",
+        "created_at": int(time.time()),
+        "thread_id": thread_id,
+        "role": role,
+        "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+        "assistant_id": None,
+        "run_id": run_id,
+        "attachments": [],
+        "metadata": {},
+        "status": "completed",
+    }
+
+def _estimate_tokens(text: str) -> int:
+    """Token stimati in 4 caratteri per token (come context_builder senza tiktoken)."""
+    return -(-len(text) // 4)
+
+def _usage(prompt_texts: List[str]) -> dict:
+    prompt_tokens = sum(_estimate_tokens(text) for text in prompt_texts)
+    completion_tokens = _estimate_tokens(FAKE_ANSWER)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+def _run_usage(thread_id: str, body: dict) -> dict:
+    """Token in input di una run: messaggi del thread (dopo truncation_strategy) e istruzioni aggiuntive."""
+    messages = _threads[thread_id]
+    truncation = body.get("truncation_strategy") or {}
+    if truncation.get("type") == "last_messages" and truncation.get("last_messages"):
+        messages = messages[-truncation["last_messages"]:]
+    texts = [m["content"][0]["text"]["value"] for m in messages]
+    return _usage(texts + [body.get("additional_instructions") or ""])
+
+def _get_thread(thread_id: str) -> List[dict]:
+    if thread_id not in _threads:
+        raise HTTPException(status_code=404, detail=f"No thread found with id '{thread_id}'.")
+    return _threads[thread_id]
+
+def _finish_run(run: dict):
+    """Porta la run allo stato finale FAKE_RUN_STATUS."""
+    run["status"] = FAKE_RUN_STATUS
+    run["usage"] = run["_usage"]
+    if FAKE_RUN_STATUS == "completed":
+        run["completed_at"] = int(time.time())
+    elif FAKE_RUN_STATUS == "failed":
+        run["last_error"] = {"code": "server_error", "message": "Fake run failure"}
+    elif FAKE_RUN_STATUS == "incomplete":
+        run["incomplete_details"] = {"reason": "max_completion_tokens"}
+
+def _refresh_run(run: dict) -> dict:
+    """Fa avanzare la run a FAKE_RUN_STATUS quando è trascorsa FAKE_RUN_DURATION."""
+    if run["status"] in ("queued", "in_progress"):
+        if time.monotonic() - run["_started"] >= FAKE_RUN_DURATION:
+            _finish_run(run)
+            if run["status"] == "completed":
+                _threads[run["thread_id"]].append(
+                    _message(run["thread_id"], "assistant", FAKE_ANSWER, run_id=run["id"])
+                )
+        else:
+            run["status"] = "in_progress"
+    return {k: v for k, v in run.items() if not k.startswith('_')}
+
+def _active_run(thread_id: str):
+    """Run del thread ancora in corso (queued o in_progress), se c'è."""
+    for run in _runs.values():
+        if run["thread_id"] != thread_id:
+            continue
+        if not run.get("_stream"):
+            _refresh_run(run)
+        if run["status"] in ("queued", "in_progress"):
+            return run
+    return None
+
+@app.get('/v1/assistants/{assistant_id}')
+async def retrieve_assistant(assistant_id: str):
+    await asyncio.sleep(FAKE_LATENCY)
+    return {
+        "id": assistant_id,
+        "object": "assistant",
+        "created_at": int(time.time()),
+        "name": "Fake DataClinic Assistant",
+        "model": "gpt-4o-mini",
+        "instructions": None,
+        "tools": [],
+        "metadata": {},
+    }
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    _stats["requests"] += 1
+    return await call_next(request)
+
+@app.get('/v1/models/{model}')
+async def retrieve_model(model: str):
+    await asyncio.sleep(FAKE_LATENCY)
+    return {"id": model, "object": "model", "created": int(time.time()), "owned_by": "fake"}
+
+@app.post('/v1/threads')
+async def create_thread():
+    await asyncio.sleep(FAKE_LATENCY)
+    thread_id = _new_id("thread")
+    _threads[thread_id] = []
+    return {
+        "id": thread_id,
+        "object": "thread",
+        "created_at": int(time.time()),
+        "metadata": {},
+        "tool_resources": None,
+    }
+
+@app.post('/v1/threads/{thread_id}/messages')
+async def create_message(thread_id: str, request: Request):
+    await asyncio.sleep(FAKE_LATENCY)
+    body = await request.json()
+    if _active_run(thread_id):
+        # Come l'Assistants API: finché una run è attiva il thread non accetta nuovi messaggi
+        return JSONResponse(status_code=400, content={"error": {
+            "message": f"Can't add messages to {thread_id} while a run is active.",
+            "type": "invalid_request_error", "param": None, "code": None,
+        }})
+    content = body.get("content", "")
+    message = _message(thread_id, body.get("role", "user"), content if isinstance(content, str) else str(content))
+    _get_thread(thread_id).append(message)
+    return message
+
+@app.get('/v1/threads/{thread_id}/messages')
+async def list_messages(thread_id: str, limit: int = 20, order: str = "desc", run_id: str = None):
+    await asyncio.sleep(FAKE_LATENCY)
+    messages = list(_get_thread(thread_id))
+    if run_id:
+        messages = [m for m in messages if m["run_id"] == run_id]
+    if order == "desc":
+        messages.reverse()
+    data = messages[:limit]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": len(messages) > limit,
+    }
+
+@app.post('/v1/threads/{thread_id}/runs')
+async def create_run(thread_id: str, request: Request):
+    await asyncio.sleep(FAKE_LATENCY)
+    _get_thread(thread_id)
+    body = await request.json()
+    run = {
+        "id": _new_id("run"),
+        "object": "thread.run",
+        "created_at": int(time.time()),
+        "thread_id": thread_id,
+        "assistant_id": body.get("assistant_id"),
+        "status": "queued",
+        "last_error": None,
+        "completed_at": None,
+        "usage": None,
+        "_started": time.monotonic(),
+        "_usage": _run_usage(thread_id, body),
+    }
+    _runs[run["id"]] = run
+    if body.get("stream"):
+        run["_stream"] = True
+        return StreamingResponse(_stream_run(run), media_type="text/event-stream")
+    return _refresh_run(run)
+
+def _sse(event: str, data) -> str:
+    payload = data if isinstance(data, str) else json.dumps(data)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+async def _stream_run(run: dict):
+    """Emette gli eventi di una run in streaming come fa l'Assistants API."""
+    public_run = {k: v for k, v in run.items() if not k.startswith('_')}
+    yield _sse("thread.run.created", public_run)
+    run["status"] = "in_progress"
+    message = _message(run["thread_id"], "assistant", "", run_id=run["id"])
+    message["status"] = "in_progress"
+    yield _sse("thread.message.created", message)
+
+    # Il primo token arriva dopo la latenza di base, i successivi a intervalli regolari
+    await asyncio.sleep(FAKE_LATENCY)
+    for index, token in enumerate(FAKE_ANSWER.split(' ')):
+        if run["status"] == "cancelled":
+            yield _sse("thread.run.cancelled", {k: v for k, v in run.items() if not k.startswith('_')})
+            return
+        piece = token if index == 0 else ' ' + token
+        yield _sse("thread.message.delta", {
+            "id": message["id"],
+            "object": "thread.message.delta",
+            "delta": {"content": [{"index": 0, "type": "text", "text": {"value": piece, "annotations": []}}]},
+        })
+        await asyncio.sleep(FAKE_TOKEN_DELAY)
+
+    message["status"] = "completed"
+    message["content"][0]["text"]["value"] = FAKE_ANSWER
+    _threads[run["thread_id"]].append(message)
+    _finish_run(run)
+    yield _sse("thread.message.completed", message)
+    yield _sse(f"thread.run.{run['status']}", {k: v for k, v in run.items() if not k.startswith('_')})
+    yield _sse("done", "[DONE]")
+
+@app.get('/v1/threads/{thread_id}/runs/{run_id}')
+async def retrieve_run(thread_id: str, run_id: str):
+    await asyncio.sleep(FAKE_LATENCY)
+    if run_id not in _runs:
+        raise HTTPException(status_code=404, detail=f"No run found with id '{run_id}'.")
+    return _refresh_run(_runs[run_id])
+
+@app.post('/v1/threads/{thread_id}/runs/{run_id}/cancel')
+async def cancel_run(thread_id: str, run_id: str):
+    await asyncio.sleep(FAKE_LATENCY)
+    if run_id not in _runs:
+        raise HTTPException(status_code=404, detail=f"No run found with id '{run_id}'.")
+    run = _runs[run_id]
+    if run["status"] in ("queued", "in_progress"):
+        run["status"] = "cancelled"
+    return {k: v for k, v in run.items() if not k.startswith('_')}
+
+def _completion_chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+async def _stream_completion(completion_id: str, model: str, usage: dict = None):
+    """
+    Chunk di Chat Completions: primo token dopo la latenza di base, poi a intervalli regolari.
+    Con stream_options.include_usage l'ultimo chunk, senza choices, riporta i token.
+    """
+    await asyncio.sleep(FAKE_LATENCY)
+    yield f"data: {json.dumps(_completion_chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n"
+    for index, token in enumerate(FAKE_ANSWER.split(' ')):
+        piece = token if index == 0 else ' ' + token
+        yield f"data: {json.dumps(_completion_chunk(completion_id, model, {'content': piece}))}\n\n"
+        await asyncio.sleep(FAKE_TOKEN_DELAY)
+    yield f"data: {json.dumps(_completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+    if usage is not None:
+        yield f"data: {json.dumps({**_completion_chunk(completion_id, model, {}), 'choices': [], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+@app.post('/v1/chat/completions')
+async def create_chat_completion(request: Request):
+    body = await request.json()
+    _stats["chat_completions"] += 1
+    _last_chat_messages[:] = body.get("messages", [])
+    completion_id = _new_id("chatcmpl")
+    model = body.get("model", "gpt-4o-mini")
+    usage = _usage([str(m.get("content", "")) for m in _last_chat_messages])
+    if body.get("stream"):
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+        return StreamingResponse(_stream_completion(completion_id, model, usage if include_usage else None),
+                                 media_type="text/event-stream")
+    # Senza streaming la risposta arriva dopo il tempo di generazione di una run
+    await asyncio.sleep(FAKE_LATENCY + FAKE_RUN_DURATION)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": FAKE_ANSWER},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+def fake_embedding(text: str, dim: int = FAKE_EMBEDDING_DIM) -> List[float]:
+    """
+    Embedding deterministico "bag of words": ogni parola incrementa una dimensione scelta
+    dal suo hash, quindi testi con parole in comune hanno similarità coseno alta.
+    """
+    vector = [0.0] * dim
+    for word in re.findall(r'\w+', text.lower()):
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        index = int.from_bytes(digest[:4], 'little') % dim
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+def _encode_embedding(vector: List[float], encoding: str):
+    """Come l'API reale: con encoding_format=base64 (default dell'SDK) i float32 sono in base64."""
+    if encoding == "base64":
+        return base64.b64encode(array('f', vector).tobytes()).decode('ascii')
+    return vector
+
+@app.post('/v1/embeddings')
+async def create_embeddings(request: Request):
+    await asyncio.sleep(FAKE_LATENCY)
+    body = await request.json()
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    _stats["embedding_requests"] += 1
+    if FAKE_EMBEDDING_ERROR_EVERY and _stats["embedding_requests"] % FAKE_EMBEDDING_ERROR_EVERY == 0:
+        _stats["embedding_errors"] += 1
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": "0.1"},
+            content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+        )
+    _stats["embedded_inputs"] += len(inputs)
+    encoding = body.get("encoding_format", "float")
+    return {
+        "object": "list",
+        "model": body.get("model", "text-embedding-3-small"),
+        "data": [
+            {"object": "embedding", "index": i, "embedding": _encode_embedding(fake_embedding(text), encoding)}
+            for i, text in enumerate(inputs)
+        ],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    }
+
+@app.get('/fake/stats')
+async def fake_stats():
+    """Contatori delle chiamate ricevute dal server finto."""
+    return {**_stats, "last_chat_messages": len(_last_chat_messages)}
+
+def run_in_thread(host: str = "127.0.0.1", port: int = 9100) -> uvicorn.Server:
+    """
+    Avvia il server finto in un thread separato e attende che sia pronto.
+
+    Returns:
+        L'istanza uvicorn.Server (imposta `should_exit = True` per fermarlo)
+    """
+    config = uvicorn.Config(app, host=host, port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv('FAKE_OPENAI_PORT', '9100')))
@@ -0,0 +1,390 @@
+"""
+Server Redis finto per test e benchmark del backend di stato senza un Redis reale.
+
+Parla il protocollo RESP2/RESP3 e implementa il sottoinsieme di comandi usato da state_backend.py
+(GET/SET/DEL/EXPIRE, hash, TIME, SCRIPT LOAD/EVALSHA, transazioni WATCH/MULTI/EXEC). Non ha un
+interprete Lua: gli script
+noti (es. RATE_LIMIT_SCRIPT) sono associati a un'implementazione Python equivalente, eseguita
+senza interruzioni come farebbe Redis, quindi l'atomicità dello script è rispettata.
+
+Avvio manuale:
+    python fake_redis_server.py            # porta 6390 (FAKE_REDIS_PORT)
+
+Poi avvia il chatbot con:
+    STATE_BACKEND=redis REDIS_URL=redis://127.0.0.1:6390/0 uvicorn main:app --workers 4
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional
+
+from state_backend import RATE_LIMIT_SCRIPT
+
+class RespError(Exception):
+    """Errore restituito al client come risposta RESP '-ERR ...'."""
+
+class FakeRedis:
+    """Stato del server: stringhe e hash con scadenza opzionale."""
+
+    def __init__(self):
+        self.data: Dict[bytes, object] = {}
+        self.expires: Dict[bytes, float] = {}
+        # Numero di modifiche di ogni chiave, per WATCH
+        self.versions: Dict[bytes, int] = {}
+        self.scripts: Dict[str, Callable] = {}
+        self.known_scripts: Dict[str, Callable] = {}
+        self.commands = 0
+        self.register_script(RATE_LIMIT_SCRIPT, _rate_limit_script)
+
+    def register_script(self, source: str, implementation: Callable):
+        """Associa il sorgente di uno script Lua alla sua implementazione Python."""
+        self.known_scripts[hashlib.sha1(source.encode()).hexdigest()] = implementation
+
+    # --- Accesso ai valori con scadenza ---
+
+    def _alive(self, key: bytes) -> bool:
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+            self._touch(key)
+        return key in self.data
+
+    def _touch(self, key: bytes):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def version(self, key: bytes) -> int:
+        """Versione corrente della chiave (cambia a ogni scrittura, cancellazione o scadenza)."""
+        self._alive(key)
+        return self.versions.get(key, 0)
+
+    def _hash(self, key: bytes) -> Dict[bytes, bytes]:
+        if not self._alive(key):
+            self.data[key] = {}
+        value = self.data[key]
+        if not isinstance(value, dict):
+            raise RespError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    # --- Comandi ---
+
+    def execute(self, args: List[bytes]):
+        self.commands += 1
+        name = args[0].decode().upper()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            raise RespError(f"ERR unknown command '{name}'")
+        return handler(*args[1:])
+
+    def cmd_ping(self, *args):
+        return args[0] if args else "PONG"
+
+    def cmd_client(self, *args):
+        return "OK"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_time(self):
+        now = time.time()
+        return [str(int(now)).encode(), str(int((now % 1) * 1_000_000)).encode()]
+
+    def cmd_get(self, key):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if isinstance(value, dict):
+            raise RespError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def cmd_set(self, key, value, *options):
+        options = [o.upper() for o in options]
+        self._touch(key)
+        self.data[key] = value
+        self.expires.pop(key, None)
+        for i, option in enumerate(options):
+            if option == b'EX':
+                self.expires[key] = time.time() + int(options[i + 1])
+            elif option == b'PX':
+                self.expires[key] = time.time() + int(options[i + 1]) / 1000
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                self._touch(key)
+                removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        self._touch(key)
+        return 1
+
+    def cmd_ttl(self, key):
+        if not self._alive(key):
+            return -2
+        expires_at = self.expires.get(key)
+        return -1 if expires_at is None else int(round(expires_at - time.time()))
+
+    def cmd_hset(self, key, *pairs):
+        values = self._hash(key)
+        self._touch(key)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in values
+            values[field] = value
+        return added
+
+    def cmd_hmget(self, key, *fields):
+        values = self._hash(key) if self._alive(key) else {}
+        return [values.get(field) for field in fields]
+
+    def cmd_hgetall(self, key):
+        values = self._hash(key) if self._alive(key) else {}
+        return [item for pair in values.items() for item in pair]
+
+    def cmd_dbsize(self):
+        return sum(1 for key in list(self.data) if self._alive(key))
+
+    def cmd_flushdb(self, *args):
+        for key in self.data:
+            self._touch(key)
+        self.data.clear()
+        self.expires.clear()
+        return "OK"
+
+    cmd_flushall = cmd_flushdb
+
+    def cmd_script(self, subcommand, *args):
+        subcommand = subcommand.upper()
+        if subcommand == b'LOAD':
+            sha = hashlib.sha1(args[0]).hexdigest()
+            if sha not in self.known_scripts:
+                raise RespError("ERR fake redis: script non supportato (manca l'implementazione Python)")
+            self.scripts[sha] = self.known_scripts[sha]
+            return sha.encode()
+        if subcommand == b'EXISTS':
+            return [int(sha.decode() in self.scripts) for sha in args]
+        if subcommand == b'FLUSH':
+            self.scripts.clear()
+            return "OK"
+        raise RespError(f"ERR unknown SCRIPT subcommand '{subcommand.decode()}'")
+
+    def cmd_evalsha(self, sha, numkeys, *rest):
+        script = self.scripts.get(sha.decode())
+        if script is None:
+            raise RespError("NOSCRIPT No matching script. Please use EVAL.")
+        numkeys = int(numkeys)
+        return script(self, list(rest[:numkeys]), list(rest[numkeys:]))
+
+    def cmd_eval(self, source, numkeys, *rest):
+        sha = self.cmd_script(b'LOAD', source)
+        return self.cmd_evalsha(sha, numkeys, *rest)
+
+def _rate_limit_script(redis: FakeRedis, keys: List[bytes], argv: List[bytes]) -> int:
+    """Equivalente Python di state_backend.RATE_LIMIT_SCRIPT."""
+    seconds, micros = redis.cmd_time()
+    now = int(seconds) + int(micros) / 1_000_000
+    n = int(argv[0])
+    longest = 0.0
+    updates = []
+    for i in range(1, n + 1):
+        window = float(argv[2 * i - 1])
+        limit = float(argv[2 * i])
+        longest = max(longest, window)
+        start, cur, prev = redis.cmd_hmget(keys[0], f's{i}'.encode(), f'c{i}'.encode(), f'p{i}'.encode())
+        start = float(start) if start is not None else 0.0
+        cur = int(cur) if cur is not None else 0
+        prev = int(prev) if prev is not None else 0
+        elapsed = now - start
+        if elapsed >= window:
+            if elapsed < 2 * window:
+                prev, start = cur, start + window
+            else:
+                prev, start = 0, now
+            cur = 0
+            elapsed = now - start
+        if prev * (1 - elapsed / window) + cur >= limit:
+            return i
+        updates.append((start, cur, prev))
+    for i, (start, cur, prev) in enumerate(updates, start=1):
+        redis.cmd_hset(
+            keys[0],
+            f's{i}'.encode(), f'{start:.6f}'.encode(),
+            f'c{i}'.encode(), str(cur + 1).encode(),
+            f'p{i}'.encode(), str(prev).encode(),
+        )
+    redis.cmd_expire(keys[0], int(-(-2 * longest // 1)))
+    return 0
+
+class Transaction:
+    """
+    Stato di una connessione per WATCH/MULTI/EXEC: i comandi dopo MULTI vengono accodati ed
+    eseguiti tutti insieme da EXEC, che non esegue nulla (risposta nulla) se una chiave
+    osservata con WATCH è cambiata nel frattempo.
+    """
+
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.watched: Dict[bytes, int] = {}
+        self.queued: Optional[List[List[bytes]]] = None
+
+    def execute(self, args: List[bytes]):
+        name = args[0].upper()
+        if name == b'MULTI':
+            if self.queued is not None:
+                raise RespError("ERR MULTI calls can not be nested")
+            self.queued = []
+            return "OK"
+        if name == b'EXEC':
+            if self.queued is None:
+                raise RespError("ERR EXEC without MULTI")
+            queued, watched = self.queued, self.watched
+            self.queued, self.watched = None, {}
+            if any(self.redis.version(key) != version for key, version in watched.items()):
+                return None
+            return [self._run(command) for command in queued]
+        if name == b'DISCARD':
+            if self.queued is None:
+                raise RespError("ERR DISCARD without MULTI")
+            self.queued, self.watched = None, {}
+            return "OK"
+        if self.queued is not None:
+            self.queued.append(args)
+            return "QUEUED"
+        if name == b'WATCH':
+            for key in args[1:]:
+                self.watched[key] = self.redis.version(key)
+            return "OK"
+        if name == b'UNWATCH':
+            self.watched = {}
+            return "OK"
+        return self.redis.execute(args)
+
+    def _run(self, command: List[bytes]):
+        try:
+            return self.redis.execute(command)
+        except RespError as e:
+            return e
+
+# --- Protocollo RESP2 ---
+
+def _encode(value, protocol: int = 2) -> bytes:
+    if value is None:
+        return b"_\r\n" if protocol == 3 else b"$-1\r\n"
+    if isinstance(value, dict):
+        if protocol == 3:
+            items = b"".join(_encode(k, protocol) + _encode(v, protocol) for k, v in value.items())
+            return b"%" + str(len(value)).encode() + b"\r\n" + items
+        return _encode([item for pair in value.items() for item in pair], protocol)
+    if isinstance(value, RespError):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, str):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, bool) or isinstance(value, int):
+        return f":{int(value)}\r\n".encode()
+    if isinstance(value, bytes):
+        return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+    if isinstance(value, list):
+        return b"*" + str(len(value)).encode() + b"\r\n" + b"".join(_encode(v, protocol) for v in value)
+    raise TypeError(f"Tipo non supportato: {type(value)}")
+
+async def _read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Comando inline (es. da redis-cli o telnet)
+        return line.strip().split()
+    args = []
+    for _ in range(int(line[1:].strip())):
+        header = await reader.readline()
+        length = int(header[1:].strip())
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+class FakeRedisServer:
+    """Server TCP asyncio che espone un'istanza di FakeRedis."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6390):
+        self.host = host
+        self.port = port
+        self.redis = FakeRedis()
+        self.started = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        protocol = 2
+        transaction = Transaction(self.redis)
+        try:
+            while True:
+                args = await _read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                try:
+                    if args[0].upper() == b'HELLO':
+                        # Negoziazione del protocollo: vale per la sola connessione
+                        if len(args) > 1:
+                            protocol = int(args[1])
+                        reply = {b"server": b"redis", b"version": b"7.2.0", b"proto": protocol,
+                                 b"mode": b"standalone", b"role": b"master", b"modules": []}
+                    else:
+                        reply = transaction.execute(args)
+                except RespError as e:
+                    reply = e
+                except Exception as e:
+                    reply = RespError(f"ERR {e}")
+                writer.write(_encode(reply, protocol))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.started.set()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def stop(self):
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+def run_in_thread(host: str = "127.0.0.1", port: int = 6390) -> FakeRedisServer:
+    """
+    Avvia il server finto in un thread separato e attende che sia pronto.
+
+    Returns:
+        L'istanza FakeRedisServer (chiama stop() per fermarlo)
+    """
+    server = FakeRedisServer(host, port)
+    thread = threading.Thread(target=lambda: asyncio.run(_serve_until_closed(server)), daemon=True)
+    thread.start()
+    server.started.wait(timeout=5)
+    return server
+
+async def _serve_until_closed(server: FakeRedisServer):
+    try:
+        await server.serve()
+    except asyncio.CancelledError:
+        pass
+
+if __name__ == "__main__":
+    asyncio.run(FakeRedisServer(port=int(os.getenv('FAKE_REDIS_PORT', '6390'))).serve())
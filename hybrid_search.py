@@ -0,0 +1,144 @@
+"""
+Ricerca ibrida: vettori densi (embedding OpenAI) + vettori sparsi in stile BM25.
+
+La ricerca densa da sola perde le domande con nomi esatti di prodotti, codici e parole
+chiave italiane poco frequenti; per compensare bisognava alzare top_k (e la dimensione
+del prompt). Con la modalità ibrida:
+- in ingestion ogni chunk ha anche un vettore sparso (token -> peso della term frequency
+  saturata di BM25), salvato nel vettore sparso SPARSE_VECTOR_NAME della collection
+- Qdrant applica l'IDF lato server (modifier IDF della collection), quindi i pesi non
+  dipendono dal corpus e un chunk nuovo non richiede di ricalcolare gli altri
+- in ricerca si eseguono ricerca densa e sparsa (in una sola richiesta batch) e i
+  risultati vengono fusi con Reciprocal Rank Fusion
+
+Configurazione:
+    HYBRID_SEARCH=false          attiva la modalità ibrida (ingestion e retrieval)
+    SPARSE_VECTOR_NAME=bm25      nome del vettore sparso nella collection
+    HYBRID_CANDIDATES=20         risultati per ramo (denso e sparso) prima della fusione
+    RRF_K=60                     costante k di RRF: score = somma di 1 / (k + rank)
+    BM25_K1=1.2, BM25_B=0.75     parametri di BM25
+    BM25_AVG_DOC_LENGTH=100      lunghezza media attesa di un chunk in token (dopo le stopword)
+
+La modalità ibrida richiede una collection con il vettore sparso: va creata con
+`python qdrant_collection.py create --recreate` (con HYBRID_SEARCH=true) e poi ricaricata.
+"""
+
+import os
+import re
+import hashlib
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, List, Sequence, Tuple
+from dotenv import load_dotenv
+
+# Carica variabili d'ambiente
+load_dotenv('.env.local')
+load_dotenv()
+
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', 'false').lower() == 'true'
+SPARSE_VECTOR_NAME = os.getenv('SPARSE_VECTOR_NAME', 'bm25')
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '20'))
+RRF_K = int(os.getenv('RRF_K', '60'))
+BM25_K1 = float(os.getenv('BM25_K1', '1.2'))
+BM25_B = float(os.getenv('BM25_B', '0.75'))
+BM25_AVG_DOC_LENGTH = float(os.getenv('BM25_AVG_DOC_LENGTH', '100'))
+
+# Parole troppo frequenti per distinguere un chunk dall'altro (italiano e inglese),
+# comprese le forme elise ("dell'", "nell'", ...) che la tokenizzazione separa
+STOPWORDS = frozenset("""
+a ad agli ai al all alla alle allo anche c che chi ci come con cosa cui d da dagli dai dal dall dalla
+dalle dallo degli dei del dell della delle dello di dove e ed era essere gli ha hanno ho i il in io
+l la le lei li lo loro lui ma mi ne negli nei nel nell nella nelle nello noi non nostro o per perche
+piu puo qual quale quali quando quanto quella quelle quelli quello questa queste questi questo se si
+sia siamo sono su sua sue sugli sui sul sull sulla sulle sullo suo suoi ti tra tu tuo un una uno vi
+voi
+an and are as at be by for from how in is it of on or that the this to was what when where which who
+why with
+""".split())
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+def _strip_accents(text: str) -> str:
+    # "perché" e "perche" (o "qualità" e "qualita") devono dare lo stesso token
+    return "".join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+
+def tokenize(text: str) -> List[str]:
+    """Token in minuscolo e senza accenti, escluse stopword e lettere singole (i numeri restano)."""
+    return [
+        token for token in _TOKEN_PATTERN.findall(_strip_accents(text.lower()))
+        if token not in STOPWORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+@lru_cache(maxsize=65536)
+def token_index(token: str) -> int:
+    """Indice del token nel vettore sparso (hash a 32 bit: nessun vocabolario da mantenere)."""
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), 'little')
+
+def encode_document(text: str, k1: float = BM25_K1, b: float = BM25_B,
+                    avg_length: float = BM25_AVG_DOC_LENGTH) -> Tuple[List[int], List[float]]:
+    """Vettore sparso di un chunk: term frequency saturata e normalizzata per lunghezza (BM25 senza IDF)."""
+    counts = Counter(token_index(token) for token in tokenize(text))
+    length_norm = k1 * (1 - b + b * sum(counts.values()) / avg_length)
+    indices = list(counts)
+    return indices, [tf * (k1 + 1) / (tf + length_norm) for tf in counts.values()]
+
+def encode_query(text: str) -> Tuple[List[int], List[float]]:
+    """Vettore sparso della query: peso 1 per ogni token distinto (l'IDF lo applica Qdrant)."""
+    indices = list(dict.fromkeys(token_index(token) for token in tokenize(text)))
+    return indices, [1.0] * len(indices)
+
+def sparse_doc_fn(texts: List[str]) -> Tuple[List[List[int]], List[List[float]]]:
+    """Encoder dei documenti nel formato di QdrantVectorStore (sparse_doc_fn)."""
+    encoded = [encode_document(text) for text in texts]
+    return [indices for indices, _ in encoded], [values for _, values in encoded]
+
+def sparse_query_fn(texts: List[str]) -> Tuple[List[List[int]], List[List[float]]]:
+    """Encoder delle query nel formato di QdrantVectorStore (sparse_query_fn)."""
+    encoded = [encode_query(text) for text in texts]
+    return [indices for indices, _ in encoded], [values for _, values in encoded]
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[Hashable]], top_k: int,
+                           k: int = RRF_K) -> List[Tuple[Hashable, float]]:
+    """
+    Fonde più classifiche con Reciprocal Rank Fusion: ogni elemento riceve 1 / (k + rank)
+    da ogni classifica in cui compare. Usa solo le posizioni, quindi non serve rendere
+    confrontabili gli score coseno e BM25.
+
+    Returns:
+        Le prime top_k coppie (chiave, score RRF) in ordine decrescente
+    """
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+def rrf_fusion_fn(dense_result, sparse_result, alpha: float = 0.5, top_k: int = 2):
+    """
+    Fusione RRF nel formato di QdrantVectorStore (hybrid_fusion_fn), al posto della
+    relative score fusion di default. `alpha` non è usato: i due rami hanno lo stesso peso.
+    """
+    from llama_index.core.vector_stores.types import VectorStoreQueryResult
+
+    nodes = {}
+    rankings = []
+    for result in (dense_result, sparse_result):
+        ranking = []
+        for node in result.nodes or []:
+            nodes.setdefault(node.node_id, node)
+            ranking.append(node.node_id)
+        rankings.append(ranking)
+    fused = reciprocal_rank_fusion(rankings, top_k)
+    return VectorStoreQueryResult(
+        nodes=[nodes[node_id] for node_id, _ in fused],
+        similarities=[score for _, score in fused],
+        ids=[node_id for node_id, _ in fused],
+    )
+
+def collection_has_sparse_vector(qdrant_client, collection_name: str, vector_name: str = SPARSE_VECTOR_NAME) -> bool:
+    """True se la collection esiste e ha il vettore sparso `vector_name`."""
+    if not qdrant_client.collection_exists(collection_name):
+        return False
+    info = qdrant_client.get_collection(collection_name)
+    return vector_name in (info.config.params.sparse_vectors or {})
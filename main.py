@@ -1,17 +1,33 @@
 import os
 import logging
-from time import sleep
+from contextlib import asynccontextmanager
 from packaging import version
+import httpx
 import openai
-from openai import OpenAI
-from fastapi import FastAPI, HTTPException, Request
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi import Request as FastAPIRequest
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
+from typing import List, Optional, Tuple
 import asyncio
+import json
+import time
+from contextlib import aclosing
 from dotenv import load_dotenv
-from retrieve_context import retrieve_relevant_context, format_context_for_prompt
-from security import validate_and_sanitize_input, create_safe_prompt, log_security_event, detect_injection, check_rate_limit
+from retrieve_context import (
+    aretrieve_relevant_context, get_embedding_cache_stats, aget_query_embedding,
+    awarm_up, is_retrieval_configured, get_index_status, seconds_until_next_init_attempt, RETRIEVAL_TIMEOUT
+)
+from answer_cache import AnswerCache
+from chat_completions import create_completions_chat, CHAT_BACKEND, BACKEND_COMPLETIONS
+from conversation_store import Conversation, ConversationMemory
+from context_builder import ContextBuilder, CONTEXT_CANDIDATES
+from run_waiter import create_run_waiter, cancel_run, STATUS_TIMEOUT, STATUS_DISCONNECTED, TERMINAL_STATUSES
+from state_backend import get_state_backend, run_state_call
+import metrics
+from security import validate_and_sanitize_input, create_safe_prompt, create_context_instructions, log_security_event, detect_injection, check_rate_limit, StreamingInjectionGuard, get_rate_limit_stats, is_valid_thread_id
 
 # Carica le variabili d'ambiente dal file .env o .env.local
 # .env.local ha priorità se esiste (utile per override locali)
@@ -35,14 +51,16 @@ all_env_keys = sorted(os.environ.keys())
 logger.info(f"Total environment variables found: {len(all_env_keys)}")
 logger.info(f"Sample environment variable keys (first 20): {all_env_keys[:20]}")
 
-# Controlliamo che la versione di OpenAI sia corretta
-required_version = version.parse("1.1.1")
+# Controlliamo che la versione di OpenAI sia corretta: servono DefaultAsyncHttpxClient, runs.stream,
+# messages.list(run_id=...), truncation_strategy/additional_instructions e stream_options
+OPENAI_MIN_VERSION = "1.40.0"
+required_version = version.parse(OPENAI_MIN_VERSION)
 current_version = version.parse(openai.__version__)
 
 if current_version < required_version:
     raise ValueError(
         f"Error: OpenAI version {openai.__version__} "
-        f"is less than the required version 1.1.1"
+        f"is less than the required version {OPENAI_MIN_VERSION}"
     )
 else:
     logger.info(f"OpenAI version {openai.__version__} is compatible.")
@@ -50,6 +68,8 @@ else:
 # Carica le variabili d'ambiente
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ASSISTANT_ID = os.getenv('ASSISTANT_ID')
+# Con CHAT_BACKEND=completions l'assistente non viene usato (vedi chat_completions.py)
+ASSISTANT_ID_REQUIRED = CHAT_BACKEND != BACKEND_COMPLETIONS
 
 # Debug: mostra quali variabili sono presenti (senza valori sensibili)
 logger.info(f"Environment variables check:")
@@ -60,7 +80,7 @@ logger.info(f"  ASSISTANT_ID: {'SET' if ASSISTANT_ID else 'NOT SET'}")
 missing_vars = []
 if not OPENAI_API_KEY:
     missing_vars.append("OPENAI_API_KEY")
-if not ASSISTANT_ID:
+if not ASSISTANT_ID and ASSISTANT_ID_REQUIRED:
     missing_vars.append("ASSISTANT_ID")
 
 if missing_vars:
@@ -72,11 +92,109 @@ if missing_vars:
     logger.warning(error_msg)
     # Non blocchiamo l'avvio - permettiamo all'app di partire per permettere il debug
 
+# Pool di connessioni HTTP condiviso verso OpenAI
+# Un solo worker può così gestire decine di conversazioni in parallelo riusando le connessioni
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '100'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '30'))
+
+# Inizializziamo il client asincrono di OpenAI (sarà None se la chiave non è impostata)
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=OPENAI_TIMEOUT,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS
+        )
+    )
+) if OPENAI_API_KEY else None
+
+# Componente che crea la run e ne attende la conclusione (vedi run_waiter.py)
+run_waiter = create_run_waiter()
+# Cancellazioni delle run interrotte ancora in corso (riferimenti forti ai task)
+_pending_run_cancels = set()
+
+# Archivio delle conversazioni: finestra, riassunto e token per thread (vedi conversation_store.py)
+conversation_memory = ConversationMemory()
+
+# Backend di chat: None per l'Assistants API, altrimenti Chat Completions con cronologia locale
+completions_chat = create_completions_chat(conversation_memory)
+
+# Cache semantica delle risposte (vedi answer_cache.py)
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+answer_cache = AnswerCache.from_env()
+
+# Contesto del prompt: soglia di score, chunk sovrapposti uniti e budget di token (vedi context_builder.py)
+context_builder = ContextBuilder()
+
+# Risposta mostrata al posto di una risposta del modello bloccata dal controllo di sicurezza
+BLOCKED_RESPONSE = "Mi dispiace, non posso elaborare questa richiesta. Per favore, riformula la tua domanda."
+# Risposta salvata nell'archivio per una domanda rimasta senza risposta nel thread dell'assistente
+UNANSWERED_RESPONSE = "(nessuna risposta: la richiesta non è stata completata)"
+
+# Warm-up all'avvio: index Qdrant e connessioni HTTP vengono inizializzati in background
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+_warmup_state = {
+    "openai_ready": False,
+    "index_ready": False,
+    "finished": False
+}
+
+async def _warm_up():
+    """Inizializza connessioni e index prima che arrivi il primo utente."""
+    # Apre il pool di connessioni verso OpenAI e verifica che l'assistente (o il modello) esista
+    delay = 1.0
+    while client and (ASSISTANT_ID or completions_chat) and not _warmup_state["openai_ready"]:
+        try:
+            if completions_chat:
+                await client.models.retrieve(completions_chat.model)
+            else:
+                await client.beta.assistants.retrieve(ASSISTANT_ID)
+            _warmup_state["openai_ready"] = True
+            logger.info("Warm-up OpenAI completato")
+        except Exception as e:
+            logger.error(f"Warm-up OpenAI fallito: {e}. Nuovo tentativo tra {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    # L'encoding di tiktoken può richiedere un download: lo si carica prima della prima domanda
+    await asyncio.to_thread(context_builder.token_counter.load)
+
+    # Inizializza l'index con retry: il circuit breaker di get_index scandisce i tentativi
+    if is_retrieval_configured():
+        while not await awarm_up():
+            await asyncio.sleep(max(seconds_until_next_init_attempt(), 0.1))
+        _warmup_state["index_ready"] = True
+
+    _warmup_state["finished"] = True
+
+def _is_ready() -> bool:
+    """Pronto quando OpenAI risponde e l'index è caldo (o il retrieval non è configurato)."""
+    index_ok = _warmup_state["index_ready"] or not is_retrieval_configured()
+    return _warmup_state["openai_ready"] and index_ok
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Gestisce le risorse condivise per tutta la vita dell'applicazione."""
+    # Il warm-up gira in background: l'avvio non viene bloccato e /ready segnala quando è finito
+    metrics.setup_tracing()
+    warmup_task = asyncio.create_task(_warm_up()) if WARMUP_ENABLED else None
+    yield
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    metrics.shutdown_tracing()
+    conversation_memory.store.close()
+    # Chiudiamo il pool di connessioni HTTP allo shutdown
+    if client:
+        await client.close()
+
 # Inizializziamo l'app FastAPI
 app = FastAPI(
     title="Chatbot DataClinic",
     description="API per il chatbot basato su OpenAI Assistant",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configurazione CORS (modifica secondo le tue esigenze)
@@ -88,8 +206,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Inizializziamo il client di OpenAI (sarà None se la chiave non è impostata)
-client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# Durata di ogni richiesta HTTP per metodo, route e status (vedi /metrics)
+app.add_middleware(metrics.RequestDurationMiddleware)
 
 # Definiamo il modello di richiesta per la chat
 class ChatRequest(BaseModel):
@@ -100,27 +218,32 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     response: str
     thread_id: str
+    cached: bool = Field(False, description="True se la risposta arriva dalla cache semantica")
 
 # Modello per la risposta di start
 class StartResponse(BaseModel):
     thread_id: str
     message: str = "Conversazione avviata con successo"
 
+def _check_configuration():
+    """Errore 500 se mancano variabili obbligatorie (ASSISTANT_ID solo con l'Assistants API)."""
+    missing = []
+    if not OPENAI_API_KEY:
+        missing.append("OPENAI_API_KEY")
+    if not ASSISTANT_ID and ASSISTANT_ID_REQUIRED:
+        missing.append("ASSISTANT_ID")
+    if missing:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Missing required environment variables: {', '.join(missing)}. Please configure them in Railway dashboard."
+        )
+
 # Endpoint per inizializzare una nuova conversazione
 @app.get('/start', response_model=StartResponse)
 async def start_conversation():
     """Avvia una nuova conversazione creando un nuovo thread."""
     # Verifica che le variabili siano configurate
-    if not OPENAI_API_KEY or not ASSISTANT_ID:
-        missing = []
-        if not OPENAI_API_KEY:
-            missing.append("OPENAI_API_KEY")
-        if not ASSISTANT_ID:
-            missing.append("ASSISTANT_ID")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Missing required environment variables: {', '.join(missing)}. Please configure them in Railway dashboard."
-        )
+    _check_configuration()
     
     if not client:
         raise HTTPException(
@@ -130,31 +253,32 @@ async def start_conversation():
     
     try:
         logger.info("Starting a new conversation...")
-        thread = client.beta.threads.create()
-        logger.info(f"New thread created with ID: {thread.id}")
+        if completions_chat:
+            # Cronologia locale: nessuna chiamata a OpenAI
+            thread_id = completions_chat.start()
+        else:
+            thread_id = (await client.beta.threads.create()).id
+            await asyncio.to_thread(conversation_memory.create, thread_id)
+        logger.info(f"New thread created with ID: {thread_id}")
         return StartResponse(
-            thread_id=thread.id,
+            thread_id=thread_id,
             message="Conversazione avviata con successo"
         )
     except Exception as e:
         logger.error(f"Error creating thread: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error creating thread: {str(e)}")
 
-# Endpoint per gestire il messaggio di chat
-@app.post('/chat', response_model=ChatResponse)
-async def chat(chat_request: ChatRequest, request: FastAPIRequest = None):
-    """Gestisce un messaggio dell'utente e restituisce la risposta dell'assistente."""
+async def _validate_chat_request(chat_request: ChatRequest, request: FastAPIRequest = None) -> Tuple[str, str]:
+    """
+    Esegue i controlli comuni a /chat e /chat/stream.
+
+    Valida la configurazione e l'input, applica rate limiting e sanitizzazione.
+
+    Returns:
+        Tuple (thread_id, sanitized_input)
+    """
     # Verifica che le variabili siano configurate
-    if not OPENAI_API_KEY or not ASSISTANT_ID:
-        missing = []
-        if not OPENAI_API_KEY:
-            missing.append("OPENAI_API_KEY")
-        if not ASSISTANT_ID:
-            missing.append("ASSISTANT_ID")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Missing required environment variables: {', '.join(missing)}. Please configure them in Railway dashboard."
-        )
+    _check_configuration()
     
     thread_id = chat_request.thread_id
     user_input = chat_request.message
@@ -163,6 +287,10 @@ async def chat(chat_request: ChatRequest, request: FastAPIRequest = None):
     if not thread_id:
         logger.error("Error: Missing thread_id")
         raise HTTPException(status_code=400, detail="Missing thread_id")
+
+    if not is_valid_thread_id(thread_id):
+        log_security_event("INVALID_THREAD_ID", repr(thread_id[:100]))
+        raise HTTPException(status_code=400, detail="Invalid thread_id")
     
     if not user_input or not user_input.strip():
         logger.error("Error: Empty message")
@@ -172,7 +300,8 @@ async def chat(chat_request: ChatRequest, request: FastAPIRequest = None):
     if request:
         client_ip = request.client.host if request.client else None
         if client_ip:
-            allowed, rate_error = check_rate_limit(f"ip_{client_ip}")
+            with metrics.stage("rate_limit"):
+                allowed, rate_error = await run_state_call(check_rate_limit, f"ip_{client_ip}")
             if not allowed:
                 log_security_event("RATE_LIMIT_EXCEEDED", f"IP: {client_ip}", thread_id)
                 raise HTTPException(
@@ -181,7 +310,9 @@ async def chat(chat_request: ChatRequest, request: FastAPIRequest = None):
                 )
     
     # 🔒 SICUREZZA: Validazione e sanitizzazione input
-    sanitized_input, security_error = validate_and_sanitize_input(user_input, thread_id)
+    with metrics.stage("validate"):
+        # Include il rate limiting per thread, anch'esso sul backend di stato
+        sanitized_input, security_error = await run_state_call(validate_and_sanitize_input, user_input, thread_id)
     
     if security_error:
         log_security_event("INPUT_REJECTED", security_error, thread_id)
@@ -198,101 +329,295 @@ async def chat(chat_request: ChatRequest, request: FastAPIRequest = None):
             detail="OpenAI client not initialized. Missing OPENAI_API_KEY."
         )
 
+    return thread_id, sanitized_input
+
+def _remaining(deadline: float) -> float:
+    """Secondi rimasti del budget di retrieval (0 se scaduto)."""
+    return max(0.0, deadline - time.monotonic())
+
+async def _build_context(sanitized_input: str, deadline: float) -> str:
+    """
+    Recupera da Qdrant il contesto per la domanda (già selezionato e entro il budget di token).
+
+    Args:
+        deadline: Scadenza (time.monotonic) del budget di retrieval, condiviso con la cache risposte
+
+    Returns:
+        Testo del contesto ("" se non c'è contesto rilevante)
+    """
     try:
         # Recupera contesto rilevante da Qdrant (usa input sanitizzato)
         logger.info("Recuperando contesto rilevante da Qdrant...")
-        relevant_contexts = retrieve_relevant_context(sanitized_input, top_k=3)
-        
-        # 🔒 SICUREZZA: Crea prompt sicuro per prevenire injection
-        if relevant_contexts:
-            context_text = format_context_for_prompt(relevant_contexts)
-            enhanced_message = create_safe_prompt(context_text, sanitized_input)
-            logger.info(f"Contesto recuperato: {len(relevant_contexts)} chunk rilevanti")
+        # Retrieval asincrono con budget di latenza: se Qdrant è lento si procede senza contesto
+        retrieval = await aretrieve_relevant_context(sanitized_input, top_k=CONTEXT_CANDIDATES,
+                                                     timeout=_remaining(deadline))
+        # Solo i chunk sopra soglia, senza overlap ripetuti, entro il budget di token
+        with metrics.stage("context_build"):
+            context = context_builder.build(retrieval.contexts, hybrid=retrieval.hybrid)
+        metrics.record_context_tokens(context.tokens)
+        if context.text:
+            logger.info(f"Contesto recuperato: {context.summary()}")
         else:
-            # Anche senza contesto, usa formato sicuro
-            enhanced_message = create_safe_prompt("", sanitized_input)
-            logger.info("Nessun contesto rilevante trovato in Qdrant")
-        
-        # Inseriamo il messaggio dell'utente (con contesto) nella conversazione
-        client.beta.threads.messages.create(
+            logger.info(f"Nessun contesto rilevante trovato in Qdrant ({context.summary()})")
+    except Exception as e:
+        logger.error(f"Error processing chat request: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing request: {str(e)}"
+        )
+
+    return context.text
+
+async def _lookup_cached_answer(sanitized_input: str, conversation: Conversation,
+                                deadline: float) -> Tuple[Optional[List[float]], Optional[str]]:
+    """
+    Cerca nella cache semantica una risposta a una domanda equivalente.
+
+    La cache è condivisa tra tutte le conversazioni, quindi si usa solo al primo turno di un
+    thread: con una cronologia o un riassunto la risposta dipende anche da quelli (una domanda
+    come "e quanto costa?" o i dati personali dati in precedenza) e non va né cercata né salvata.
+
+    Args:
+        conversation: Stato della conversazione (vedi ConversationMemory.is_first_turn)
+        deadline: Scadenza (time.monotonic) del budget di retrieval: l'embedding della domanda
+            ne fa parte, così un endpoint degli embedding lento non blocca /chat
+
+    Returns:
+        Tuple (embedding della domanda, risposta in cache o None). L'embedding è None se la
+        cache non si applica al turno: in quel caso la risposta non viene memorizzata.
+    """
+    if not ANSWER_CACHE_ENABLED or not conversation_memory.is_first_turn(conversation):
+        return None, None
+    try:
+        # L'embedding arriva dalla cache degli embedding e viene riusato dal retrieval
+        query_embedding = await asyncio.wait_for(aget_query_embedding(sanitized_input),
+                                                 timeout=_remaining(deadline))
+    except asyncio.TimeoutError:
+        metrics.record_retrieval_timeout()
+        logger.warning(f"Embedding della domanda oltre il budget di {RETRIEVAL_TIMEOUT}s: cache risposte saltata")
+        return None, None
+    except Exception as e:
+        logger.warning(f"Impossibile calcolare l'embedding per la cache risposte: {e}")
+        return None, None
+    with metrics.stage("answer_cache"):
+        hit = await run_state_call(answer_cache.lookup, query_embedding)
+    metrics.record_cache("answer", hit is not None)
+    return query_embedding, hit[0] if hit else None
+
+async def _append_cached_exchange(thread_id: str, sanitized_input: str, answer: str):
+    """Aggiunge al thread domanda e risposta servite dalla cache, per mantenere la continuità."""
+    try:
+        await asyncio.to_thread(conversation_memory.record_exchange, thread_id, sanitized_input, answer)
+        if completions_chat:
+            return
+        await client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
-            content=enhanced_message
+            content=sanitized_input
         )
-
-        # Creiamo la run per l'assistente
-        run = client.beta.threads.runs.create(
+        await client.beta.threads.messages.create(
             thread_id=thread_id,
-            assistant_id=ASSISTANT_ID
+            role="assistant",
+            content=answer
         )
+    except Exception as e:
+        logger.warning(f"Impossibile aggiungere la risposta in cache al thread {thread_id}: {e}")
+
+async def _finalize_response(thread_id: str, sanitized_input: str, query_embedding: Optional[List[float]],
+                       response: str) -> str:
+    """
+    Controllo di sicurezza sulla risposta; se è valida la si salva nella cache semantica
+    (solo al primo turno del thread, quando _lookup_cached_answer ha calcolato l'embedding).
+    """
+    # 🔒 SICUREZZA: Verifica che la risposta non contenga tentativi di injection
+    # (doppio controllo per sicurezza)
+    if response:
+        is_injection, reason = detect_injection(response)
+        if is_injection:
+            log_security_event("RESPONSE_INJECTION_DETECTED", reason, thread_id)
+            # Non restituiamo la risposta sospetta
+            return BLOCKED_RESPONSE
+        if ANSWER_CACHE_ENABLED and query_embedding is not None:
+            await run_state_call(answer_cache.store, sanitized_input, query_embedding, response)
+    return response
+
+def _message_text(message) -> str:
+    """
+    Testo di un messaggio dell'assistente: concatena tutti i blocchi di testo (ignorando immagini
+    e altri tipi di contenuto) e rimuove i marcatori delle citazioni dei file (es. 【4:0†source】),
+    che l'utente non può aprire.
+    """
+    parts = []
+    for block in message.content:
+        if block.type != "text":
+            continue
+        text = block.text.value
+        for annotation in block.text.annotations or []:
+            if annotation.type == "file_citation" and annotation.text:
+                text = text.replace(annotation.text, "")
+        parts.append(text.strip())
+    return "\n\n".join(part for part in parts if part)
+
+def _assistant_run_options(conversation: Conversation, context_text: str) -> dict:
+    """
+    Parametri della run per l'Assistants API: nel thread restano solo le domande e le risposte,
+    il modello vede la finestra dei messaggi non riassunti più la domanda corrente, mentre
+    riassunto e contesto arrivano come istruzioni aggiuntive valide solo per questa run.
+    """
+    options = {}
+    if conversation.stored and not conversation_memory.partial_history:
+        # I thread che l'archivio non conosce (o di cui può avere solo una parte dei turni, con un
+        # archivio locale e più repliche) mantengono tutta la cronologia su OpenAI
+        options["truncation_strategy"] = {"type": "last_messages", "last_messages": len(conversation.messages) + 1}
+    instructions = create_context_instructions(context_text, conversation.summary)
+    if instructions:
+        options["additional_instructions"] = instructions
+    return options
+
+def _run_error(status: str, run, thread_id: str) -> Optional[HTTPException]:
+    """
+    Errore da restituire per una run che non si è conclusa con una risposta (None se completata):
+    ogni stato finale ha la sua risposta, senza cercare nel thread un messaggio che non c'è.
+    """
+    if status == "completed":
+        return None
+    if status == "failed":
+        error_msg = run.last_error.message if run and run.last_error else "Unknown error"
+        logger.error(f"Run failed: {error_msg}")
+        return HTTPException(status_code=500, detail=f"Assistant run failed: {error_msg}")
+    if status == "requires_action":
+        logger.warning("Run requires action - this may need special handling")
+        return HTTPException(status_code=500, detail="Assistant requires action - not implemented")
+    if status in (STATUS_TIMEOUT, "expired"):
+        logger.error(f"Run {status} - exceeded deadline")
+        return HTTPException(status_code=504, detail="Request timeout - assistant took too long to respond")
+    if status == STATUS_DISCONNECTED:
+        logger.warning(f"Client disconnected while waiting for run on thread {thread_id}")
+        return HTTPException(status_code=499, detail="Client disconnected")
+    if status == "incomplete":
+        details = getattr(run, 'incomplete_details', None)
+        reason = getattr(details, 'reason', None) or "unknown reason"
+        logger.error(f"Run incomplete: {reason}")
+        return HTTPException(status_code=502, detail=f"Assistant run incomplete: {reason}")
+    # cancelled/cancelling (annullata da fuori) o uno stato non previsto
+    logger.error(f"Run ended with status {status} on thread {thread_id}")
+    return HTTPException(status_code=500, detail=f"Assistant run {status}")
+
+async def _record_unanswered(thread_id: str, sanitized_input: str, context_text: str):
+    """
+    Salva nell'archivio una domanda già aggiunta al thread di OpenAI ma rimasta senza risposta
+    (run fallita, scaduta, annullata o interrotta): la finestra dell'archivio conta così gli
+    stessi messaggi del thread e truncation_strategy non scarta cronologia reale.
+    """
+    try:
+        await asyncio.to_thread(conversation_memory.record_exchange, thread_id, sanitized_input,
+                                UNANSWERED_RESPONSE, context_text)
+    except Exception as e:
+        logger.warning(f"Impossibile salvare il turno senza risposta del thread {thread_id}: {e}")
 
-        logger.info(f"Run created with ID: {run.id}")
+async def _load_conversation(thread_id: str) -> Conversation:
+    """Riassunto e finestra dei messaggi del thread dall'archivio delle conversazioni."""
+    try:
+        if completions_chat:
+            return await completions_chat.load(thread_id)
+        return await asyncio.to_thread(conversation_memory.load, thread_id)
+    except Exception as e:
+        logger.error(f"Error loading conversation {thread_id}: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing request: {str(e)}"
+        )
 
-        # Polling per controllare lo stato della run
-        max_attempts = 60  # Timeout di 60 secondi
-        attempt = 0
-        end = False
+async def _chat_with_completions(conversation: Conversation, sanitized_input: str, context_text: str,
+                                 query_embedding: Optional[List[float]]) -> ChatResponse:
+    """/chat con Chat Completions: una sola chiamata a OpenAI, cronologia locale."""
+    thread_id = conversation.thread_id
+    # 🔒 SICUREZZA: domanda e contesto arrivano al modello nel prompt sicuro
+    enhanced_message = create_safe_prompt(context_text, sanitized_input)
+    try:
+        with metrics.stage("completion"):
+            response = await completions_chat.complete(client, conversation, enhanced_message)
+    except Exception as e:
+        logger.error(f"Error processing chat request: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing request: {str(e)}"
+        )
+    response = await _finalize_response(thread_id, sanitized_input, query_embedding, response)
+    await asyncio.to_thread(conversation_memory.record_exchange, thread_id, sanitized_input, response, context_text)
+    logger.info(f"Assistant response generated successfully for thread {thread_id}")
+    return ChatResponse(response=response, thread_id=thread_id)
 
-        while not end and attempt < max_attempts:
-            # Controlliamo lo stato della run
-            run_status = client.beta.threads.runs.retrieve(
+# Endpoint per gestire il messaggio di chat
+@app.post('/chat', response_model=ChatResponse)
+async def chat(chat_request: ChatRequest, background_tasks: BackgroundTasks, request: FastAPIRequest = None):
+    """Gestisce un messaggio dell'utente e restituisce la risposta dell'assistente."""
+    thread_id, sanitized_input = await _validate_chat_request(chat_request, request)
+
+    conversation = await _load_conversation(thread_id)
+
+    # 💾 CACHE: al primo turno, domande equivalenti già risposte non creano una nuova run
+    # Un solo budget di latenza per embedding, cache risposte e ricerca Qdrant
+    retrieval_deadline = time.monotonic() + RETRIEVAL_TIMEOUT
+    query_embedding, cached_answer = await _lookup_cached_answer(sanitized_input, conversation, retrieval_deadline)
+    if cached_answer is not None:
+        background_tasks.add_task(_append_cached_exchange, thread_id, sanitized_input, cached_answer)
+        logger.info(f"Cached response served for thread {thread_id}")
+        return ChatResponse(response=cached_answer, thread_id=thread_id, cached=True)
+
+    context_text = await _build_context(sanitized_input, retrieval_deadline)
+    # I messaggi oltre la finestra vengono riassunti dopo la risposta, quando sono un batch intero
+    if conversation_memory.needs_summary(conversation):
+        background_tasks.add_task(conversation_memory.summarize, client, thread_id)
+    if completions_chat:
+        return await _chat_with_completions(conversation, sanitized_input, context_text, query_embedding)
+
+    question_added = False
+    try:
+        # Inseriamo nella conversazione solo la domanda: il contesto va nelle istruzioni della run
+        with metrics.stage("message_create"):
+            await client.beta.threads.messages.create(
                 thread_id=thread_id,
-                run_id=run.id
-            )
-            
-            logger.info(f"Run status: {run_status.status} (attempt {attempt + 1})")
-
-            if run_status.status == 'completed':
-                end = True
-            elif run_status.status in ["cancelling", "requires_action", "cancelled", "expired", "failed"]:
-                end = True
-                if run_status.status == "failed":
-                    error_msg = run_status.last_error.message if run_status.last_error else "Unknown error"
-                    logger.error(f"Run failed: {error_msg}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Assistant run failed: {error_msg}"
-                    )
-                elif run_status.status == "requires_action":
-                    logger.warning("Run requires action - this may need special handling")
-                    raise HTTPException(
-                        status_code=500,
-                        detail="Assistant requires action - not implemented"
-                    )
-
-            if not end:
-                await asyncio.sleep(1)
-                attempt += 1
-
-        if attempt >= max_attempts:
-            logger.error("Run timeout - exceeded max attempts")
-            raise HTTPException(
-                status_code=504,
-                detail="Request timeout - assistant took too long to respond"
+                role="user",
+                content=sanitized_input
             )
+        question_added = True
+
+        # Creiamo la run per l'assistente e attendiamo che termini
+        # (polling adattivo o streaming, secondo RUN_WAITER)
+        is_disconnected = request.is_disconnected if request else None
+        result = await run_waiter.run(client, thread_id, ASSISTANT_ID, is_disconnected=is_disconnected,
+                                      run_options=_assistant_run_options(conversation, context_text))
+        run_status = result.run
+        await asyncio.to_thread(conversation_memory.record_usage, thread_id, getattr(run_status, 'usage', None))
+
+        error = _run_error(result.status, run_status, thread_id)
+        if error:
+            raise error
 
         # Recuperiamo i messaggi della conversazione
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
+        # Solo l'ultimo messaggio prodotto da questa run, non una pagina della cronologia
+        with metrics.stage("messages_list"):
+            messages = await client.beta.threads.messages.list(
+                thread_id=thread_id,
+                run_id=run_status.id,
+                order="desc",
+                limit=1
+            )
 
         # Verifichiamo che ci siano messaggi
         if not messages.data:
-            logger.error("No messages found in thread")
+            logger.error(f"No messages found for run {run_status.id}")
             raise HTTPException(
                 status_code=500,
                 detail="No messages found in thread"
             )
 
         # Recuperiamo il testo della risposta
-        response = messages.data[0].content[0].text.value
-        
-        # 🔒 SICUREZZA: Verifica che la risposta non contenga tentativi di injection
-        # (doppio controllo per sicurezza)
-        if response:
-            is_injection, reason = detect_injection(response)
-            if is_injection:
-                log_security_event("RESPONSE_INJECTION_DETECTED", reason, thread_id)
-                # Non restituiamo la risposta sospetta
-                response = "Mi dispiace, non posso elaborare questa richiesta. Per favore, riformula la tua domanda."
+        response = _message_text(messages.data[0])
+        response = await _finalize_response(thread_id, sanitized_input, query_embedding, response)
+        await asyncio.to_thread(conversation_memory.record_exchange, thread_id, sanitized_input, response,
+                                context_text)
 
         logger.info(f"Assistant response generated successfully for thread {thread_id}")
 
@@ -302,25 +627,250 @@ async def chat(chat_request: ChatRequest, request: FastAPIRequest = None):
         )
 
     except HTTPException:
+        if question_added:
+            await _record_unanswered(thread_id, sanitized_input, context_text)
         raise
     except Exception as e:
+        if question_added:
+            await _record_unanswered(thread_id, sanitized_input, context_text)
         logger.error(f"Error processing chat request: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"Error processing request: {str(e)}"
         )
 
+def _sse_event(event: str, data: dict) -> str:
+    """Serializza un evento nel formato Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _stream_cached_answer(thread_id: str, answer: str):
+    """Emette una risposta in cache come un unico evento token."""
+    yield _sse_event("token", {"text": answer})
+    yield _sse_event("done", {"thread_id": thread_id, "cached": True})
+
+async def _cancel_unfinished_run(thread_id: str, run):
+    """
+    Cancella una run rimasta attiva dopo l'interruzione dello stream. La cancellazione gira in un
+    task separato: se lo stream è stato interrotto perché il client si è disconnesso, la richiesta
+    di cancellazione parte comunque anche se la risposta HTTP viene annullata.
+    """
+    if run is None or run.status in TERMINAL_STATUSES:
+        return
+    task = asyncio.create_task(cancel_run(client, thread_id, run.id, "stream interrotto"))
+    _pending_run_cancels.add(task)
+    task.add_done_callback(_pending_run_cancels.discard)
+    await asyncio.shield(task)
+
+async def _run_text_deltas(thread_id: str, run_options: dict):
+    """
+    Frammenti di testo di una run dell'assistente in streaming. Se la run termina senza essere
+    completata (fallita, scaduta, annullata, incompleta) lo stream finisce con un errore.
+    Se lo stream viene chiuso prima della fine (client disconnesso, risposta bloccata dal
+    controllo di sicurezza, errore di rete) la run ancora attiva viene cancellata.
+    """
+    stream = None
+    finished = False
+    try:
+        async with client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=ASSISTANT_ID,
+            **run_options
+        ) as stream:
+            async for delta in stream.text_deltas:
+                yield delta
+            finished = True
+            run = stream.current_run
+            # A stream concluso la run riporta i token consumati
+            await asyncio.to_thread(conversation_memory.record_usage, thread_id, getattr(run, 'usage', None))
+    finally:
+        if not finished and stream is not None:
+            await _cancel_unfinished_run(thread_id, stream.current_run)
+    error = _run_error(run.status if run else "unknown", run, thread_id)
+    if error:
+        raise RuntimeError(error.detail)
+
+async def _stream_run_events(thread_id: str, sanitized_input: str, query_embedding: Optional[List[float]],
+                             deltas, context_text: str = "", question_in_thread: bool = False):
+    """
+    Genera gli eventi SSE di una risposta in streaming.
+
+    Args:
+        deltas: Frammenti di testo della risposta (run dell'assistente o Chat Completions)
+        context_text: Contesto iniettato, salvato nell'archivio delle conversazioni con la domanda
+        question_in_thread: True se la domanda è già nel thread dell'assistente: se la risposta non
+            arriva (errore o client disconnesso) la si salva comunque, senza risposta
+
+    Eventi emessi:
+        token: {"text": "..."} per ogni frammento di testo dell'assistente
+        done:  {"thread_id": "...", "cached": false} a fine risposta
+        error: {"detail": "..."} in caso di errore o risposta bloccata
+    """
+    guard = StreamingInjectionGuard()
+    start = time.perf_counter()
+    first_token = True
+    recorded = False
+
+    try:
+        # aclosing: se lo stream viene interrotto la richiesta a OpenAI viene chiusa subito
+        # e la run dell'assistente ancora attiva viene cancellata (vedi _run_text_deltas)
+        async with aclosing(deltas):
+            async for delta in deltas:
+                if first_token:
+                    metrics.observe_stage("stream_first_token", time.perf_counter() - start)
+                    first_token = False
+                # 🔒 SICUREZZA: controllo incrementale sul testo prodotto finora
+                is_injection, reason = guard.feed(delta)
+                if is_injection:
+                    log_security_event("RESPONSE_INJECTION_DETECTED", reason, thread_id)
+                    recorded = True
+                    await asyncio.to_thread(conversation_memory.record_exchange, thread_id, sanitized_input,
+                                            BLOCKED_RESPONSE, context_text)
+                    yield _sse_event("error", {"detail": BLOCKED_RESPONSE})
+                    return
+                yield _sse_event("token", {"text": delta})
+
+        # Controllo finale sull'intera risposta (doppio controllo per sicurezza)
+        is_injection, reason = guard.finish()
+        if is_injection:
+            log_security_event("RESPONSE_INJECTION_DETECTED", reason, thread_id)
+            recorded = True
+            await asyncio.to_thread(conversation_memory.record_exchange, thread_id, sanitized_input, BLOCKED_RESPONSE,
+                                    context_text)
+            yield _sse_event("error", {"detail": BLOCKED_RESPONSE})
+            return
+
+        if ANSWER_CACHE_ENABLED and query_embedding is not None:
+            await run_state_call(answer_cache.store, sanitized_input, query_embedding, guard.text)
+        recorded = True
+        await asyncio.to_thread(conversation_memory.record_exchange, thread_id, sanitized_input, guard.text,
+                                context_text)
+
+        logger.info(f"Assistant response streamed successfully for thread {thread_id}")
+        metrics.observe_stage("stream", time.perf_counter() - start)
+        yield _sse_event("done", {"thread_id": thread_id, "cached": False})
+
+    except Exception as e:
+        metrics.record_error("stream", e)
+        logger.error(f"Error streaming chat response: {str(e)}")
+        yield _sse_event("error", {"detail": f"Error processing request: {str(e)}"})
+    finally:
+        if question_in_thread and not recorded:
+            await _record_unanswered(thread_id, sanitized_input, context_text)
+
+# Endpoint per gestire il messaggio di chat in streaming (Server-Sent Events)
+@app.post('/chat/stream')
+async def chat_stream(chat_request: ChatRequest, background_tasks: BackgroundTasks, request: FastAPIRequest = None):
+    """Come /chat, ma restituisce la risposta dell'assistente token per token via SSE."""
+    thread_id, sanitized_input = await _validate_chat_request(chat_request, request)
+    sse_headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # Disattiva il buffering dei proxy
+    }
+
+    conversation = await _load_conversation(thread_id)
+
+    # 💾 CACHE: al primo turno, domande equivalenti già risposte non creano una nuova run
+    # Un solo budget di latenza per embedding, cache risposte e ricerca Qdrant
+    retrieval_deadline = time.monotonic() + RETRIEVAL_TIMEOUT
+    query_embedding, cached_answer = await _lookup_cached_answer(sanitized_input, conversation, retrieval_deadline)
+    if cached_answer is not None:
+        background_tasks.add_task(_append_cached_exchange, thread_id, sanitized_input, cached_answer)
+        return StreamingResponse(
+            _stream_cached_answer(thread_id, cached_answer),
+            media_type="text/event-stream",
+            headers=sse_headers
+        )
+
+    context_text = await _build_context(sanitized_input, retrieval_deadline)
+    # Il riassunto gira dopo la fine dello stream (i BackgroundTasks passano alla StreamingResponse)
+    if conversation_memory.needs_summary(conversation):
+        background_tasks.add_task(conversation_memory.summarize, client, thread_id)
+    if completions_chat:
+        # Nessun thread su OpenAI: la domanda con il contesto va direttamente a Chat Completions
+        # 🔒 SICUREZZA: nel prompt sicuro
+        enhanced_message = create_safe_prompt(context_text, sanitized_input)
+        return StreamingResponse(
+            _stream_run_events(thread_id, sanitized_input, query_embedding,
+                               completions_chat.stream(client, conversation, enhanced_message), context_text),
+            media_type="text/event-stream",
+            headers=sse_headers
+        )
+
+    try:
+        # Inseriamo nella conversazione solo la domanda: il contesto va nelle istruzioni della run
+        with metrics.stage("message_create"):
+            await client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=sanitized_input
+            )
+    except Exception as e:
+        logger.error(f"Error processing chat request: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing request: {str(e)}"
+        )
+
+    return StreamingResponse(
+        _stream_run_events(thread_id, sanitized_input, query_embedding,
+                           _run_text_deltas(thread_id, _assistant_run_options(conversation, context_text)),
+                           context_text, question_in_thread=True),
+        media_type="text/event-stream",
+        headers=sse_headers
+    )
+
 # Endpoint di health check
 @app.get('/health')
 async def health_check():
     """Endpoint per verificare lo stato dell'API."""
     return {
-        "status": "healthy" if (OPENAI_API_KEY and ASSISTANT_ID) else "degraded",
+        "status": "healthy" if (OPENAI_API_KEY and (ASSISTANT_ID or not ASSISTANT_ID_REQUIRED)) else "degraded",
         "openai_version": openai.__version__,
         "assistant_id_set": bool(ASSISTANT_ID),
-        "openai_api_key_set": bool(OPENAI_API_KEY)
+        "openai_api_key_set": bool(OPENAI_API_KEY),
+        "chat_backend": "completions" if completions_chat else "assistants",
+        "run_waiter": run_waiter.stats.as_dict(),
+        "embedding_cache": get_embedding_cache_stats(),
+        "answer_cache": answer_cache.stats() if ANSWER_CACHE_ENABLED else None,
+        "conversation_store": conversation_memory.store.stats(),
+        "rate_limiter": get_rate_limit_stats(),
+        "state_backend": get_state_backend().stats(),
+        "index": get_index_status()
     }
 
+# Endpoint con i token consumati da una conversazione
+@app.get('/threads/{thread_id}/usage')
+async def thread_usage(thread_id: str):
+    """Token consumati dal thread (risposte e riassunti) e stato della finestra dei messaggi."""
+    if not is_valid_thread_id(thread_id):
+        log_security_event("INVALID_THREAD_ID", repr(thread_id[:100]))
+        raise HTTPException(status_code=400, detail="Invalid thread_id")
+    usage = await asyncio.to_thread(conversation_memory.usage, thread_id)
+    if usage is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return {"thread_id": thread_id, **usage}
+
+# Endpoint di readiness: risponde 200 solo quando il warm-up è completato
+@app.get('/ready')
+async def readiness_check():
+    """Endpoint di readiness per il bilanciatore/healthcheck: 503 finché il servizio non è caldo."""
+    ready = _is_ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "openai_ready": _warmup_state["openai_ready"],
+            "index": get_index_status(),
+            "warmup_finished": _warmup_state["finished"]
+        }
+    )
+
+# Endpoint delle metriche in formato Prometheus
+@app.get('/metrics')
+async def metrics_endpoint():
+    """Latenze per fase, poll per run, hit delle cache, token del contesto ed errori (per processo)."""
+    return Response(metrics.render(), media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
 # Endpoint di debug per diagnosticare problemi con le variabili d'ambiente
 @app.get('/debug/env')
 async def debug_env():
@@ -354,7 +904,11 @@ async def root():
         "endpoints": {
             "start": "/start",
             "chat": "/chat",
-            "health": "/health"
+            "chat_stream": "/chat/stream",
+            "thread_usage": "/threads/{thread_id}/usage",
+            "health": "/health",
+            "ready": "/ready",
+            "metrics": "/metrics"
         }
     }
 
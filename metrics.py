@@ -0,0 +1,290 @@
+"""
+Metriche per fase della pipeline di chat, esposte in formato Prometheus su /metrics.
+
+Ogni fase di /chat e /chat/stream (validazione, cache, embedding, ricerca Qdrant, costruzione
+del contesto, messages.create, run, singoli poll, messages.list, streaming) viene misurata con
+`stage(...)` e finisce nell'istogramma chatbot_stage_duration_seconds{stage=...}; le eccezioni
+vengono contate per fase e classe di errore. A queste si aggiungono poll per run, stati delle
+run, hit/miss delle cache, token del contesto e token in input per risposta.
+
+L'implementazione non ha dipendenze: contatori e istogrammi sono in memoria e il testo per
+Prometheus viene generato solo quando /metrics viene letto. Una misura costa un paio di
+microsecondi (perf_counter, un lock e una ricerca binaria sui bucket).
+
+Le metriche sono per processo: con più worker uvicorn ogni scrape vede il worker che risponde
+(su Railway conviene una replica per worker, oppure sommare le serie per istanza).
+
+OpenTelemetry (opzionale): con OTEL_ENABLED=true ogni fase diventa anche uno span, esportato
+via OTLP se sono installati opentelemetry-sdk e opentelemetry-exporter-otlp (endpoint e
+header dalle variabili standard OTEL_EXPORTER_OTLP_*). Senza questi pacchetti si usano solo
+le metriche.
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+OTEL_ENABLED = os.getenv('OTEL_ENABLED', 'false').lower() == 'true'
+OTEL_SERVICE_NAME = os.getenv('OTEL_SERVICE_NAME', 'chatbot-dataclinic')
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket in secondi: dai millisecondi della cache ai decine di secondi di una run
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Contatore monotono con etichette."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}_total{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+class Histogram:
+    """Istogramma cumulativo con bucket fissi ed etichette."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per ogni combinazione di etichette: [conteggi per bucket (+Inf in fondo), somma]
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+class Registry:
+    """Insieme delle metriche esposte su /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Testo nel formato di esposizione di Prometheus (0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+STAGE_DURATION = registry.register(Histogram(
+    "chatbot_stage_duration_seconds", "Durata delle fasi della pipeline di chat", ["stage"]
+))
+STAGE_ERRORS = registry.register(Counter(
+    "chatbot_stage_errors", "Errori per fase e classe di eccezione", ["stage", "error"]
+))
+REQUEST_DURATION = registry.register(Histogram(
+    "chatbot_http_request_duration_seconds", "Durata delle richieste HTTP", ["method", "route", "status"]
+))
+RUN_POLLS = registry.register(Histogram(
+    "chatbot_run_polls", "Poll di runs.retrieve per run", buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+))
+RUN_STATUS = registry.register(Counter(
+    "chatbot_runs", "Run dell'assistente per stato finale", ["status"]
+))
+CACHE_REQUESTS = registry.register(Counter(
+    "chatbot_cache_requests", "Consultazioni delle cache", ["cache", "result"]
+))
+CONTEXT_TOKENS = registry.register(Histogram(
+    "chatbot_context_tokens", "Token del contesto inserito nel prompt",
+    buckets=(0, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 4000, 8000)
+))
+PROMPT_TOKENS = registry.register(Histogram(
+    "chatbot_prompt_tokens", "Token in input per risposta del modello (cronologia, riassunto e contesto)",
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 16000, 32000)
+))
+RETRIEVAL_TIMEOUTS = registry.register(Counter(
+    "chatbot_retrieval_timeouts", "Retrieval oltre il budget di latenza (chat senza contesto)"
+))
+
+_tracer = None
+
+def setup_tracing() -> bool:
+    """Configura l'export degli span OpenTelemetry (se OTEL_ENABLED e i pacchetti sono installati)."""
+    global _tracer
+    if not OTEL_ENABLED:
+        return False
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        logger.warning(f"OTEL_ENABLED ma OpenTelemetry non è installato ({e}): "
+                       f"pip install opentelemetry-sdk opentelemetry-exporter-otlp")
+        return False
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(__name__)
+    logger.info(f"Tracing OpenTelemetry attivo (servizio {OTEL_SERVICE_NAME})")
+    return True
+
+def shutdown_tracing():
+    """Esporta gli span rimasti in coda."""
+    if _tracer is None:
+        return
+    from opentelemetry import trace
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, 'shutdown'):
+        provider.shutdown()
+
+@contextmanager
+def stage(name: str, **attributes):
+    """
+    Misura una fase: durata nell'istogramma per fase, errori per classe di eccezione e,
+    se il tracing è attivo, uno span con gli attributi indicati.
+    """
+    start = time.perf_counter()
+    try:
+        if _tracer is None:
+            yield None
+        else:
+            with _tracer.start_as_current_span(f"chatbot.{name}", attributes=attributes) as span:
+                yield span
+    except BaseException as e:
+        STAGE_ERRORS.inc(name, type(e).__name__)
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - start, name)
+
+def observe_stage(name: str, seconds: float):
+    """Registra la durata di una fase già misurata altrove."""
+    STAGE_DURATION.observe(seconds, name)
+
+def record_error(stage_name: str, error: BaseException):
+    STAGE_ERRORS.inc(stage_name, type(error).__name__)
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+def record_run(status: str, polls: Optional[int] = None):
+    RUN_STATUS.inc(status)
+    if polls is not None:
+        RUN_POLLS.observe(polls)
+
+def record_context_tokens(tokens: int):
+    CONTEXT_TOKENS.observe(tokens)
+
+def record_prompt_tokens(tokens: int):
+    PROMPT_TOKENS.observe(tokens)
+
+def record_retrieval_timeout():
+    RETRIEVAL_TIMEOUTS.inc()
+
+class RequestDurationMiddleware:
+    """
+    Middleware ASGI: durata di ogni richiesta HTTP per metodo, route e status.
+
+    A differenza di @app.middleware("http") non avvolge la risposta in un task e in uno stream
+    aggiuntivi: inoltra i messaggi così come sono e ferma il timer all'ultimo messaggio del body,
+    quindi per /chat/stream misura l'intero stream e non solo l'invio degli header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+        finished = False
+
+        def observe():
+            # Il template della route ("/chat") e non il path, per non creare una serie per URL
+            route = scope.get("route")
+            REQUEST_DURATION.observe(time.perf_counter() - start, scope["method"],
+                                     route.path if route else "unmatched", str(status))
+
+        async def send_timed(message):
+            nonlocal status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = True
+                observe()
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            # Eccezione o client disconnesso prima della fine della risposta
+            if not finished:
+                observe()
+
+def render() -> str:
+    return registry.render()
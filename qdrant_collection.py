@@ -0,0 +1,283 @@
+"""
+Gestione della collection Qdrant usata dal chatbot.
+
+Invece di lasciare che QdrantVectorStore crei la collection con i default (vettori float32
+in RAM, nessun indice sui payload, HNSW non configurato) la collection viene creata qui in
+modo esplicito con:
+- quantizzazione scalare (int8) o binaria dei vettori, tenuta in RAM
+- vettori originali su disco (opzionale), usati solo per il rescoring
+- parametri HNSW m / ef_construct
+- indice sul payload 'source' (filtri per documento e cancellazione dei chunk di un file)
+- con HYBRID_SEARCH=true, il vettore sparso BM25 con IDF calcolato da Qdrant (vedi hybrid_search.py)
+
+Configurazione (variabili d'ambiente):
+    QDRANT_QUANTIZATION=scalar|binary|none   (default scalar)
+    QDRANT_ON_DISK_VECTORS=false
+    QDRANT_HNSW_M=16
+    QDRANT_HNSW_EF_CONSTRUCT=100
+    EMBEDDING_DIM                             (default: dedotta da EMBEDDING_MODEL)
+
+Parametri di ricerca (usati da retrieve_context.py, sovrascrivibili per chiamata):
+    QDRANT_SEARCH_HNSW_EF                     (default: quello di Qdrant)
+    QDRANT_SEARCH_RESCORE=true
+    QDRANT_SEARCH_OVERSAMPLING                (es. 2.0 con la quantizzazione binaria)
+
+Uso:
+    python qdrant_collection.py info
+    python qdrant_collection.py create [--quantization binary] [--on-disk] [--hnsw-m 32]
+    python qdrant_collection.py create --recreate     # cancella e ricrea (poi ricarica i PDF)
+    python qdrant_collection.py create --recreate --hybrid
+    python qdrant_collection.py update --quantization scalar --hnsw-ef-construct 200
+
+qdrant_client viene importato solo quando serve, così il modulo resta leggero per il server.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional, Tuple
+from dotenv import load_dotenv
+
+from hybrid_search import HYBRID_SEARCH, SPARSE_VECTOR_NAME
+
+logger = logging.getLogger(__name__)
+
+# Carica variabili d'ambiente
+load_dotenv('.env.local')
+load_dotenv()
+
+QDRANT_URL = os.getenv('QDRANT_URL')
+QDRANT_API_KEY = os.getenv('QDRANT_API_KEY')
+COLLECTION_NAME = os.getenv('QDRANT_COLLECTION_NAME', 'dataclinic_docs')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
+
+# Dimensione dei vettori dei modelli di embedding OpenAI
+EMBEDDING_DIMENSIONS = {
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+    'text-embedding-ada-002': 1536,
+}
+
+QUANTIZATION_TYPES = ('none', 'scalar', 'binary')
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+def embedding_dimension(embedding_model: str = EMBEDDING_MODEL) -> Optional[int]:
+    """Dimensione dei vettori: EMBEDDING_DIM se impostata, altrimenti quella nota del modello."""
+    if os.getenv('EMBEDDING_DIM'):
+        return int(os.getenv('EMBEDDING_DIM'))
+    return EMBEDDING_DIMENSIONS.get(embedding_model)
+
+@dataclass
+class CollectionSettings:
+    """Configurazione della collection (vettori, quantizzazione, HNSW, indici sui payload)."""
+    vector_size: int
+    quantization: str = 'scalar'
+    on_disk: bool = False
+    hnsw_m: int = 16
+    hnsw_ef_construct: int = 100
+    payload_indexes: Tuple[str, ...] = ('source',)
+    # Nome del vettore sparso per la ricerca ibrida (None = solo vettori densi)
+    sparse_vector: Optional[str] = None
+
+    def __post_init__(self):
+        if self.quantization not in QUANTIZATION_TYPES:
+            raise ValueError(f"Quantizzazione '{self.quantization}' non valida (usa: {', '.join(QUANTIZATION_TYPES)})")
+
+    @classmethod
+    def from_env(cls, vector_size: Optional[int] = None, **overrides) -> "CollectionSettings":
+        vector_size = vector_size or embedding_dimension()
+        if vector_size is None:
+            raise ValueError(f"Dimensione dei vettori sconosciuta per '{EMBEDDING_MODEL}': imposta EMBEDDING_DIM")
+        settings = {
+            'quantization': os.getenv('QDRANT_QUANTIZATION', 'scalar').lower(),
+            'on_disk': os.getenv('QDRANT_ON_DISK_VECTORS', 'false').lower() == 'true',
+            'hnsw_m': int(os.getenv('QDRANT_HNSW_M', '16')),
+            'hnsw_ef_construct': int(os.getenv('QDRANT_HNSW_EF_CONSTRUCT', '100')),
+            'sparse_vector': SPARSE_VECTOR_NAME if HYBRID_SEARCH else None,
+        }
+        settings.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(vector_size=vector_size, **settings)
+
+    def vectors_config(self):
+        from qdrant_client import models
+        # Vettore senza nome: è il formato che QdrantVectorStore usa per le collection non ibride
+        return models.VectorParams(size=self.vector_size, distance=models.Distance.COSINE, on_disk=self.on_disk)
+
+    def sparse_vectors_config(self):
+        if not self.sparse_vector:
+            return None
+        from qdrant_client import models
+        # Pesi BM25 senza IDF nei punti: l'IDF lo calcola Qdrant sulla collection
+        return {self.sparse_vector: models.SparseVectorParams(modifier=models.Modifier.IDF)}
+
+    def hnsw_config(self):
+        from qdrant_client import models
+        return models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct)
+
+    def quantization_config(self):
+        from qdrant_client import models
+        if self.quantization == 'scalar':
+            return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=True
+            ))
+        if self.quantization == 'binary':
+            return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+        return None
+
+async def create_collection(aclient, collection_name: str, settings: CollectionSettings,
+                            recreate: bool = False) -> bool:
+    """
+    Crea la collection con le impostazioni indicate e gli indici sui payload.
+
+    Returns:
+        True se la collection è stata creata, False se esisteva già (e recreate è False)
+    """
+    if await aclient.collection_exists(collection_name):
+        if not recreate:
+            return False
+        logger.warning(f"Cancellazione della collection {collection_name}")
+        await aclient.delete_collection(collection_name)
+
+    await aclient.create_collection(
+        collection_name,
+        vectors_config=settings.vectors_config(),
+        sparse_vectors_config=settings.sparse_vectors_config(),
+        hnsw_config=settings.hnsw_config(),
+        quantization_config=settings.quantization_config(),
+    )
+    await create_payload_indexes(aclient, collection_name, settings.payload_indexes)
+    logger.info(f"Collection {collection_name} creata: {asdict(settings)}")
+    return True
+
+async def create_payload_indexes(aclient, collection_name: str, fields=('source',)):
+    from qdrant_client import models
+    for field_name in fields:
+        await aclient.create_payload_index(
+            collection_name, field_name=field_name, field_schema=models.PayloadSchemaType.KEYWORD
+        )
+
+async def update_collection(aclient, collection_name: str, settings: CollectionSettings):
+    """
+    Applica quantizzazione, HNSW e vettori su disco a una collection esistente
+    (Qdrant ricostruisce indici e quantizzazione in background) e crea gli indici mancanti.
+    """
+    from qdrant_client import models
+    existing_sparse = (await collection_info(aclient, collection_name))["sparse_vectors"]
+    if settings.sparse_vector and settings.sparse_vector not in existing_sparse:
+        # I vettori sparsi non si possono aggiungere a una collection esistente
+        logger.warning(f"La collection {collection_name} non ha il vettore sparso '{settings.sparse_vector}': "
+                       f"per la ricerca ibrida ricreala con 'create --recreate' e ricarica i PDF")
+    quantization = settings.quantization_config() or models.Disabled.DISABLED
+    await aclient.update_collection(
+        collection_name,
+        vectors_config={"": models.VectorParamsDiff(on_disk=settings.on_disk)},
+        hnsw_config=settings.hnsw_config(),
+        quantization_config=quantization,
+    )
+    await create_payload_indexes(aclient, collection_name, settings.payload_indexes)
+    logger.info(f"Collection {collection_name} aggiornata: {asdict(settings)}")
+
+async def collection_info(aclient, collection_name: str) -> Dict:
+    """Configurazione e stato della collection in forma leggibile."""
+    info = await aclient.get_collection(collection_name)
+    params = info.config.params
+    return {
+        "status": str(info.status.value if hasattr(info.status, 'value') else info.status),
+        "points": info.points_count,
+        "indexed_vectors": info.indexed_vectors_count,
+        "vectors": params.vectors.model_dump(exclude_none=True) if hasattr(params.vectors, 'model_dump')
+        else {name: v.model_dump(exclude_none=True) for name, v in params.vectors.items()},
+        "sparse_vectors": sorted(params.sparse_vectors or {}),
+        "hnsw": info.config.hnsw_config.model_dump(exclude_none=True),
+        "quantization": info.config.quantization_config.model_dump(exclude_none=True)
+        if info.config.quantization_config else None,
+        "payload_indexes": sorted(info.payload_schema or {}),
+    }
+
+def search_params_from_env() -> Dict:
+    """Parametri di ricerca di default (QDRANT_SEARCH_*)."""
+    params = {
+        'hnsw_ef': _env_float('QDRANT_SEARCH_HNSW_EF'),
+        'rescore': os.getenv('QDRANT_SEARCH_RESCORE', 'true').lower() == 'true',
+        'oversampling': _env_float('QDRANT_SEARCH_OVERSAMPLING'),
+    }
+    return {k: v for k, v in params.items() if v is not None}
+
+def build_search_params(params: Optional[Dict]):
+    """
+    Converte un dizionario {'hnsw_ef', 'rescore', 'oversampling', 'exact'} in SearchParams.
+    I parametri di quantizzazione vengono ignorati da Qdrant se la collection non è quantizzata.
+    """
+    if not params:
+        return None
+    from qdrant_client import models
+    quantization = None
+    if params.get('rescore') is not None or params.get('oversampling') is not None:
+        quantization = models.QuantizationSearchParams(
+            rescore=params.get('rescore'), oversampling=params.get('oversampling')
+        )
+    hnsw_ef = params.get('hnsw_ef')
+    return models.SearchParams(
+        hnsw_ef=int(hnsw_ef) if hnsw_ef is not None else None,
+        exact=bool(params.get('exact', False)),
+        quantization=quantization,
+    )
+
+def search_params_key(params: Optional[Dict]) -> Optional[tuple]:
+    return tuple(sorted(params.items())) if params else None
+
+async def _run_command(args) -> int:
+    from qdrant_client import AsyncQdrantClient
+
+    if not args.url:
+        logger.error("QDRANT_URL non configurata (o usa --url)")
+        return 1
+    # ':memory:' crea una collection locale di prova (quantizzazione e HNSW vengono ignorati)
+    aclient = AsyncQdrantClient(location=':memory:') if args.url == ':memory:' \
+        else AsyncQdrantClient(url=args.url, api_key=QDRANT_API_KEY)
+    try:
+        if args.command in ('create', 'update'):
+            settings = CollectionSettings.from_env(
+                vector_size=args.vector_size, quantization=args.quantization, on_disk=args.on_disk,
+                hnsw_m=args.hnsw_m, hnsw_ef_construct=args.hnsw_ef_construct,
+            )
+            if args.hybrid is not None:
+                settings.sparse_vector = SPARSE_VECTOR_NAME if args.hybrid else None
+            if args.command == 'create':
+                if not await create_collection(aclient, args.collection, settings, recreate=args.recreate):
+                    logger.warning(f"La collection {args.collection} esiste già: usa 'update' o --recreate")
+                    return 1
+            else:
+                await update_collection(aclient, args.collection, settings)
+        print(json.dumps(await collection_info(aclient, args.collection), indent=2, default=str))
+    finally:
+        await aclient.close()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Gestione della collection Qdrant")
+    parser.add_argument('command', choices=['info', 'create', 'update'])
+    parser.add_argument('--collection', default=COLLECTION_NAME)
+    parser.add_argument('--url', default=QDRANT_URL, help="URL di Qdrant (default QDRANT_URL)")
+    parser.add_argument('--recreate', action='store_true', help="Con create: cancella la collection se esiste")
+    parser.add_argument('--vector-size', type=int, help="Default: EMBEDDING_DIM o dimensione del modello")
+    parser.add_argument('--quantization', choices=QUANTIZATION_TYPES)
+    parser.add_argument('--on-disk', action=argparse.BooleanOptionalAction, default=None,
+                        help="Vettori originali su disco (in RAM resta solo la versione quantizzata)")
+    parser.add_argument('--hybrid', action=argparse.BooleanOptionalAction, default=None,
+                        help="Vettore sparso BM25 per la ricerca ibrida (default HYBRID_SEARCH)")
+    parser.add_argument('--hnsw-m', type=int)
+    parser.add_argument('--hnsw-ef-construct', type=int)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    return asyncio.run(_run_command(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
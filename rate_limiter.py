@@ -0,0 +1,123 @@
+"""
+Rate limiter a finestra scorrevole con costo costante per richiesta.
+
+Per ogni identificatore (IP o thread_id) e per ogni finestra (es. minuto e ora) si tengono
+solo due contatori: richieste della finestra corrente e di quella precedente. Il numero di
+richieste nell'ultima finestra viene stimato pesando il contatore precedente per la parte
+di finestra ancora "scoperta" (sliding window counter), quindi il controllo è O(1) e la
+memoria per chiave è costante, indipendentemente dal limite.
+
+Le chiavi inattive da più di due volte la finestra più lunga (fino ad allora il contatore
+precedente conta ancora nella stima) vengono rimosse periodicamente e il
+numero totale di chiavi è limitato (eviction LRU), così la memoria non cresce con il numero
+di IP distinti. Il tempo è misurato con time.monotonic(), immune ai cambi dell'orologio.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+class SlidingWindowRateLimiter:
+    """
+    Limiter con più finestre (es. 10 al minuto e 100 all'ora) per identificatore.
+
+    Args:
+        limits: Sequenza di (durata finestra in secondi, richieste massime, messaggio di errore)
+        max_keys: Numero massimo di identificatori tracciati (i meno recenti vengono scartati)
+        cleanup_interval: Ogni quanti secondi rimuovere le chiavi inattive
+        clock: Funzione che restituisce il tempo corrente (default time.monotonic)
+    """
+
+    def __init__(self, limits: Sequence[Tuple[float, int, str]], max_keys: int = 100_000,
+                 cleanup_interval: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.limits = list(limits)
+        self.max_keys = max_keys
+        self.cleanup_interval = cleanup_interval
+        self.clock = clock
+        # Dopo l'ultima richiesta il contatore pesa nella stima per al più due finestre
+        self._idle_after = 2 * max(window for window, _, _ in self.limits)
+        # Stato di una chiave in una lista piatta (compatta in memoria):
+        # [ultimo accesso, inizio finestra 0, corrente 0, precedente 0, inizio finestra 1, ...]
+        self._keys: "OrderedDict[str, list]" = OrderedDict()
+        self._empty_state = [0.0] + [0.0, 0, 0] * len(self.limits)
+        self._lock = threading.Lock()
+        self._next_cleanup = clock() + cleanup_interval
+        self.evicted_idle = 0
+        self.evicted_overflow = 0
+
+    def check(self, identifier: str) -> Tuple[bool, Optional[str]]:
+        """
+        Verifica e, se permessa, conta una richiesta per l'identificatore.
+
+        Returns:
+            Tuple (is_allowed, error_message)
+        """
+        now = self.clock()
+        with self._lock:
+            if now >= self._next_cleanup:
+                self._evict_idle(now)
+
+            state = self._keys.get(identifier)
+            if state is None:
+                state = self._empty_state.copy()
+                self._keys[identifier] = state
+                while len(self._keys) > self.max_keys:
+                    self._keys.popitem(last=False)
+                    self.evicted_overflow += 1
+            else:
+                self._keys.move_to_end(identifier)
+            state[0] = now
+
+            offset = 1
+            for window, max_requests, error_msg in self.limits:
+                elapsed = now - state[offset]
+                if elapsed >= window:
+                    if elapsed < 2 * window:
+                        # Finestra successiva: la corrente diventa la precedente
+                        state[offset + 2] = state[offset + 1]
+                        state[offset] += window
+                    else:
+                        # È passata più di una finestra intera: contatori azzerati
+                        state[offset + 2] = 0
+                        state[offset] = now
+                    state[offset + 1] = 0
+                    elapsed = now - state[offset]
+                estimated = state[offset + 2] * (1.0 - elapsed / window) + state[offset + 1]
+                if estimated >= max_requests:
+                    return False, error_msg
+                offset += 3
+
+            for offset in range(2, len(state), 3):
+                state[offset] += 1
+        return True, None
+
+    def _evict_idle(self, now: float):
+        """Rimuove le chiavi inattive (sono in testa, ordinate per ultimo accesso)."""
+        self._next_cleanup = now + self.cleanup_interval
+        while self._keys:
+            identifier, state = next(iter(self._keys.items()))
+            if now - state[0] < self._idle_after:
+                break
+            del self._keys[identifier]
+            self.evicted_idle += 1
+
+    def reset(self, identifier: Optional[str] = None):
+        """Azzera i contatori di un identificatore (o di tutti)."""
+        with self._lock:
+            if identifier is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(identifier, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "keys": len(self._keys),
+                "max_keys": self.max_keys,
+                "evicted_idle": self.evicted_idle,
+                "evicted_overflow": self.evicted_overflow,
+            }
@@ -0,0 +1,338 @@
+"""
+Backend di retrieval usati da retrieve_context.py.
+
+- LlamaIndexBackend: retrieval tramite LlamaIndex (VectorStoreIndex su QdrantVectorStore)
+- QdrantBackend: ricerca diretta con qdrant_client usando l'embedding della query già
+  calcolato; non importa LlamaIndex, quindi l'avvio del worker è più veloce e leggero
+
+Le librerie pesanti vengono importate solo quando il backend viene creato.
+Entrambi i backend restituiscono i contesti nello stesso formato:
+lista di dizionari con 'text', 'source', 'score'.
+
+I parametri di ricerca di Qdrant (hnsw_ef, rescore e oversampling della quantizzazione,
+exact) hanno un default per backend e si possono sovrascrivere per singola ricerca.
+
+Con hybrid=True (HYBRID_SEARCH) entrambi i backend eseguono ricerca densa e sparsa BM25
+e fondono i risultati con Reciprocal Rank Fusion (vedi hybrid_search.py). Se la collection
+non ha il vettore sparso si torna alla sola ricerca densa.
+"""
+
+import json
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from hybrid_search import (
+    HYBRID_CANDIDATES, SPARSE_VECTOR_NAME, collection_has_sparse_vector, encode_query, reciprocal_rank_fusion,
+    rrf_fusion_fn, sparse_doc_fn, sparse_query_fn,
+)
+from qdrant_collection import build_search_params, search_params_key
+
+logger = logging.getLogger(__name__)
+
+def _filters_key(filters: Optional[Dict]) -> Optional[tuple]:
+    return tuple(sorted(filters.items())) if filters else None
+
+def _hybrid_available(qdrant_client, collection_name: str) -> bool:
+    if collection_has_sparse_vector(qdrant_client, collection_name):
+        return True
+    logger.warning(f"La collection {collection_name} non ha il vettore sparso '{SPARSE_VECTOR_NAME}': "
+                   f"ricerca ibrida disattivata (ricrea la collection con HYBRID_SEARCH=true e ricarica i PDF)")
+    return False
+
+class LlamaIndexBackend:
+    """Retrieval con LlamaIndex: il retriever gestisce la ricerca in Qdrant."""
+
+    name = "llamaindex"
+
+    def __init__(self, index, embed_model, async_search: bool = False, qdrant_client=None, qdrant_aclient=None,
+                 collection_name: Optional[str] = None, search_params: Optional[Dict] = None,
+                 hybrid: bool = False):
+        self.index = index
+        self.embed_model = embed_model
+        self.supports_async_search = async_search
+        self.qdrant_client = qdrant_client
+        self.qdrant_aclient = qdrant_aclient
+        self.collection_name = collection_name
+        self.search_params = search_params
+        self.hybrid = hybrid
+        self._retrievers: Dict[tuple, object] = {}
+        self._retrievers_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, url: str, api_key: str, openai_api_key: str, collection_name: str,
+               embedding_model: str, async_client: bool = True,
+               search_params: Optional[Dict] = None, hybrid: bool = False) -> "LlamaIndexBackend":
+        """Crea client Qdrant, vector store, modello di embedding e index."""
+        from llama_index.core import VectorStoreIndex
+        from llama_index.vector_stores.qdrant import QdrantVectorStore
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        from qdrant_client import QdrantClient, AsyncQdrantClient
+
+        # Setup client Qdrant
+        qdrant_client = QdrantClient(url=url, api_key=api_key)
+
+        # Client asincrono per il retrieval non bloccante
+        qdrant_aclient = AsyncQdrantClient(url=url, api_key=api_key) if async_client else None
+
+        hybrid = hybrid and _hybrid_available(qdrant_client, collection_name)
+
+        # Setup vector store (in modalità ibrida con encoder BM25 e fusione RRF)
+        hybrid_kwargs = dict(
+            enable_hybrid=True, sparse_doc_fn=sparse_doc_fn, sparse_query_fn=sparse_query_fn,
+            hybrid_fusion_fn=rrf_fusion_fn, sparse_vector_name=SPARSE_VECTOR_NAME,
+        ) if hybrid else {}
+        vector_store = QdrantVectorStore(
+            client=qdrant_client,
+            aclient=qdrant_aclient,
+            collection_name=collection_name,
+            **hybrid_kwargs
+        )
+
+        # Setup embedding model
+        embed_model = OpenAIEmbedding(model=embedding_model, api_key=openai_api_key)
+
+        # Carica index esistente da Qdrant
+        index = VectorStoreIndex.from_vector_store(vector_store=vector_store, embed_model=embed_model)
+
+        return cls(index, embed_model, async_search=qdrant_aclient is not None,
+                   qdrant_client=qdrant_client, qdrant_aclient=qdrant_aclient, collection_name=collection_name,
+                   search_params=search_params, hybrid=hybrid)
+
+    def get_retriever(self, top_k: int, filters: Optional[Dict] = None, search_params: Optional[Dict] = None):
+        """Restituisce il retriever per (top_k, filtri, parametri di ricerca), creandolo solo la prima volta."""
+        if search_params is None:
+            search_params = self.search_params
+        key = (top_k, _filters_key(filters), search_params_key(search_params))
+        retriever = self._retrievers.get(key)
+        if retriever is not None:
+            return retriever
+
+        with self._retrievers_lock:
+            retriever = self._retrievers.get(key)
+            if retriever is None:
+                metadata_filters = None
+                if filters:
+                    from llama_index.core.vector_stores import MetadataFilters, MetadataFilter
+                    metadata_filters = MetadataFilters(
+                        filters=[MetadataFilter(key=k, value=v) for k, v in filters.items()]
+                    )
+                vector_store_kwargs = {"search_params": build_search_params(search_params)}
+                if self.hybrid:
+                    # HYBRID_CANDIDATES risultati per ramo, top_k dopo la fusione
+                    candidates = max(top_k, HYBRID_CANDIDATES)
+                    retriever = self.index.as_retriever(
+                        vector_store_query_mode="hybrid", similarity_top_k=candidates, sparse_top_k=candidates,
+                        hybrid_top_k=top_k, filters=metadata_filters, vector_store_kwargs=vector_store_kwargs,
+                    )
+                else:
+                    retriever = self.index.as_retriever(
+                        similarity_top_k=top_k, filters=metadata_filters, vector_store_kwargs=vector_store_kwargs,
+                    )
+                self._retrievers[key] = retriever
+        return retriever
+
+    def embed_query(self, query: str) -> List[float]:
+        return self.embed_model.get_query_embedding(query)
+
+    async def aembed_query(self, query: str) -> List[float]:
+        return await self.embed_model.aget_query_embedding(query)
+
+    @staticmethod
+    def _query_bundle(query: str, embedding: Optional[List[float]]):
+        from llama_index.core import QueryBundle
+        # Passando l'embedding nel QueryBundle LlamaIndex non lo ricalcola
+        return QueryBundle(query_str=query, embedding=embedding)
+
+    @staticmethod
+    def nodes_to_contexts(nodes) -> List[Dict]:
+        """
+        Converte i NodeWithScore di LlamaIndex nel formato originale per compatibilità.
+        Il retriever restituisce sempre NodeWithScore con nodi testuali, quindi si
+        accede direttamente agli attributi.
+        """
+        return [
+            {
+                'text': nws.node.text,
+                'source': nws.node.metadata.get('source', 'unknown'),
+                'score': float(nws.score) if nws.score else 0.0
+            }
+            for nws in nodes
+        ]
+
+    def search(self, query: str, embedding: Optional[List[float]], top_k: int,
+               filters: Optional[Dict] = None, search_params: Optional[Dict] = None) -> List[Dict]:
+        retriever = self.get_retriever(top_k, filters, search_params)
+        return self.nodes_to_contexts(retriever.retrieve(self._query_bundle(query, embedding)))
+
+    async def asearch(self, query: str, embedding: Optional[List[float]], top_k: int,
+                      filters: Optional[Dict] = None, search_params: Optional[Dict] = None) -> List[Dict]:
+        retriever = self.get_retriever(top_k, filters, search_params)
+        return self.nodes_to_contexts(await retriever.aretrieve(self._query_bundle(query, embedding)))
+
+    async def warm_up(self):
+        """Apre le connessioni verso Qdrant."""
+        if self.qdrant_aclient is not None:
+            await self.qdrant_aclient.get_collection(self.collection_name)
+        elif self.qdrant_client is not None:
+            await asyncio.to_thread(self.qdrant_client.get_collection, self.collection_name)
+
+class QdrantBackend:
+    """
+    Retrieval leggero: embedding della query con il client OpenAI e ricerca diretta
+    con qdrant_client. Legge i payload scritti da LlamaIndex (campo _node_content).
+    """
+
+    name = "qdrant"
+
+    def __init__(self, qdrant_client, collection_name: str, embedding_model: str,
+                 openai_client=None, async_openai_client=None, qdrant_aclient=None,
+                 search_params: Optional[Dict] = None, hybrid: bool = False):
+        self.qdrant_client = qdrant_client
+        self.qdrant_aclient = qdrant_aclient
+        self.collection_name = collection_name
+        self.embedding_model = embedding_model
+        self.openai_client = openai_client
+        self.async_openai_client = async_openai_client
+        self.search_params = search_params
+        self.hybrid = hybrid
+        self.supports_async_search = qdrant_aclient is not None
+
+    @classmethod
+    def create(cls, url: str, api_key: str, openai_api_key: str, collection_name: str,
+               embedding_model: str, async_client: bool = True,
+               search_params: Optional[Dict] = None, hybrid: bool = False) -> "QdrantBackend":
+        from openai import OpenAI, AsyncOpenAI
+        from qdrant_client import QdrantClient, AsyncQdrantClient
+
+        qdrant_client = QdrantClient(url=url, api_key=api_key)
+        return cls(
+            qdrant_client,
+            collection_name,
+            embedding_model,
+            openai_client=OpenAI(api_key=openai_api_key),
+            async_openai_client=AsyncOpenAI(api_key=openai_api_key),
+            qdrant_aclient=AsyncQdrantClient(url=url, api_key=api_key) if async_client else None,
+            search_params=search_params,
+            hybrid=hybrid and _hybrid_available(qdrant_client, collection_name),
+        )
+
+    def embed_query(self, query: str) -> List[float]:
+        response = self.openai_client.embeddings.create(model=self.embedding_model, input=[query])
+        return response.data[0].embedding
+
+    async def aembed_query(self, query: str) -> List[float]:
+        response = await self.async_openai_client.embeddings.create(model=self.embedding_model, input=[query])
+        return response.data[0].embedding
+
+    @staticmethod
+    def _qdrant_filter(filters: Optional[Dict]):
+        if not filters:
+            return None
+        from qdrant_client import models
+        return models.Filter(must=[
+            models.FieldCondition(key=k, match=models.MatchValue(value=v)) for k, v in filters.items()
+        ])
+
+    @staticmethod
+    def point_to_context(point) -> Dict:
+        """Converte un punto Qdrant nel formato dei contesti."""
+        payload = point.payload or {}
+        text = payload.get('text')
+        if text is None:
+            # Payload scritto da LlamaIndex: il testo è nel nodo serializzato
+            text = json.loads(payload.get('_node_content', '{}')).get('text', '')
+        return {
+            'text': text,
+            'source': payload.get('source', 'unknown'),
+            'score': float(point.score) if point.score else 0.0
+        }
+
+    def _search_params(self, search_params: Optional[Dict]):
+        return build_search_params(self.search_params if search_params is None else search_params)
+
+    def _hybrid_requests(self, query: str, embedding: List[float], top_k: int, query_filter, params):
+        """Richieste densa e sparsa per la ricerca ibrida (None se la query non ha token utili)."""
+        from qdrant_client import models
+        indices, values = encode_query(query)
+        if not indices:
+            return None
+        candidates = max(top_k, HYBRID_CANDIDATES)
+        return [
+            models.QueryRequest(query=embedding, limit=candidates, filter=query_filter, params=params,
+                                with_payload=True),
+            models.QueryRequest(query=models.SparseVector(indices=indices, values=values), using=SPARSE_VECTOR_NAME,
+                                limit=candidates, filter=query_filter, params=params, with_payload=True),
+        ]
+
+    def _fuse(self, responses, top_k: int) -> List[Dict]:
+        """Fonde i risultati densi e sparsi con RRF; lo score dei contesti è quello RRF."""
+        points = {}
+        rankings = []
+        for response in responses:
+            rankings.append([point.id for point in response.points])
+            for point in response.points:
+                points.setdefault(point.id, point)
+        contexts = []
+        for point_id, score in reciprocal_rank_fusion(rankings, top_k):
+            context = self.point_to_context(points[point_id])
+            context['score'] = score
+            contexts.append(context)
+        return contexts
+
+    def search(self, query: str, embedding: Optional[List[float]], top_k: int,
+               filters: Optional[Dict] = None, search_params: Optional[Dict] = None) -> List[Dict]:
+        if embedding is None:
+            embedding = self.embed_query(query)
+        query_filter = self._qdrant_filter(filters)
+        params = self._search_params(search_params)
+        requests = self._hybrid_requests(query, embedding, top_k, query_filter, params) if self.hybrid else None
+        if requests:
+            return self._fuse(self.qdrant_client.query_batch_points(self.collection_name, requests=requests), top_k)
+        if hasattr(self.qdrant_client, 'query_points'):
+            points = self.qdrant_client.query_points(
+                self.collection_name, query=embedding, limit=top_k,
+                query_filter=query_filter, search_params=params, with_payload=True
+            ).points
+        else:
+            points = self.qdrant_client.search(
+                self.collection_name, query_vector=embedding, limit=top_k,
+                query_filter=query_filter, search_params=params, with_payload=True
+            )
+        return [self.point_to_context(p) for p in points]
+
+    async def asearch(self, query: str, embedding: Optional[List[float]], top_k: int,
+                      filters: Optional[Dict] = None, search_params: Optional[Dict] = None) -> List[Dict]:
+        if embedding is None:
+            embedding = await self.aembed_query(query)
+        query_filter = self._qdrant_filter(filters)
+        params = self._search_params(search_params)
+        requests = self._hybrid_requests(query, embedding, top_k, query_filter, params) if self.hybrid else None
+        if requests:
+            responses = await self.qdrant_aclient.query_batch_points(self.collection_name, requests=requests)
+            return self._fuse(responses, top_k)
+        if hasattr(self.qdrant_aclient, 'query_points'):
+            response = await self.qdrant_aclient.query_points(
+                self.collection_name, query=embedding, limit=top_k,
+                query_filter=query_filter, search_params=params, with_payload=True
+            )
+            points = response.points
+        else:
+            points = await self.qdrant_aclient.search(
+                self.collection_name, query_vector=embedding, limit=top_k,
+                query_filter=query_filter, search_params=params, with_payload=True
+            )
+        return [self.point_to_context(p) for p in points]
+
+    async def warm_up(self):
+        """Apre le connessioni verso Qdrant."""
+        if self.qdrant_aclient is not None:
+            await self.qdrant_aclient.get_collection(self.collection_name)
+        else:
+            await asyncio.to_thread(self.qdrant_client.get_collection, self.collection_name)
+
+BACKENDS = {
+    LlamaIndexBackend.name: LlamaIndexBackend,
+    QdrantBackend.name: QdrantBackend,
+}
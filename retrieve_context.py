@@ -1,12 +1,32 @@
 """
-Modulo per recuperare contesto rilevante da Qdrant usando LlamaIndex.
-Riscritto con LlamaIndex per semplificare il codice e migliorare le performance.
+Modulo per recuperare contesto rilevante da Qdrant.
+
+Facciata leggera sopra i backend di retrieval (vedi retrieval_backends.py):
+- llamaindex (default): retrieval tramite LlamaIndex
+- qdrant: ricerca diretta con qdrant_client e embedding della query già calcolato
+
+Con HYBRID_SEARCH=true la ricerca densa è affiancata da quella sparsa BM25 e i risultati
+vengono fusi con RRF (vedi hybrid_search.py).
+
+LlamaIndex viene importato solo quando il backend llamaindex viene inizializzato,
+così l'import di questo modulo (e l'avvio dei worker uvicorn) resta veloce.
 """
 
 import os
+import time
+import asyncio
 import logging
-from typing import List, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional
 from dotenv import load_dotenv
+from context_builder import format_context
+from embedding_cache import EmbeddingCache
+from hybrid_search import HYBRID_SEARCH
+from metrics import observe_stage, record_cache, record_error, record_retrieval_timeout
+from qdrant_collection import search_params_from_env
+from retrieval_backends import BACKENDS
 
 # Configurazione logging
 logger = logging.getLogger(__name__)
@@ -15,17 +35,6 @@ logger = logging.getLogger(__name__)
 load_dotenv('.env.local')
 load_dotenv()
 
-# Importa LlamaIndex
-try:
-    from llama_index.core import VectorStoreIndex, StorageContext
-    from llama_index.vector_stores.qdrant import QdrantVectorStore
-    from llama_index.embeddings.openai import OpenAIEmbedding
-    from qdrant_client import QdrantClient
-except ImportError as e:
-    logger.error(f"Errore: libreria LlamaIndex mancante. Installa con: pip install -r requirements.txt")
-    logger.error(f"Dettaglio: {e}")
-    raise
-
 # Configurazione
 # IMPORTANTE: Configura queste variabili nel file .env.local o come variabili d'ambiente
 # Non committare mai valori hardcoded nel repository!
@@ -33,6 +42,18 @@ QDRANT_URL = os.getenv('QDRANT_URL')
 QDRANT_API_KEY = os.getenv('QDRANT_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 COLLECTION_NAME = os.getenv('QDRANT_COLLECTION_NAME', 'dataclinic_docs')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
+
+# Retrieval asincrono: budget di latenza complessivo (embedding + ricerca) in secondi.
+# Se Qdrant è lento si procede senza contesto invece di bloccare la richiesta.
+RETRIEVAL_TIMEOUT = float(os.getenv('RETRIEVAL_TIMEOUT', '3.0'))
+# Usa AsyncQdrantClient; se disattivato la ricerca gira in un pool di thread limitato
+RETRIEVAL_ASYNC_CLIENT = os.getenv('RETRIEVAL_ASYNC_CLIENT', 'true').lower() == 'true'
+RETRIEVAL_THREADS = int(os.getenv('RETRIEVAL_THREADS', '8'))
+# Backend di retrieval: 'llamaindex' oppure 'qdrant' (leggero, senza LlamaIndex)
+RETRIEVAL_BACKEND = os.getenv('RETRIEVAL_BACKEND', 'llamaindex').lower()
+# Parametri di ricerca di default (QDRANT_SEARCH_HNSW_EF, QDRANT_SEARCH_RESCORE, QDRANT_SEARCH_OVERSAMPLING)
+SEARCH_PARAMS = search_params_from_env()
 
 # Validazione: verifica che le variabili essenziali siano configurate
 if not QDRANT_URL or not QDRANT_API_KEY:
@@ -42,102 +63,207 @@ if not QDRANT_URL or not QDRANT_API_KEY:
     )
 
 # Singleton per evitare reinizializzazioni
-_index = None
+_backend = None
 
-def get_index():
-    """Ottiene o crea l'index LlamaIndex (singleton pattern)."""
-    global _index
+# Circuit breaker sull'inizializzazione del backend: dopo un errore i tentativi
+# successivi sono distanziati con backoff esponenziale
+INDEX_RETRY_BASE_DELAY = float(os.getenv('INDEX_RETRY_BASE_DELAY', '1.0'))
+INDEX_RETRY_MAX_DELAY = float(os.getenv('INDEX_RETRY_MAX_DELAY', '60'))
+WARMUP_QUERY = os.getenv('WARMUP_QUERY', "Cos'è DataClinic?")
+_backend_lock = threading.Lock()
+_init_failures = 0
+_next_init_attempt = 0.0
+_last_init_error = None
+
+DEFAULT_TOP_K = 3
+
+# Pool di thread limitato per il retrieval sincrono quando il client asincrono non è disponibile
+_retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_THREADS, thread_name_prefix="retrieval")
+
+# Cache degli embedding delle query (LRU + TTL, livello persistente opzionale)
+_embedding_cache = EmbeddingCache.from_env()
+
+def is_retrieval_configured() -> bool:
+    """True se le credenziali necessarie al retrieval sono configurate."""
+    return bool(QDRANT_API_KEY and OPENAI_API_KEY)
+
+def get_backend():
+    """
+    Ottiene o crea il backend di retrieval configurato (singleton pattern).
+    
+    Se l'inizializzazione fallisce, i tentativi successivi sono distanziati con backoff
+    esponenziale (circuit breaker): finché il circuito è aperto la funzione restituisce
+    subito None invece di ricostruire client e vector store a ogni richiesta.
+    """
+    global _backend, _init_failures, _next_init_attempt, _last_init_error
+    
+    if _backend is not None:
+        return _backend
     
-    if _index is None:
-        if not QDRANT_API_KEY or not OPENAI_API_KEY:
-            logger.warning("QDRANT_API_KEY o OPENAI_API_KEY non configurate")
+    if not is_retrieval_configured():
+        logger.warning("QDRANT_API_KEY o OPENAI_API_KEY non configurate")
+        return None
+    
+    # Circuito aperto: attendiamo il prossimo tentativo consentito
+    if time.monotonic() < _next_init_attempt:
+        return None
+    
+    with _backend_lock:
+        if _backend is not None:
+            return _backend
+        if time.monotonic() < _next_init_attempt:
             return None
         
         try:
-            # Setup client Qdrant
-            qdrant_client = QdrantClient(
+            backend_class = BACKENDS.get(RETRIEVAL_BACKEND)
+            if backend_class is None:
+                raise ValueError(f"RETRIEVAL_BACKEND '{RETRIEVAL_BACKEND}' non valido (usa: {', '.join(BACKENDS)})")
+            
+            _backend = backend_class.create(
                 url=QDRANT_URL,
                 api_key=QDRANT_API_KEY,
+                openai_api_key=OPENAI_API_KEY,
+                collection_name=COLLECTION_NAME,
+                embedding_model=EMBEDDING_MODEL,
+                async_client=RETRIEVAL_ASYNC_CLIENT,
+                search_params=SEARCH_PARAMS,
+                hybrid=HYBRID_SEARCH
             )
             
-            # Setup vector store
-            vector_store = QdrantVectorStore(
-                client=qdrant_client,
-                collection_name=COLLECTION_NAME
-            )
+            # Il retriever di default è pronto insieme all'index
+            if hasattr(_backend, 'get_retriever'):
+                _backend.get_retriever(DEFAULT_TOP_K)
             
-            # Setup embedding model
-            embed_model = OpenAIEmbedding(
-                model="text-embedding-3-small",
-                api_key=OPENAI_API_KEY
-            )
-            
-            # Crea storage context
-            storage_context = StorageContext.from_defaults(vector_store=vector_store)
-            
-            # Carica index esistente da Qdrant
-            _index = VectorStoreIndex.from_vector_store(
-                vector_store=vector_store,
-                embed_model=embed_model
-            )
-            
-            logger.info("Index LlamaIndex inizializzato con successo")
+            _init_failures = 0
+            _last_init_error = None
+            logger.info(f"Backend di retrieval '{_backend.name}' inizializzato con successo")
         except Exception as e:
-            logger.error(f"Errore durante l'inizializzazione dell'index: {e}")
-            import traceback
-            traceback.print_exc()
+            _init_failures += 1
+            _last_init_error = str(e)
+            delay = min(INDEX_RETRY_BASE_DELAY * 2 ** (_init_failures - 1), INDEX_RETRY_MAX_DELAY)
+            _next_init_attempt = time.monotonic() + delay
+            logger.error(
+                f"Errore durante l'inizializzazione del retrieval (tentativo {_init_failures}): {e}. "
+                f"Nuovo tentativo tra {delay:.1f}s"
+            )
             return None
     
-    return _index
+    return _backend
+
+def set_backend(backend):
+    """Imposta il backend di retrieval (es. Qdrant in memoria per benchmark e test di carico)."""
+    global _backend, _init_failures, _next_init_attempt, _last_init_error
+    with _backend_lock:
+        _backend = backend
+        _init_failures = 0
+        _next_init_attempt = 0.0
+        _last_init_error = None
+
+def get_index():
+    """Ottiene l'index LlamaIndex (None se il backend non è 'llamaindex' o non è disponibile)."""
+    backend = get_backend()
+    return getattr(backend, 'index', None)
+
+def seconds_until_next_init_attempt() -> float:
+    """Secondi mancanti al prossimo tentativo di inizializzazione consentito dal circuit breaker."""
+    return max(0.0, _next_init_attempt - time.monotonic())
+
+def get_index_status() -> Dict:
+    """Stato del retrieval per /ready e /health."""
+    return {
+        "backend": RETRIEVAL_BACKEND,
+        "hybrid": getattr(_backend, 'hybrid', HYBRID_SEARCH),
+        "configured": is_retrieval_configured(),
+        "ready": _backend is not None,
+        "init_failures": _init_failures,
+        "circuit_open": _backend is None and seconds_until_next_init_attempt() > 0,
+        "last_error": _last_init_error,
+    }
+
+async def awarm_up() -> bool:
+    """
+    Inizializza il backend e apre le connessioni HTTP verso Qdrant e OpenAI,
+    così la prima richiesta dopo un deploy non paga la latenza di avvio.
+    
+    Returns:
+        True se il backend è pronto
+    """
+    backend = await asyncio.to_thread(get_backend)
+    if backend is None:
+        return False
+    
+    try:
+        await backend.warm_up()
+        # L'embedding di warm-up resta in cache: la domanda più comune è già pronta
+        await aget_query_embedding(WARMUP_QUERY)
+    except Exception as e:
+        # Il backend è pronto: un errore nel warm-up delle connessioni non è bloccante
+        logger.warning(f"Warm-up delle connessioni non completato: {e}")
+    
+    logger.info("Warm-up del retrieval completato")
+    return True
 
-def retrieve_relevant_context(query: str, top_k: int = 3) -> List[Dict]:
+def get_query_embedding(query: str) -> Optional[List[float]]:
     """
-    Recupera i chunk più rilevanti da Qdrant usando LlamaIndex.
+    Restituisce l'embedding della query, usando la cache quando possibile.
+    
+    Args:
+        query: La query dell'utente (già sanitizzata)
+    
+    Returns:
+        Embedding della query, oppure None se il backend non è disponibile
+    """
+    backend = get_backend()
+    if backend is None:
+        return None
+    
+    return _embedding_cache.get_or_compute(
+        EMBEDDING_MODEL,
+        query,
+        lambda: backend.embed_query(query)
+    )
+
+async def aget_query_embedding(query: str) -> Optional[List[float]]:
+    """Versione asincrona di get_query_embedding (non blocca l'event loop)."""
+    backend = _backend or await asyncio.to_thread(get_backend)
+    if backend is None:
+        return None
+    
+    embedding = await _embedding_cache.aget(EMBEDDING_MODEL, query)
+    record_cache("embedding", embedding is not None)
+    if embedding is None:
+        embedding = await backend.aembed_query(query)
+        await _embedding_cache.aset(EMBEDDING_MODEL, query, embedding)
+    return embedding
+
+def get_embedding_cache_stats() -> Dict:
+    """Statistiche della cache degli embedding (per monitoraggio)."""
+    return _embedding_cache.stats()
+
+def retrieve_relevant_context(query: str, top_k: int = DEFAULT_TOP_K, filters: Optional[Dict] = None,
+                              search_params: Optional[Dict] = None) -> List[Dict]:
+    """
+    Recupera i chunk più rilevanti da Qdrant.
     
     Args:
         query: La query dell'utente
         top_k: Numero di risultati da recuperare
+        filters: Filtri opzionali sui metadata, es. {'source': 'dataclinic.pdf'}
+        search_params: Parametri di ricerca di Qdrant, es. {'hnsw_ef': 128, 'rescore': True,
+            'oversampling': 2.0} (default SEARCH_PARAMS); {'exact': True} per la ricerca esatta
     
     Returns:
         Lista di dizionari con 'text', 'source', 'score'
     """
-    index = get_index()
+    backend = get_backend()
     
-    if index is None:
+    if backend is None:
         logger.warning("Index non disponibile, restituendo lista vuota")
         return []
     
     try:
-        # Crea retriever con top_k dinamico
-        retriever = index.as_retriever(similarity_top_k=top_k)
-        
-        # LlamaIndex gestisce automaticamente:
-        # 1. Generazione embedding della query
-        # 2. Ricerca in Qdrant
-        # 3. Recupero dei risultati più rilevanti
-        
-        # Usa retrieve() per ottenere i nodi (restituisce NodeWithScore)
-        nodes = retriever.retrieve(query)
-        
-        # Formatta risultati nel formato originale per compatibilità
-        results = []
-        for node_with_score in nodes:
-            # LlamaIndex restituisce NodeWithScore che ha:
-            # - node: il nodo con testo e metadata
-            # - score: lo score di similarità
-            node = node_with_score.node if hasattr(node_with_score, 'node') else node_with_score
-            score = getattr(node_with_score, 'score', 0.0)
-            
-            # Estrai testo e metadata dal nodo
-            text = getattr(node, 'text', '') if hasattr(node, 'text') else str(node)
-            metadata = getattr(node, 'metadata', {}) if hasattr(node, 'metadata') else {}
-            source = metadata.get('source', 'unknown')
-            
-            results.append({
-                'text': text,
-                'source': source,
-                'score': float(score) if score else 0.0
-            })
+        # L'embedding della query arriva dalla cache se già calcolato
+        results = backend.search(query, get_query_embedding(query), top_k, filters, search_params)
         
         logger.info(f"Recuperati {len(results)} contesti rilevanti per la query")
         return results
@@ -148,24 +274,96 @@ def retrieve_relevant_context(query: str, top_k: int = 3) -> List[Dict]:
         traceback.print_exc()
         return []
 
-def format_context_for_prompt(contexts: List[Dict]) -> str:
+@dataclass
+class RetrievalResult:
+    """Risultato del retrieval asincrono con i tempi delle singole fasi."""
+    contexts: List[Dict] = field(default_factory=list)
+    embed_ms: float = 0.0
+    search_ms: float = 0.0
+    timed_out: bool = False
+    # True se gli score sono quelli RRF della ricerca ibrida
+    hybrid: bool = False
+
+    @property
+    def total_ms(self) -> float:
+        return self.embed_ms + self.search_ms
+
+async def aretrieve_relevant_context(query: str, top_k: int = DEFAULT_TOP_K,
+                                     timeout: Optional[float] = None,
+                                     filters: Optional[Dict] = None,
+                                     search_params: Optional[Dict] = None) -> RetrievalResult:
     """
-    Formatta i contesti recuperati per includerli nel prompt.
+    Versione asincrona di retrieve_relevant_context con budget di latenza.
+    
+    L'embedding usa la cache e il client asincrono di OpenAI; la ricerca usa
+    AsyncQdrantClient (o un pool di thread limitato come fallback). Se il budget
+    scade si restituisce un risultato vuoto con timed_out=True, così la chat
+    procede senza contesto invece di restare bloccata.
     
     Args:
-        contexts: Lista di contesti recuperati
+        query: La query dell'utente
+        top_k: Numero di risultati da recuperare
+        timeout: Budget in secondi (default RETRIEVAL_TIMEOUT)
+        filters: Filtri opzionali sui metadata, es. {'source': 'dataclinic.pdf'}
+        search_params: Parametri di ricerca di Qdrant (vedi retrieve_relevant_context)
     
     Returns:
-        Stringa formattata con il contesto
+        RetrievalResult con contesti e tempi per fase (embed_ms, search_ms)
     """
-    if not contexts:
-        return ""
+    result = RetrievalResult()
+    budget = RETRIEVAL_TIMEOUT if timeout is None else timeout
     
-    formatted = "\n\n--- Informazioni rilevanti da DataClinic ---\n\n"
+    async def run():
+        start = time.perf_counter()
+        embedding = await aget_query_embedding(query)
+        result.embed_ms = (time.perf_counter() - start) * 1000
+        if embedding is not None:
+            observe_stage("embed", result.embed_ms / 1000)
+        backend = _backend
+        if backend is None:
+            logger.warning("Index non disponibile, restituendo lista vuota")
+            return
+        
+        result.hybrid = getattr(backend, 'hybrid', False)
+        start = time.perf_counter()
+        if backend.supports_async_search:
+            contexts = await backend.asearch(query, embedding, top_k, filters, search_params)
+        else:
+            loop = asyncio.get_running_loop()
+            contexts = await loop.run_in_executor(
+                _retrieval_executor, backend.search, query, embedding, top_k, filters, search_params
+            )
+        result.contexts = contexts
+        result.search_ms = (time.perf_counter() - start) * 1000
+        observe_stage("search", result.search_ms / 1000)
     
-    for idx, ctx in enumerate(contexts, 1):
-        formatted += f"[Fonte: {ctx['source']}]\n{ctx['text']}\n\n"
+    try:
+        await asyncio.wait_for(run(), timeout=budget)
+        logger.info(
+            f"Recuperati {len(result.contexts)} contesti rilevanti per la query "
+            f"(embedding {result.embed_ms:.0f}ms, ricerca {result.search_ms:.0f}ms)"
+        )
+    except asyncio.TimeoutError:
+        result.timed_out = True
+        result.contexts = []
+        record_retrieval_timeout()
+        logger.warning(f"Retrieval oltre il budget di {budget}s: si procede senza contesto")
+    except Exception as e:
+        result.contexts = []
+        record_error("retrieval", e)
+        logger.error(f"Errore durante il retrieval: {e}")
     
-    formatted += "--- Fine informazioni ---\n\n"
+    return result
+
+def format_context_for_prompt(contexts: List[Dict]) -> str:
+    """
+    Formatta i contesti recuperati per includerli nel prompt, senza selezione né budget
+    (per il prompt della chat si usa context_builder.ContextBuilder).
     
-    return formatted
+    Args:
+        contexts: Lista di contesti recuperati
+    
+    Returns:
+        Stringa formattata con il contesto
+    """
+    return format_context(contexts)
@@ -0,0 +1,237 @@
+"""
+Modulo per attendere il completamento delle run dell'OpenAI Assistant.
+
+Fornisce due implementazioni intercambiabili con la stessa interfaccia:
+- PollingRunWaiter: crea la run e ne controlla lo stato con un polling adattivo
+  (poll ravvicinati all'inizio, backoff esponenziale dopo, deadline complessiva)
+- StreamingRunWaiter: crea la run in streaming e attende l'evento finale, senza polling
+
+Entrambe cancellano la run se il client si disconnette o se la deadline scade,
+e tengono statistiche sul numero di poll per run (anche come metriche, vedi metrics.py).
+"""
+
+import os
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional
+
+from metrics import observe_stage, record_run, stage
+
+logger = logging.getLogger(__name__)
+
+# Stati in cui la run non avanza più
+TERMINAL_STATUSES = {"completed", "cancelling", "requires_action", "cancelled", "expired", "failed", "incomplete"}
+
+# Stati restituiti dal waiter quando la run non arriva a uno stato terminale
+STATUS_TIMEOUT = "timeout"
+STATUS_DISCONNECTED = "disconnected"
+
+@dataclass
+class PollSchedule:
+    """
+    Pianificazione degli intervalli di polling.
+
+    I primi `fast_polls` controlli avvengono ogni `initial_interval` secondi,
+    poi l'intervallo cresce di `backoff_factor` fino a `max_interval`.
+    `deadline` è il tempo massimo complessivo di attesa della run.
+    """
+    initial_interval: float = 0.2
+    fast_polls: int = 5
+    backoff_factor: float = 1.5
+    max_interval: float = 2.0
+    deadline: float = 60.0
+
+    @classmethod
+    def from_env(cls) -> "PollSchedule":
+        """Crea la pianificazione leggendo le variabili d'ambiente RUN_POLL_* e RUN_TIMEOUT."""
+        return cls(
+            initial_interval=float(os.getenv('RUN_POLL_INITIAL_INTERVAL', '0.2')),
+            fast_polls=int(os.getenv('RUN_POLL_FAST_POLLS', '5')),
+            backoff_factor=float(os.getenv('RUN_POLL_BACKOFF', '1.5')),
+            max_interval=float(os.getenv('RUN_POLL_MAX_INTERVAL', '2.0')),
+            deadline=float(os.getenv('RUN_TIMEOUT', '60')),
+        )
+
+    def intervals(self) -> Iterator[float]:
+        """Genera (all'infinito) gli intervalli di attesa tra un poll e il successivo."""
+        interval = self.initial_interval
+        polls = 0
+        while True:
+            yield interval
+            polls += 1
+            if polls >= self.fast_polls:
+                interval = min(interval * self.backoff_factor, self.max_interval)
+
+@dataclass
+class RunWaitResult:
+    """Esito dell'attesa di una run."""
+    run: Any
+    status: str
+    polls: int
+    elapsed: float
+
+@dataclass
+class RunWaiterStats:
+    """Statistiche aggregate del waiter (per monitoraggio)."""
+    runs: int = 0
+    polls: int = 0
+    timeouts: int = 0
+    disconnects: int = 0
+    statuses: Dict[str, int] = field(default_factory=dict)
+
+    def record(self, result: RunWaitResult):
+        self.runs += 1
+        self.polls += result.polls
+        if result.status == STATUS_TIMEOUT:
+            self.timeouts += 1
+        elif result.status == STATUS_DISCONNECTED:
+            self.disconnects += 1
+        self.statuses[result.status] = self.statuses.get(result.status, 0) + 1
+
+    def as_dict(self) -> Dict:
+        return {
+            "runs": self.runs,
+            "polls": self.polls,
+            "avg_polls_per_run": round(self.polls / self.runs, 2) if self.runs else 0.0,
+            "timeouts": self.timeouts,
+            "disconnects": self.disconnects,
+            "statuses": dict(self.statuses),
+        }
+
+IsDisconnected = Callable[[], Awaitable[bool]]
+
+async def cancel_run(client, thread_id: str, run_id: str, reason: str):
+    """
+    Cancella la run (best effort) per non consumare risorse inutilmente: una run ancora attiva
+    blocca il thread e il messaggio successivo fallirebbe con "thread has an active run".
+    """
+    logger.warning(f"Cancellazione run {run_id}: {reason}")
+    try:
+        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+    except Exception as e:
+        logger.warning(f"Impossibile cancellare la run {run_id}: {e}")
+
+class RunWaiter(ABC):
+    """Interfaccia comune: crea una run e attende che arrivi a uno stato terminale."""
+
+    def __init__(self, schedule: Optional[PollSchedule] = None):
+        self.schedule = schedule or PollSchedule.from_env()
+        self.stats = RunWaiterStats()
+
+    async def run(self, client, thread_id: str, assistant_id: str,
+                  is_disconnected: Optional[IsDisconnected] = None,
+                  run_options: Optional[Dict] = None) -> RunWaitResult:
+        """
+        Crea una run sul thread e ne attende la conclusione.
+
+        Args:
+            client: Client AsyncOpenAI
+            thread_id: ID del thread
+            assistant_id: ID dell'assistente
+            is_disconnected: Coroutine opzionale che indica se il client HTTP si è disconnesso
+            run_options: Parametri aggiuntivi della run (es. additional_instructions, truncation_strategy)
+
+        Returns:
+            RunWaitResult con la run finale e lo stato (può essere STATUS_TIMEOUT o STATUS_DISCONNECTED)
+        """
+        start = time.monotonic()
+        result = await self._run(client, thread_id, assistant_id, is_disconnected, start, run_options or {})
+        self.stats.record(result)
+        observe_stage("run", result.elapsed)
+        record_run(result.status, result.polls)
+        logger.info(
+            f"Run {getattr(result.run, 'id', 'N/A')} terminata con stato {result.status} "
+            f"dopo {result.polls} poll in {result.elapsed:.2f}s"
+        )
+        return result
+
+    @abstractmethod
+    async def _run(self, client, thread_id, assistant_id, is_disconnected, start, run_options) -> RunWaitResult:
+        """Crea la run e la attende; implementato da ciascuna strategia di attesa."""
+
+    async def _cancel(self, client, thread_id: str, run_id: str, reason: str):
+        await cancel_run(client, thread_id, run_id, reason)
+
+class PollingRunWaiter(RunWaiter):
+    """Attende la run con polling adattivo su runs.retrieve."""
+
+    async def _run(self, client, thread_id, assistant_id, is_disconnected, start, run_options) -> RunWaitResult:
+        with stage("run_create"):
+            run = await client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                **run_options
+            )
+        logger.info(f"Run created with ID: {run.id}")
+
+        deadline = start + self.schedule.deadline
+        polls = 0
+        intervals = self.schedule.intervals()
+
+        while run.status not in TERMINAL_STATUSES:
+            if is_disconnected and await is_disconnected():
+                await self._cancel(client, thread_id, run.id, "client disconnesso")
+                return RunWaitResult(run, STATUS_DISCONNECTED, polls, time.monotonic() - start)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                await self._cancel(client, thread_id, run.id, "timeout")
+                return RunWaitResult(run, STATUS_TIMEOUT, polls, time.monotonic() - start)
+
+            await asyncio.sleep(min(next(intervals), remaining))
+            with stage("run_poll"):
+                run = await client.beta.threads.runs.retrieve(
+                    thread_id=thread_id,
+                    run_id=run.id
+                )
+            polls += 1
+            logger.debug(f"Run status: {run.status} (poll {polls})")
+
+        return RunWaitResult(run, run.status, polls, time.monotonic() - start)
+
+class StreamingRunWaiter(RunWaiter):
+    """Attende la run consumando lo stream di eventi: nessun poll, si sblocca appena la run finisce."""
+
+    async def _run(self, client, thread_id, assistant_id, is_disconnected, start, run_options) -> RunWaitResult:
+        run = None
+
+        async def consume():
+            nonlocal run
+            async with client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                **run_options
+            ) as stream:
+                async for event in stream:
+                    if event.event.startswith("thread.run."):
+                        run = event.data
+                    if is_disconnected and await is_disconnected():
+                        return STATUS_DISCONNECTED
+            return run.status if run else "failed"
+
+        try:
+            status = await asyncio.wait_for(consume(), timeout=self.schedule.deadline)
+        except asyncio.TimeoutError:
+            status = STATUS_TIMEOUT
+
+        if status in (STATUS_TIMEOUT, STATUS_DISCONNECTED) and run is not None:
+            await self._cancel(client, thread_id, run.id, status)
+
+        return RunWaitResult(run, status, 0, time.monotonic() - start)
+
+def create_run_waiter(kind: Optional[str] = None) -> RunWaiter:
+    """
+    Crea il waiter configurato.
+
+    Args:
+        kind: 'polling' o 'streaming' (default: variabile d'ambiente RUN_WAITER, poi 'polling')
+    """
+    kind = (kind or os.getenv('RUN_WAITER', 'polling')).lower()
+    if kind == 'streaming':
+        return StreamingRunWaiter()
+    if kind != 'polling':
+        logger.warning(f"RUN_WAITER '{kind}' non riconosciuto, uso 'polling'")
+    return PollingRunWaiter()
@@ -0,0 +1,305 @@
+"""
+Backend di stato condiviso per rate limiting e cache.
+
+Con più worker uvicorn o più repliche su Railway lo stato in memoria è per processo:
+il limite effettivo di richieste si moltiplica per il numero di processi e ogni worker
+ha le cache fredde. Questo modulo astrae lo stato dietro un backend configurabile:
+
+- InMemoryStateBackend: stato nel processo (default, nessuna dipendenza)
+- RedisStateBackend: stato su un server Redis (o compatibile) condiviso da tutti i processi;
+  il rate limiter è uno script Lua eseguito in modo atomico sul server e gli aggiornamenti
+  lettura-modifica-scrittura (update) sono transazioni WATCH/MULTI/EXEC
+
+Configurazione:
+    STATE_BACKEND=memory|redis
+    REDIS_URL=redis://localhost:6379/0
+    STATE_KEY_PREFIX=chatbot:
+
+Il client Redis è sincrono: dagli handler async le chiamate che toccano lo stato passano
+da run_state_call, che con un backend condiviso le esegue in un thread.
+
+Per i test senza Redis si può usare fake_redis_server.py.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+
+from rate_limiter import SlidingWindowRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Carica variabili d'ambiente (anche quando il modulo è importato da upload_pdf.py)
+load_dotenv('.env.local')
+load_dotenv()
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+STATE_KEY_PREFIX = os.getenv('STATE_KEY_PREFIX', 'chatbot:')
+
+# Limiti nel formato di SlidingWindowRateLimiter: (finestra in secondi, richieste massime, messaggio)
+Limits = Sequence[Tuple[float, int, str]]
+
+class InMemoryStateBackend:
+    """Stato nel processo corrente: valori con TTL (LRU limitata) e rate limiter locale."""
+
+    name = "memory"
+    # Lo stato non è visibile agli altri processi
+    shared = False
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._values: "OrderedDict[str, Tuple[Optional[float], bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def rate_limiter(self, limits: Limits, max_keys: int = 100_000) -> SlidingWindowRateLimiter:
+        return SlidingWindowRateLimiter(limits, max_keys=max_keys)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._values[key] = (expires_at, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]],
+               ttl: Optional[float] = None) -> Optional[bytes]:
+        """
+        Legge, trasforma e riscrive un valore in modo atomico rispetto agli altri thread.
+
+        Args:
+            func: Riceve il valore corrente (None se manca) e restituisce il nuovo valore
+                (None per non scrivere nulla); può essere chiamata più di una volta
+            ttl: Durata del nuovo valore in secondi
+
+        Returns:
+            Il valore scritto, oppure None
+        """
+        with self._lock:
+            entry = self._values.get(key)
+            current = None
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                current = entry[1]
+            value = func(current)
+            if value is not None:
+                self._values[key] = (time.monotonic() + ttl if ttl else None, value)
+                self._values.move_to_end(key)
+                while len(self._values) > self.max_entries:
+                    self._values.popitem(last=False)
+            return value
+
+    def delete(self, key: str):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"backend": self.name, "shared": self.shared, "entries": len(self._values)}
+
+# Sliding window counter atomico: stessa logica di SlidingWindowRateLimiter.check.
+# KEYS[1] = hash dell'identificatore con i campi s<i> (inizio finestra), c<i> (corrente), p<i> (precedente)
+# ARGV = numero di finestre, poi per ogni finestra durata in secondi e richieste massime.
+# Restituisce 0 se la richiesta è permessa, altrimenti l'indice (da 1) della finestra superata.
+# Il tempo è quello del server Redis, quindi è lo stesso per tutte le repliche.
+# La chiave scade dopo due finestre: fino ad allora il contatore precedente pesa ancora nella stima.
+RATE_LIMIT_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local n = tonumber(ARGV[1])
+local longest = 0
+local updates = {}
+for i = 1, n do
+  local window = tonumber(ARGV[2 * i])
+  local limit = tonumber(ARGV[2 * i + 1])
+  if window > longest then longest = window end
+  local v = redis.call('HMGET', KEYS[1], 's' .. i, 'c' .. i, 'p' .. i)
+  local start = tonumber(v[1]) or 0
+  local cur = tonumber(v[2]) or 0
+  local prev = tonumber(v[3]) or 0
+  local elapsed = now - start
+  if elapsed >= window then
+    if elapsed < 2 * window then
+      prev = cur
+      start = start + window
+    else
+      prev = 0
+      start = now
+    end
+    cur = 0
+    elapsed = now - start
+  end
+  if prev * (1 - elapsed / window) + cur >= limit then
+    return i
+  end
+  updates[i] = {start, cur, prev}
+end
+for i = 1, n do
+  local u = updates[i]
+  redis.call('HSET', KEYS[1], 's' .. i, string.format('%.6f', u[1]), 'c' .. i, u[2] + 1, 'p' .. i, u[3])
+end
+redis.call('EXPIRE', KEYS[1], math.ceil(2 * longest))
+return 0
+"""
+
+class RedisRateLimiter:
+    """
+    Rate limiter condiviso su Redis. Ogni controllo è una sola chiamata allo script Lua,
+    quindi lettura e aggiornamento dei contatori sono atomici anche con molte repliche.
+    Le chiavi inattive scadono da sole (EXPIRE pari a due volte la finestra più lunga).
+
+    Se Redis non risponde si ripiega su un limiter locale, così il servizio resta
+    disponibile con limiti per processo invece di bloccare tutte le richieste.
+    """
+
+    def __init__(self, client, limits: Limits, prefix: str, max_keys: int = 100_000):
+        self.client = client
+        self.limits = list(limits)
+        self.prefix = prefix
+        self._script = client.register_script(RATE_LIMIT_SCRIPT)
+        self._args = [len(self.limits)]
+        for window, max_requests, _ in self.limits:
+            self._args += [window, max_requests]
+        self._fallback = SlidingWindowRateLimiter(limits, max_keys=max_keys)
+        self.fallbacks = 0
+
+    def check(self, identifier: str) -> Tuple[bool, Optional[str]]:
+        try:
+            violated = int(self._script(keys=[f"{self.prefix}rl:{identifier}"], args=self._args))
+        except Exception as e:
+            self.fallbacks += 1
+            logger.warning(f"Rate limiter Redis non disponibile, uso il limiter locale: {e}")
+            return self._fallback.check(identifier)
+        if violated:
+            return False, self.limits[violated - 1][2]
+        return True, None
+
+    def stats(self) -> Dict:
+        return {"backend": "redis", "fallbacks": self.fallbacks, "local_fallback": self._fallback.stats()}
+
+class RedisStateBackend:
+    """Stato su Redis, condiviso tra worker e repliche."""
+
+    name = "redis"
+    shared = True
+
+    def __init__(self, client, prefix: str = STATE_KEY_PREFIX):
+        self.client = client
+        self.prefix = prefix
+        self.errors = 0
+
+    @classmethod
+    def from_url(cls, url: str = REDIS_URL, prefix: str = STATE_KEY_PREFIX) -> "RedisStateBackend":
+        import redis
+        client = redis.Redis.from_url(url, socket_timeout=1.0, socket_connect_timeout=1.0)
+        return cls(client, prefix)
+
+    def rate_limiter(self, limits: Limits, max_keys: int = 100_000) -> RedisRateLimiter:
+        return RedisRateLimiter(self.client, limits, self.prefix, max_keys=max_keys)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get(self.prefix + key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Errore lettura da Redis ({key}): {e}")
+            return None
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        try:
+            if ttl:
+                self.client.set(self.prefix + key, value, px=int(ttl * 1000))
+            else:
+                self.client.set(self.prefix + key, value)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Errore scrittura su Redis ({key}): {e}")
+
+    def update(self, key: str, func: Callable[[Optional[bytes]], Optional[bytes]],
+               ttl: Optional[float] = None) -> Optional[bytes]:
+        """
+        Come InMemoryStateBackend.update, con una transazione WATCH/MULTI/EXEC: se un altro
+        processo modifica la chiave tra la lettura e la scrittura, la transazione viene ripetuta.
+        """
+        full_key = self.prefix + key
+
+        def transaction(pipe):
+            value = func(pipe.get(full_key))
+            if value is not None:
+                pipe.multi()
+                if ttl:
+                    pipe.set(full_key, value, px=int(ttl * 1000))
+                else:
+                    pipe.set(full_key, value)
+            return value
+
+        try:
+            return self.client.transaction(transaction, full_key, value_from_callable=True)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Errore aggiornamento su Redis ({key}): {e}")
+            return None
+
+    def delete(self, key: str):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Errore cancellazione su Redis ({key}): {e}")
+
+    def stats(self) -> Dict:
+        return {"backend": self.name, "shared": self.shared, "errors": self.errors}
+
+_state_backend = None
+_state_backend_lock = threading.Lock()
+
+def create_state_backend(kind: Optional[str] = None):
+    """Crea il backend indicato da `kind` (default: variabile STATE_BACKEND)."""
+    kind = (kind or STATE_BACKEND).lower()
+    if kind == 'redis':
+        logger.info(f"Backend di stato: Redis ({STATE_KEY_PREFIX}*)")
+        return RedisStateBackend.from_url(REDIS_URL, STATE_KEY_PREFIX)
+    if kind != 'memory':
+        logger.warning(f"STATE_BACKEND '{kind}' non valido, uso 'memory'")
+    return InMemoryStateBackend()
+
+def get_state_backend():
+    """Restituisce il backend di stato del processo (creato alla prima chiamata)."""
+    global _state_backend
+    if _state_backend is None:
+        with _state_backend_lock:
+            if _state_backend is None:
+                _state_backend = create_state_backend()
+    return _state_backend
+
+def set_state_backend(backend):
+    """Imposta il backend di stato (test e benchmark)."""
+    global _state_backend
+    _state_backend = backend
+
+async def run_state_call(func, *args):
+    """
+    Esegue `func(*args)` (una funzione che legge o scrive lo stato) da codice async senza bloccare
+    l'event loop: con un backend condiviso ogni chiamata è un round trip di rete (fino al socket
+    timeout se Redis non risponde) e va in un thread; in memoria si esegue direttamente.
+    """
+    if get_state_backend().shared:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
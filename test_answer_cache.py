@@ -0,0 +1,122 @@
+"""
+Test unitari della cache semantica delle risposte (answer_cache.py), anche con le voci
+condivise tra processi sul backend di stato (in memoria e sul Redis finto).
+
+    python -m pytest -q test_answer_cache.py
+"""
+
+import math
+import time
+import socket
+
+import answer_cache
+from answer_cache import AnswerCache, SharedAnswerStore, bump_corpus_version
+from fake_redis_server import run_in_thread
+from state_backend import InMemoryStateBackend, RedisStateBackend
+
+def _unit(degrees: float):
+    return [math.cos(math.radians(degrees)), math.sin(math.radians(degrees))]
+
+def _cache(tmp_path, **kwargs) -> AnswerCache:
+    return AnswerCache(version_path=str(tmp_path / "corpus_version"), **kwargs)
+
+def _workers(tmp_path, backend, count: int = 2, max_size: int = 500):
+    # Processi diversi con lo stesso backend: ognuno ha la sua copia locale delle voci
+    return [_cache(tmp_path, max_size=max_size, version_check_interval=0,
+                   shared=SharedAnswerStore(backend, ttl=3600, max_size=max_size)) for _ in range(count)]
+
+def test_hit_above_threshold_and_miss_below(tmp_path):
+    cache = _cache(tmp_path, threshold=0.95)
+    cache.store("Cos'è DataClinic?", [1.0, 0.0], "Una società di analisi dati.")
+    assert cache.lookup([0.99, 0.05])[0] == "Una società di analisi dati."
+    assert cache.lookup([0.0, 1.0]) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_expired_best_match_falls_back_to_next_valid_entry(tmp_path):
+    # Domande a 0° e 25°, query a 10°: la prima è la più simile, la seconda resta sopra soglia
+    cache = _cache(tmp_path, threshold=math.cos(math.radians(20)))
+    cache.store("domanda vicina", _unit(0), "risposta scaduta")
+    cache.store("domanda simile", _unit(25), "risposta valida")
+    expired_key = next(k for k, e in cache._entries.items() if e.answer == "risposta scaduta")
+    cache._entries[expired_key].expires_at = time.time() - 1
+    cache._matrix = None
+
+    answer, similarity = cache.lookup(_unit(10))
+    assert answer == "risposta valida"
+    assert similarity >= cache.threshold
+    assert cache.stats()["size"] == 1
+
+def test_store_replaces_equivalent_question(tmp_path):
+    cache = _cache(tmp_path, threshold=0.95)
+    cache.store("Orari?", [1.0, 0.0], "Dalle 9 alle 18")
+    cache.store("Quali sono gli orari?", [0.99, 0.01], "Dalle 9 alle 19")
+    assert cache.stats()["size"] == 1
+    assert cache.lookup([1.0, 0.0])[0] == "Dalle 9 alle 19"
+
+    cache.store("Dove siete?", [0.0, 1.0], "A Milano")
+    assert cache.stats()["size"] == 2
+
+def test_lru_eviction(tmp_path):
+    cache = _cache(tmp_path, threshold=0.99, max_size=2)
+    cache.store("a", [1.0, 0.0, 0.0], "A")
+    cache.store("b", [0.0, 1.0, 0.0], "B")
+    cache.lookup([1.0, 0.0, 0.0])
+    cache.store("c", [0.0, 0.0, 1.0], "C")
+    assert cache.lookup([0.0, 1.0, 0.0]) is None
+    assert cache.lookup([1.0, 0.0, 0.0])[0] == "A"
+
+def test_corpus_version_is_read_outside_the_lock(tmp_path, monkeypatch):
+    cache = _cache(tmp_path, version_check_interval=0)
+    cache.store("a", [1.0, 0.0], "A")
+    calls = []
+
+    def read_version(path):
+        calls.append(cache._lock.locked())
+        return "nuova-versione"
+
+    monkeypatch.setattr(answer_cache, "read_corpus_version", read_version)
+    assert cache.lookup([1.0, 0.0]) is None
+    assert calls and not any(calls)
+    assert cache.stats()["invalidations"] == 1
+
+def test_shared_entries_reach_the_other_workers(tmp_path):
+    first, second = _workers(tmp_path, InMemoryStateBackend())
+    first.store("Orari?", [1.0, 0.0], "Dalle 9 alle 18")
+    assert second.lookup([1.0, 0.0])[0] == "Dalle 9 alle 18"
+
+    # Una risposta sostituita da un worker sostituisce anche la copia degli altri
+    second.store("Quali sono gli orari?", [0.99, 0.01], "Dalle 9 alle 19")
+    assert first.lookup([1.0, 0.0])[0] == "Dalle 9 alle 19"
+    assert first.stats()["size"] == second.stats()["size"] == 1
+
+def test_shared_index_keeps_max_size_entries(tmp_path):
+    first, second = _workers(tmp_path, InMemoryStateBackend(), max_size=2)
+    first.store("a", [1.0, 0.0, 0.0], "A")
+    second.store("b", [0.0, 1.0, 0.0], "B")
+    first.store("c", [0.0, 0.0, 1.0], "C")
+    assert second.lookup([1.0, 0.0, 0.0]) is None
+    assert second.lookup([0.0, 0.0, 1.0])[0] == "C"
+    assert second.stats()["size"] == 2
+
+def test_shared_entries_are_dropped_when_the_corpus_changes(tmp_path):
+    first, second = _workers(tmp_path, InMemoryStateBackend())
+    first.store("a", [1.0, 0.0], "A")
+    bump_corpus_version(str(tmp_path / "corpus_version"))
+    assert second.lookup([1.0, 0.0]) is None
+    assert first.lookup([1.0, 0.0]) is None
+
+def test_shared_entries_on_redis(tmp_path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = run_in_thread(port=port)
+    try:
+        backends = [RedisStateBackend.from_url(f"redis://127.0.0.1:{port}/0", prefix="test:") for _ in range(2)]
+        first, second = (_cache(tmp_path, version_check_interval=0, shared=SharedAnswerStore(backend, 3600, 500))
+                         for backend in backends)
+        first.store("Dove siete?", [0.0, 1.0], "A Milano")
+        answer, similarity = second.lookup([0.0, 1.0])
+        assert answer == "A Milano" and similarity > 0.99
+        assert backends[0].errors == backends[1].errors == 0
+    finally:
+        server.stop()
@@ -0,0 +1,85 @@
+"""
+Test unitari della costruzione del contesto (context_builder.py): soglia di score, unione dei
+chunk sovrapposti, budget di token e statistiche. I token sono stimati (4 caratteri per
+token) per non dipendere dall'encoding di tiktoken.
+
+    python -m pytest -q test_context_builder.py
+"""
+
+from context_builder import (
+    CONTEXT_FOOTER, CONTEXT_HEADER, ContextBuilder, TokenCounter, format_block, merge_overlapping,
+)
+
+def _estimating_counter() -> TokenCounter:
+    counter = TokenCounter()
+    counter._loaded = True  # nessun encoding: stima per caratteri
+    return counter
+
+def _builder(max_tokens: int, min_score: float = 0.2) -> ContextBuilder:
+    return ContextBuilder(max_tokens=max_tokens, min_score=min_score, token_counter=_estimating_counter())
+
+def _chunk(text: str, score: float, source: str = "doc.pdf") -> dict:
+    return {"text": text, "score": score, "source": source}
+
+def _overhead(counter: TokenCounter) -> int:
+    return counter.count(CONTEXT_HEADER) + counter.count(CONTEXT_FOOTER)
+
+BASE = ("DataClinic analizza i dati clinici delle strutture sanitarie italiane. " * 2).strip()
+TAIL = BASE[-60:] + " I report vengono consegnati ogni mese ai responsabili di reparto."
+
+def test_merge_overlapping_in_both_orders():
+    merged = merge_overlapping(BASE, TAIL)
+    assert merged == BASE + TAIL[60:]
+    assert merge_overlapping(TAIL, BASE) == merged
+    assert merge_overlapping(BASE, "testo senza alcuna sovrapposizione con il primo chunk, lungo abbastanza") is None
+
+def test_chunks_below_min_score_are_dropped():
+    result = _builder(1000).build([_chunk("A" * 100, 0.9), _chunk("B" * 100, 0.1)])
+    assert len(result.passages) == 1
+    assert result.below_min_score == 1
+    assert result.candidates == 2
+
+def test_overlapping_chunks_are_merged_into_one_passage():
+    result = _builder(1000).build([_chunk(BASE, 0.9), _chunk(TAIL, 0.8)])
+    assert len(result.passages) == 1
+    assert result.passages[0]["text"] == BASE + TAIL[60:]
+    assert result.merged == 1
+    assert result.over_budget == 0
+
+def test_chunk_contained_in_passage_counts_as_merged():
+    result = _builder(1000).build([_chunk(BASE, 0.9), _chunk(BASE[10:90], 0.8)])
+    assert len(result.passages) == 1
+    assert result.merged == 1
+
+def test_merge_over_budget_counts_only_as_over_budget():
+    counter = _estimating_counter()
+    budget = _overhead(counter) + counter.count(format_block("doc.pdf", BASE)) + 2
+    result = _builder(budget).build([_chunk(BASE, 0.9), _chunk(TAIL, 0.8)])
+    assert result.passages[0]["text"] == BASE
+    assert result.merged == 0
+    assert result.over_budget == 1
+
+def test_passages_added_by_score_within_budget():
+    counter = _estimating_counter()
+    block = counter.count(format_block("a.pdf", "x" * 200))
+    budget = _overhead(counter) + 2 * block
+    chunks = [_chunk("x" * 200, 0.5, "a.pdf"), _chunk("y" * 200, 0.9, "b.pdf"),
+              _chunk("z" * 400, 0.7, "c.pdf"), _chunk("w" * 200, 0.6, "d.pdf")]
+    result = _builder(budget).build(chunks)
+    assert [p["source"] for p in result.passages] == ["b.pdf", "d.pdf"]
+    assert result.over_budget == 2
+    assert result.tokens <= budget
+    assert result.text.startswith(CONTEXT_HEADER) and result.text.endswith(CONTEXT_FOOTER)
+
+def test_best_chunk_larger_than_budget_is_truncated():
+    counter = _estimating_counter()
+    budget = _overhead(counter) + 40
+    result = _builder(budget).build([_chunk("x" * 2000, 0.9)])
+    assert result.truncated
+    assert len(result.passages) == 1
+    assert result.tokens <= budget
+
+def test_no_chunks_gives_empty_context():
+    result = _builder(1000).build([])
+    assert result.text == ""
+    assert result.tokens == 0
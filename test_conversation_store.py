@@ -0,0 +1,197 @@
+"""
+Test unitari dell'archivio delle conversazioni (conversation_store.py): finestra dei messaggi,
+soglia del riassunto, token per thread, scadenza e limiti dei thread. Il riassunto usa un
+client OpenAI finto in memoria; l'archivio condiviso usa il backend di stato in memoria.
+
+    python -m pytest -q test_conversation_store.py
+"""
+
+import asyncio
+import time
+import socket
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from conversation_store import ConversationMemory, SharedConversationStore, SQLiteConversationStore
+from fake_redis_server import run_in_thread
+from state_backend import InMemoryStateBackend, RedisStateBackend
+
+class FakeCompletions:
+    """chat.completions.create: restituisce un riassunto fisso e conta le chiamate."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Riassunto della conversazione"))],
+            usage=SimpleNamespace(prompt_tokens=50, completion_tokens=10),
+        )
+
+def _client(completions: FakeCompletions):
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+@pytest.fixture
+def redis_url():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = run_in_thread(port=port)
+    yield f"redis://127.0.0.1:{port}/0"
+    server.stop()
+
+@pytest.fixture(params=["sqlite", "state", "redis"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite"))
+    elif request.param == "state":
+        store = SharedConversationStore(InMemoryStateBackend())
+    else:
+        store = SharedConversationStore(RedisStateBackend.from_url(request.getfixturevalue("redis_url"), prefix="test:"))
+    yield store
+    store.close()
+
+def _memory(store, window: int = 4, batch: int = 2) -> ConversationMemory:
+    return ConversationMemory(store, window_messages=window, summary_batch=batch)
+
+def _turns(memory: ConversationMemory, thread_id: str, count: int, start: int = 0):
+    for i in range(start, start + count):
+        memory.record_exchange(thread_id, f"domanda {i}", f"risposta {i}", context=f"contesto {i}")
+
+def test_history_is_limited_to_window_plus_batch(store):
+    memory = _memory(store)
+    thread_id = memory.create()
+    _turns(memory, thread_id, 5)
+    conversation = memory.load(thread_id)
+    assert conversation.stored
+    assert [m['content'] for m in conversation.messages] == [
+        "domanda 2", "risposta 2", "domanda 3", "risposta 3", "domanda 4", "risposta 4",
+    ]
+    # Il contesto non fa parte della cronologia inviata al modello
+    assert memory.history_messages(conversation)[0] == {"role": "user", "content": "domanda 2"}
+
+def test_history_starts_with_a_question(store):
+    memory = _memory(store, window=3, batch=0)
+    thread_id = memory.create()
+    _turns(memory, thread_id, 3)
+    assert [m['role'] for m in memory.load(thread_id).messages] == ["user", "assistant"]
+
+def test_summary_waits_for_a_full_batch(store):
+    memory = _memory(store)
+    completions = FakeCompletions()
+    thread_id = memory.create()
+    _turns(memory, thread_id, 2)
+    assert asyncio.run(memory.summarize(_client(completions), thread_id)) is False
+    assert completions.calls == []
+
+    _turns(memory, thread_id, 1, start=2)
+    assert asyncio.run(memory.summarize(_client(completions), thread_id)) is True
+    conversation = memory.load(thread_id)
+    assert conversation.summary == "Riassunto della conversazione"
+    assert [m['content'] for m in conversation.messages] == ["domanda 1", "risposta 1", "domanda 2", "risposta 2"]
+    assert "domanda 0" in completions.calls[0]["messages"][1]["content"]
+    usage = memory.usage(thread_id)
+    assert usage["summary_prompt_tokens"] == 50 and usage["summary_completion_tokens"] == 10
+    assert usage["unsummarized_messages"] == 4
+
+def test_summary_is_scheduled_only_when_the_turn_completes_a_batch(store):
+    memory = _memory(store, window=4, batch=4)
+    completions = FakeCompletions()
+    thread_id = memory.create()
+    scheduled = []
+    for i in range(8):
+        needed = memory.needs_summary(memory.load(thread_id))
+        scheduled.append(needed)
+        _turns(memory, thread_id, 1, start=i)
+        if needed:
+            assert asyncio.run(memory.summarize(_client(completions), thread_id)) is True
+    assert scheduled == [False, False, False, True, False, True, False, True]
+    assert len(completions.calls) == 3
+    assert not memory.needs_summary(memory.load("thread_sconosciuto"))
+
+def test_usage_is_summed_per_thread(store):
+    memory = _memory(store)
+    thread_id = memory.create()
+    memory.record_usage(thread_id, SimpleNamespace(prompt_tokens=100, completion_tokens=20))
+    memory.record_usage(thread_id, SimpleNamespace(prompt_tokens=80, completion_tokens=30))
+    usage = memory.usage(thread_id)
+    assert usage["turns"] == 2
+    assert usage["prompt_tokens"] == 180 and usage["completion_tokens"] == 50
+    assert usage["last_prompt_tokens"] == 80
+    assert usage["total_tokens"] == 230
+
+def test_unknown_thread_is_not_created(store):
+    memory = _memory(store)
+    memory.record_exchange("thread_sconosciuto", "domanda", "risposta")
+    memory.record_usage("thread_sconosciuto", SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+    assert memory.usage("thread_sconosciuto") is None
+    assert memory.load("thread_sconosciuto").stored is False
+
+def test_sqlite_threads_expire_after_ttl(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite"), ttl=60)
+    memory = _memory(store)
+    thread_id = memory.create()
+    _turns(memory, thread_id, 2)
+    store._conn.execute("UPDATE threads SET updated_at = ?", (time.time() - 120,))
+    assert memory.load(thread_id).stored is False
+    memory.record_exchange(thread_id, "domanda", "risposta")
+    assert memory.usage(thread_id) is None
+
+    # I thread scaduti vengono rimossi, con i messaggi, alla creazione dei nuovi
+    store._next_prune = 0
+    memory.create()
+    assert store.stats()["threads"] == 1
+    assert store.stats()["messages"] == 0
+    assert store.stats()["expired"] == 1
+    store.close()
+
+def test_sqlite_least_recently_used_threads_are_evicted(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite"), max_threads=10)
+    memory = _memory(store)
+    threads = [memory.create() for _ in range(10)]
+    for i, thread_id in enumerate(threads):
+        store._conn.execute("UPDATE threads SET updated_at = ? WHERE thread_id = ?", (time.time() - 100 + i, thread_id))
+    memory.record_exchange(threads[0], "domanda", "risposta")
+    memory.create()
+    assert store.stats()["threads"] == 9
+    assert store.stats()["evicted"] == 2
+    assert memory.load(threads[0]).stored
+    assert not memory.load(threads[1]).stored and not memory.load(threads[2]).stored
+    store.close()
+
+def test_first_turn_only_without_history_or_summary(store):
+    memory = _memory(store)
+    thread_id = memory.create()
+    assert memory.is_first_turn(memory.load(thread_id))
+    _turns(memory, thread_id, 1)
+    assert not memory.is_first_turn(memory.load(thread_id))
+    assert not memory.is_first_turn(memory.load("thread_sconosciuto"))
+
+def test_concurrent_writes_to_a_shared_thread_are_not_lost(redis_url):
+    # Due repliche sullo stesso Redis: i turni e il riassunto in background dello stesso thread
+    # si sovrappongono, ma nessuna scrittura cancella quelle degli altri
+    memories = [_memory(SharedConversationStore(RedisStateBackend.from_url(redis_url, prefix="test:")))
+                for _ in range(2)]
+    thread_id = memories[0].create()
+
+    def turns(memory, worker):
+        for i in range(20):
+            memory.record_exchange(thread_id, f"domanda {worker}.{i}", f"risposta {worker}.{i}")
+            memory.record_usage(thread_id, SimpleNamespace(prompt_tokens=10, completion_tokens=1))
+
+    workers = [threading.Thread(target=turns, args=(memories[i % 2], i)) for i in range(4)]
+    for worker in workers:
+        worker.start()
+    while len(memories[1].store.load(thread_id).messages) < 10:
+        time.sleep(0.001)
+    memories[1].store.set_summary(thread_id, "Riassunto", 10)
+    for worker in workers:
+        worker.join()
+
+    usage = memories[0].usage(thread_id)
+    assert usage["turns"] == 80 and usage["prompt_tokens"] == 800
+    assert usage["unsummarized_messages"] == 160 - 10
+    assert memories[1].load(thread_id).summary == "Riassunto"
@@ -0,0 +1,56 @@
+"""
+Test unitari della cache degli embedding (embedding_cache.py): chiavi condivise con
+l'ingestion e aggiornamenti di last_used accumulati.
+
+    python -m pytest -q test_embedding_cache.py
+"""
+
+import asyncio
+
+from embedding_cache import EmbeddingCache, SQLiteEmbeddingStore, text_hash
+
+MODEL = "text-embedding-3-small"
+
+def test_query_cache_reads_embeddings_stored_by_ingestion(tmp_path):
+    store = SQLiteEmbeddingStore(str(tmp_path / "emb.sqlite"))
+    # upload_pdf.py salva per text_hash del testo del chunk
+    store.set_many(MODEL, {text_hash("Cos'è DataClinic?"): [0.5, 0.25]})
+    cache = EmbeddingCache(store=store)
+    assert asyncio.run(cache.aget(MODEL, "Cos'è DataClinic?")) == [0.5, 0.25]
+    assert cache.stats()["persistent_hits"] == 1
+    store.close()
+
+def test_query_embeddings_are_visible_to_ingestion(tmp_path):
+    store = SQLiteEmbeddingStore(str(tmp_path / "emb.sqlite"))
+    cache = EmbeddingCache(store=store)
+    asyncio.run(cache.aset(MODEL, "Orari di apertura", [1.0, 2.0]))
+    assert store.get_many(MODEL, [text_hash("Orari di apertura")]) == {text_hash("Orari di apertura"): [1.0, 2.0]}
+    store.close()
+
+def test_last_used_updates_are_batched(tmp_path):
+    path = str(tmp_path / "emb.sqlite")
+    store = SQLiteEmbeddingStore(path)
+    store.set(MODEL, "k", [1.0])
+    (created,), = store._conn.execute("SELECT last_used FROM embeddings").fetchall()
+    store._last_touch_flush = float("inf")  # nessun flush per tempo durante il test
+    for _ in range(store.TOUCH_BATCH - 1):
+        store.get(MODEL, "k")
+    (used,), = store._conn.execute("SELECT last_used FROM embeddings").fetchall()
+    assert used == created
+    store.get(MODEL, "k")
+    (used,), = store._conn.execute("SELECT last_used FROM embeddings").fetchall()
+    assert used > created
+    store.close()
+
+def test_pending_touches_are_written_on_close(tmp_path):
+    path = str(tmp_path / "emb.sqlite")
+    store = SQLiteEmbeddingStore(path)
+    store.set(MODEL, "k", [1.0])
+    (created,), = store._conn.execute("SELECT last_used FROM embeddings").fetchall()
+    store.get(MODEL, "k")
+    store.close()
+    reopened = SQLiteEmbeddingStore(path)
+    (used,), = reopened._conn.execute("SELECT last_used FROM embeddings").fetchall()
+    assert used >= created
+    assert not reopened._touches
+    reopened.close()
@@ -0,0 +1,36 @@
+"""
+Test unitari della valutazione del retrieval (eval_retrieval.py) con un backend finto:
+l'insieme di domande di esempio è valido e le metriche sono calcolate sulle etichette.
+
+    python -m pytest -q test_eval_retrieval.py
+"""
+
+from eval_retrieval import DEFAULT_QUESTIONS, is_relevant, load_questions, run_evaluation
+
+class FakeBackend:
+    """Restituisce sempre gli stessi contesti: uno irrilevante e poi quello giusto."""
+
+    def embed_query(self, question):
+        return [0.0]
+
+    def search(self, question, embedding, top_k, filters=None):
+        contexts = [{"text": "Orari di apertura", "source": "altro.pdf"},
+                    {"text": "DataClinic offre servizi di analisi dei dati clinici", "source": "dataclinic.pdf"}]
+        return contexts[:top_k]
+
+def test_sample_questions_are_valid():
+    questions = load_questions(DEFAULT_QUESTIONS)
+    assert len(questions) >= 10
+    assert all(item["source"] == "dataclinic.pdf" for item in questions)
+
+def test_relevance_needs_source_and_one_of_the_strings():
+    item = {"question": "Servizi?", "source": "dataclinic.pdf", "contains": ["SERVIZI", "offerta"]}
+    assert is_relevant({"text": "I servizi di DataClinic", "source": "dataclinic.pdf"}, item)
+    assert not is_relevant({"text": "I servizi di DataClinic", "source": "altro.pdf"}, item)
+    assert not is_relevant({"text": "Orari", "source": "dataclinic.pdf"}, item)
+
+def test_hit_rate_and_mrr_per_top_k():
+    questions = [{"question": "Servizi?", "source": "dataclinic.pdf", "contains": ["servizi"]}]
+    results = {r["top_k"]: r for r in run_evaluation({"dense": FakeBackend()}, questions, [1, 2])}
+    assert results[1]["hit_rate"] == 0.0
+    assert results[2]["hit_rate"] == 1.0 and results[2]["mrr"] == 0.5
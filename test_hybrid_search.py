@@ -0,0 +1,61 @@
+"""
+Test unitari della ricerca ibrida (hybrid_search.py): Reciprocal Rank Fusion dei risultati
+densi e sparsi, tokenizzazione e vettori sparsi in stile BM25.
+
+    python -m pytest -q test_hybrid_search.py
+"""
+
+import pytest
+
+from hybrid_search import (
+    encode_document, encode_query, reciprocal_rank_fusion, rrf_fusion_fn, token_index, tokenize,
+)
+
+def test_rrf_scores_are_sum_of_reciprocal_ranks():
+    fused = dict(reciprocal_rank_fusion([["a", "b"], ["b", "c"]], top_k=10, k=60))
+    assert fused["a"] == pytest.approx(1 / 61)
+    assert fused["b"] == pytest.approx(1 / 62 + 1 / 61)
+    assert fused["c"] == pytest.approx(1 / 62)
+
+def test_rrf_prefers_results_found_by_both_branches():
+    dense = ["solo_denso", "x1", "entrambi"]
+    sparse = ["solo_sparso", "x2", "entrambi"]
+    fused = reciprocal_rank_fusion([dense, sparse], top_k=3)
+    assert fused[0][0] == "entrambi"
+    assert [key for key, _ in fused[1:]] == ["solo_denso", "solo_sparso"]
+
+def test_rrf_limits_to_top_k_and_handles_empty_rankings():
+    assert len(reciprocal_rank_fusion([list("abcdef"), list("ghijkl")], top_k=4)) == 4
+    assert reciprocal_rank_fusion([[], []], top_k=3) == []
+    assert [key for key, _ in reciprocal_rank_fusion([["a", "b"], []], top_k=3)] == ["a", "b"]
+
+def test_rrf_fusion_fn_returns_nodes_in_fused_order():
+    from llama_index.core.schema import TextNode
+    from llama_index.core.vector_stores.types import VectorStoreQueryResult
+
+    a, b, c = (TextNode(id_=node_id, text=node_id) for node_id in "abc")
+    dense = VectorStoreQueryResult(nodes=[a, b], similarities=[0.9, 0.8], ids=["a", "b"])
+    sparse = VectorStoreQueryResult(nodes=[c, b], similarities=[7.0, 5.0], ids=["c", "b"])
+    result = rrf_fusion_fn(dense, sparse, top_k=2)
+    assert result.ids == ["b", "a"]
+    assert [node.node_id for node in result.nodes] == ["b", "a"]
+    assert result.similarities[0] == pytest.approx(1 / 62 + 1 / 62)
+
+def test_tokenize_drops_stopwords_and_accents():
+    # "perché" diventa "perche", che è una stopword; i numeri restano anche se di una cifra
+    assert tokenize("Perché la qualità dell'analisi è migliorata nel 2024?") == [
+        "qualita", "analisi", "migliorata", "2024",
+    ]
+    assert tokenize("Report 3 a Roma") == ["report", "3", "roma"]
+
+def test_query_vector_has_one_entry_per_distinct_token():
+    indices, values = encode_query("report report mensile")
+    assert indices == [token_index("report"), token_index("mensile")]
+    assert values == [1.0, 1.0]
+
+def test_document_weights_saturate_with_term_frequency():
+    indices, values = encode_document("report " * 3 + "mensile")
+    weights = dict(zip(indices, values))
+    assert weights[token_index("report")] > weights[token_index("mensile")]
+    # BM25: il peso cresce con le occorrenze ma resta sotto k1 + 1
+    assert weights[token_index("report")] < 2.2
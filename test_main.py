@@ -0,0 +1,100 @@
+"""
+Test degli endpoint di main.py senza servizi esterni: l'Assistants API è il server finto di
+fake_openai_server.py, l'archivio delle conversazioni è un file SQLite temporaneo e
+l'embedding delle domande è calcolato in locale (Qdrant non è configurato).
+
+    python -m pytest -q test_main.py
+"""
+
+import hashlib
+import socket
+
+import pytest
+from fastapi.testclient import TestClient
+from openai import AsyncOpenAI
+
+import fake_openai_server
+import metrics
+from answer_cache import AnswerCache
+from conversation_store import ConversationMemory, SQLiteConversationStore
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def _embedding(text: str):
+    # Stessa domanda, stesso vettore; domande diverse hanno vettori quasi ortogonali
+    digest = hashlib.sha256(text.lower().encode()).digest()
+    return [byte - 127.5 for byte in digest]
+
+@pytest.fixture(scope="module")
+def openai_url():
+    port = _free_port()
+    server = fake_openai_server.run_in_thread(port=port)
+    yield f"http://127.0.0.1:{port}/v1"
+    server.should_exit = True
+
+@pytest.fixture
+def app(openai_url, tmp_path, monkeypatch):
+    import main
+    import security
+
+    monkeypatch.setattr(fake_openai_server, "FAKE_LATENCY", 0.0)
+    monkeypatch.setattr(fake_openai_server, "FAKE_RUN_DURATION", 0.0)
+    monkeypatch.setattr(main, "OPENAI_API_KEY", "fake")
+    monkeypatch.setattr(main, "ASSISTANT_ID", "asst_fake")
+    monkeypatch.setattr(main, "WARMUP_ENABLED", False)
+    monkeypatch.setattr(main, "completions_chat", None)
+    monkeypatch.setattr(main, "client", AsyncOpenAI(api_key="fake", base_url=openai_url))
+    monkeypatch.setattr(main, "conversation_memory",
+                        ConversationMemory(SQLiteConversationStore(str(tmp_path / "conversations.sqlite"))))
+    monkeypatch.setattr(main, "ANSWER_CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "answer_cache", AnswerCache(version_path=str(tmp_path / "corpus_version")))
+    monkeypatch.setattr(main, "aget_query_embedding", _embedding)
+    monkeypatch.setattr(security, "_rate_limiter", security.create_rate_limiter(1000, 1000))
+    with TestClient(main.app) as client:
+        yield client
+
+def _ask(app, thread_id: str, message: str, answer: str, monkeypatch) -> dict:
+    monkeypatch.setattr(fake_openai_server, "FAKE_ANSWER", answer)
+    response = app.post("/chat", json={"thread_id": thread_id, "message": message})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def test_answer_cache_is_used_only_for_the_first_turn(app, monkeypatch):
+    first, second, other = (app.get("/start").json()["thread_id"] for _ in range(3))
+
+    # Al primo turno la risposta viene condivisa tra le conversazioni
+    assert not _ask(app, first, "E quanto costa?", "Dipende dal servizio.", monkeypatch)["cached"]
+    shared = _ask(app, other, "E quanto costa?", "Risposta nuova", monkeypatch)
+    assert shared["cached"] and shared["response"] == "Dipende dal servizio."
+
+    # La stessa domanda dopo una cronologia diversa ha una risposta diversa per ogni thread
+    _ask(app, first, "Quanto costa l'analisi dei ricoveri?", "L'analisi dei ricoveri costa 500 euro.", monkeypatch)
+    _ask(app, second, "Quanto costa la consulenza?", "La consulenza costa 80 euro l'ora.", monkeypatch)
+    followup_first = _ask(app, first, "E quanto costa?", "Sempre 500 euro.", monkeypatch)
+    followup_second = _ask(app, second, "E quanto costa?", "Sempre 80 euro l'ora.", monkeypatch)
+    assert followup_first == {"response": "Sempre 500 euro.", "thread_id": first, "cached": False}
+    assert followup_second == {"response": "Sempre 80 euro l'ora.", "thread_id": second, "cached": False}
+
+def _duration_sum(route: str) -> float:
+    prefix = f'chatbot_http_request_duration_seconds_sum{{method="POST",route="{route}",status="200"}} '
+    line = next((line for line in metrics.render().splitlines() if line.startswith(prefix)), None)
+    return float(line[len(prefix):]) if line else 0.0
+
+def test_request_duration_covers_the_whole_stream(app, monkeypatch):
+    monkeypatch.setattr(fake_openai_server, "FAKE_TOKEN_DELAY", 0.05)
+    monkeypatch.setattr(fake_openai_server, "FAKE_ANSWER", "uno due tre quattro cinque sei sette otto")
+    thread_id = app.get("/start").json()["thread_id"]
+    before = _duration_sum("/chat/stream")
+    response = app.post("/chat/stream", json={"thread_id": thread_id, "message": "Quali servizi offrite?"})
+    assert response.text.rstrip().endswith('"cached": false}')
+    # Otto token a 50 ms l'uno: la durata registrata include tutto lo stream, non solo gli header
+    assert _duration_sum("/chat/stream") - before >= 0.4
+
+def test_thread_usage_validates_the_thread_id(app):
+    assert app.get("/threads/not-a-thread/usage").status_code == 400
+    assert app.get("/threads/thread_sconosciuto/usage").status_code == 404
+    thread_id = app.get("/start").json()["thread_id"]
+    assert app.get(f"/threads/{thread_id}/usage").json()["turns"] == 0
@@ -0,0 +1,112 @@
+"""
+Test unitari del rate limiting: finestra scorrevole locale (rate_limiter.py), script Lua su
+Redis con ripiego sul limiter locale e chiamate al backend di stato fuori dall'event loop
+(state_backend.py). Redis è il server finto di fake_redis_server.py.
+
+    python -m pytest -q test_rate_limiter.py
+"""
+
+import socket
+import asyncio
+import threading
+
+import pytest
+
+from fake_redis_server import run_in_thread
+from rate_limiter import SlidingWindowRateLimiter
+from state_backend import InMemoryStateBackend, RedisStateBackend, run_state_call, set_state_backend
+
+LIMITS = [(60.0, 3, "troppe al minuto"), (3600.0, 5, "troppe all'ora")]
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_limit_per_window_and_identifier():
+    limiter = SlidingWindowRateLimiter(LIMITS, clock=Clock())
+    assert [limiter.check("ip_1")[0] for _ in range(3)] == [True, True, True]
+    assert limiter.check("ip_1") == (False, "troppe al minuto")
+    assert limiter.check("ip_2") == (True, None)
+
+def test_previous_window_is_weighted_by_elapsed_fraction():
+    clock = Clock()
+    limiter = SlidingWindowRateLimiter([(60.0, 4, "limite")], clock=clock)
+    for _ in range(4):
+        limiter.check("ip")
+    # A metà della finestra successiva la precedente pesa la metà: 4 * 0.5 = 2 richieste stimate
+    clock.now += 90
+    assert limiter.check("ip")[0]
+    assert limiter.check("ip")[0]
+    assert not limiter.check("ip")[0]
+    # Dopo due finestre intere i contatori ripartono da zero
+    clock.now += 120
+    assert [limiter.check("ip")[0] for _ in range(4)] == [True] * 4
+
+def test_longer_window_applies_after_shorter_resets():
+    clock = Clock()
+    limiter = SlidingWindowRateLimiter(LIMITS, clock=clock)
+    for _ in range(3):
+        assert limiter.check("ip")[0]
+    clock.now += 180
+    assert [limiter.check("ip")[0] for _ in range(2)] == [True, True]
+    assert limiter.check("ip") == (False, "troppe all'ora")
+
+def test_idle_and_overflow_keys_are_evicted():
+    clock = Clock()
+    limiter = SlidingWindowRateLimiter(LIMITS, max_keys=2, cleanup_interval=10, clock=clock)
+    for identifier in ("a", "b", "c"):
+        limiter.check(identifier)
+    assert limiter.stats()["keys"] == 2
+    assert limiter.stats()["evicted_overflow"] == 1
+    # Le chiavi inattive restano per due finestre: il contatore precedente conta ancora
+    clock.now += 3601
+    limiter.check("d")
+    assert limiter.stats()["evicted_idle"] == 0
+    clock.now += 3600
+    limiter.check("d")
+    assert limiter.stats()["keys"] == 1
+    assert limiter.stats()["evicted_idle"] == 1
+
+@pytest.fixture
+def redis_url():
+    port = _free_port()
+    server = run_in_thread(port=port)
+    yield f"redis://127.0.0.1:{port}/0"
+    server.stop()
+
+def test_redis_limiter_counts_across_instances(redis_url):
+    # Due processi con lo stesso Redis condividono i contatori
+    first = RedisStateBackend.from_url(redis_url, prefix="test:").rate_limiter(LIMITS)
+    second = RedisStateBackend.from_url(redis_url, prefix="test:").rate_limiter(LIMITS)
+    assert first.check("ip")[0] and second.check("ip")[0] and first.check("ip")[0]
+    assert second.check("ip") == (False, "troppe al minuto")
+    assert first.stats()["fallbacks"] == 0
+
+def test_redis_limiter_falls_back_to_local_limits_when_unreachable():
+    limiter = RedisStateBackend.from_url(f"redis://127.0.0.1:{_free_port()}/0", prefix="test:").rate_limiter(LIMITS)
+    assert [limiter.check("ip")[0] for _ in range(3)] == [True, True, True]
+    assert limiter.check("ip") == (False, "troppe al minuto")
+    assert limiter.stats()["fallbacks"] == 4
+
+def test_state_calls_run_off_the_event_loop_with_a_shared_backend(redis_url):
+    def current_thread():
+        return threading.get_ident()
+
+    async def thread_of_call():
+        return await run_state_call(current_thread)
+
+    try:
+        set_state_backend(InMemoryStateBackend())
+        assert asyncio.run(thread_of_call()) == threading.get_ident()
+        set_state_backend(RedisStateBackend.from_url(redis_url, prefix="test:"))
+        assert asyncio.run(thread_of_call()) != threading.get_ident()
+    finally:
+        set_state_backend(None)
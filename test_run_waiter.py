@@ -0,0 +1,133 @@
+"""
+Test unitari dei waiter delle run (run_waiter.py): completamento, timeout, disconnessione
+del client e cancellazione della run, con un client OpenAI finto in memoria.
+
+    python -m pytest -q test_run_waiter.py
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from run_waiter import (
+    PollSchedule, PollingRunWaiter, RunWaiter, StreamingRunWaiter, STATUS_DISCONNECTED, STATUS_TIMEOUT,
+)
+
+FAST = dict(initial_interval=0.001, fast_polls=2, backoff_factor=2.0, max_interval=0.004)
+
+class FakeRuns:
+    """runs.create/retrieve/cancel/stream: la run termina dopo `polls_to_finish` poll."""
+
+    def __init__(self, polls_to_finish: int = 2, final_status: str = "completed", stream_delay: float = 0.0):
+        self.polls_to_finish = polls_to_finish
+        self.final_status = final_status
+        self.stream_delay = stream_delay
+        self.retrieved = 0
+        self.cancelled = []
+        self.create_kwargs = None
+
+    def _run(self, status):
+        return SimpleNamespace(id="run_1", status=status, usage=None)
+
+    async def create(self, **kwargs):
+        self.create_kwargs = kwargs
+        return self._run("queued")
+
+    async def retrieve(self, thread_id, run_id):
+        self.retrieved += 1
+        return self._run(self.final_status if self.retrieved >= self.polls_to_finish else "in_progress")
+
+    async def cancel(self, thread_id, run_id):
+        self.cancelled.append(run_id)
+
+    def stream(self, **kwargs):
+        self.create_kwargs = kwargs
+        runs = self
+
+        class Stream:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def __aiter__(self):
+                yield SimpleNamespace(event="thread.run.created", data=runs._run("queued"))
+                await asyncio.sleep(runs.stream_delay)
+                yield SimpleNamespace(event="thread.message.delta", data=None)
+                yield SimpleNamespace(event=f"thread.run.{runs.final_status}", data=runs._run(runs.final_status))
+
+        return Stream()
+
+def _client(runs: FakeRuns):
+    return SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs)))
+
+def _run(waiter, runs, **kwargs):
+    return asyncio.run(waiter.run(_client(runs), "thread_1", "asst_1", **kwargs))
+
+def test_run_waiter_is_abstract():
+    with pytest.raises(TypeError):
+        RunWaiter()
+
+def test_poll_schedule_backs_off_up_to_max_interval():
+    intervals = PollSchedule(initial_interval=0.2, fast_polls=2, backoff_factor=2.0, max_interval=1.0).intervals()
+    assert [next(intervals) for _ in range(6)] == [0.2, 0.2, 0.4, 0.8, 1.0, 1.0]
+
+def test_polling_waiter_completes_and_passes_run_options():
+    runs = FakeRuns(polls_to_finish=3)
+    waiter = PollingRunWaiter(PollSchedule(deadline=5, **FAST))
+    result = _run(waiter, runs, run_options={"additional_instructions": "contesto"})
+    assert result.status == "completed"
+    assert result.polls == 3
+    assert runs.create_kwargs["additional_instructions"] == "contesto"
+    assert runs.cancelled == []
+    assert waiter.stats.as_dict()["statuses"] == {"completed": 1}
+
+def test_polling_waiter_reports_terminal_failure_status():
+    runs = FakeRuns(polls_to_finish=1, final_status="expired")
+    result = _run(PollingRunWaiter(PollSchedule(deadline=5, **FAST)), runs)
+    assert result.status == "expired"
+    assert runs.cancelled == []
+
+def test_polling_waiter_cancels_run_on_timeout():
+    runs = FakeRuns(polls_to_finish=10_000)
+    waiter = PollingRunWaiter(PollSchedule(deadline=0.05, **FAST))
+    result = _run(waiter, runs)
+    assert result.status == STATUS_TIMEOUT
+    assert runs.cancelled == ["run_1"]
+    assert waiter.stats.timeouts == 1
+
+def test_polling_waiter_cancels_run_when_client_disconnects():
+    runs = FakeRuns(polls_to_finish=10_000)
+
+    async def disconnected():
+        return runs.retrieved >= 2
+
+    result = _run(PollingRunWaiter(PollSchedule(deadline=5, **FAST)), runs, is_disconnected=disconnected)
+    assert result.status == STATUS_DISCONNECTED
+    assert runs.cancelled == ["run_1"]
+
+def test_streaming_waiter_completes_without_polling():
+    runs = FakeRuns(final_status="completed")
+    result = _run(StreamingRunWaiter(PollSchedule(deadline=5)), runs, run_options={"truncation_strategy": {}})
+    assert result.status == "completed"
+    assert result.polls == 0
+    assert runs.retrieved == 0
+    assert "truncation_strategy" in runs.create_kwargs
+
+def test_streaming_waiter_cancels_run_on_timeout():
+    runs = FakeRuns(stream_delay=1.0)
+    result = _run(StreamingRunWaiter(PollSchedule(deadline=0.05)), runs)
+    assert result.status == STATUS_TIMEOUT
+    assert runs.cancelled == ["run_1"]
+
+def test_streaming_waiter_cancels_run_when_client_disconnects():
+    runs = FakeRuns()
+
+    async def disconnected():
+        return True
+
+    result = _run(StreamingRunWaiter(PollSchedule(deadline=5)), runs, is_disconnected=disconnected)
+    assert result.status == STATUS_DISCONNECTED
+    assert runs.cancelled == ["run_1"]
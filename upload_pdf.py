@@ -1,13 +1,63 @@
 """
 Script per caricare PDF su Qdrant Vector Database usando LlamaIndex.
 Estrae il testo dai PDF, lo divide in chunks, genera embeddings con OpenAI e li carica su Qdrant.
-Riscritto con LlamaIndex per semplificare il codice.
+
+Pipeline a stadi espliciti:
+- extract: estrazione del testo pagina per pagina in un pool di processi (il parsing è CPU-bound)
+- chunk: divisione in chunk con ID deterministici, nello stesso processo del pool
+- embed: embedding dei chunk in batch grandi, con un numero limitato di richieste concorrenti
+- upsert: caricamento su Qdrant in batch, con un unico client condiviso per tutti i file
+
+I PDF vengono elaborati in streaming, a finestre di INGEST_PAGES_PER_TASK pagine: ogni finestra
+viene caricata mentre le successive sono in estrazione e poi rilasciata, quindi la memoria di
+picco dipende dalla dimensione delle finestre e non da quella del PDF (vedi benchmark_ingest_memory.py).
+
+L'ingestion è riprendibile:
+- gli embedding calcolati vengono salvati subito in un checkpoint locale (INGEST_CHECKPOINT):
+  se l'esecuzione si interrompe (errore di rete, rate limit, Ctrl+C) la successiva riusa gli
+  embedding già pagati e carica solo quello che manca; il checkpoint di un file viene svuotato
+  quando il file è stato caricato completamente
+- il manifest viene salvato dopo ogni file, così i file completati non vengono ricontrollati
+- le chiamate a OpenAI e Qdrant vengono ripetute con backoff esponenziale (e jitter) sugli errori
+  temporanei: 429, 5xx, timeout e connessioni interrotte; Retry-After viene rispettato
+
+Gli embedding sono anche salvati nell'archivio persistente di embedding_cache.py, indicizzato per
+(modello, sha256 del testo) e condiviso con le query del chatbot: cambiare CHUNK_SIZE/CHUNK_OVERLAP
+o ricreare la collection ricalcola solo i testi mai visti (--no-embedding-cache per disattivarlo).
+
+L'ingestion è incrementale:
+- l'ID di ogni punto deriva dall'hash di (source, testo del chunk, impostazioni di chunking),
+  quindi ricaricare lo stesso chunk sovrascrive il punto invece di duplicarlo
+- un manifest locale (INGEST_MANIFEST) ricorda l'hash di ogni file caricato: i file invariati
+  vengono saltati senza estrazione né embedding
+- per i file modificati vengono calcolati gli embedding solo dei chunk nuovi e rimossi da
+  Qdrant i chunk che non esistono più; con --prune si rimuovono i file non più presenti
+
+Con HYBRID_SEARCH=true ogni chunk viene caricato anche con il vettore sparso BM25 per la ricerca
+ibrida (vedi hybrid_search.py); la collection deve avere il vettore sparso.
+
+Uso:
+    python upload_pdf.py documenti/*.pdf --workers 4 --batch-size 100
+    python upload_pdf.py documenti/ --prune
 """
 
 import os
 import sys
+import json
+import time
+import uuid
+import random
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import logging
+from array import array
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional
 from dotenv import load_dotenv
 
 # Carica variabili d'ambiente
@@ -16,16 +66,24 @@ load_dotenv()
 
 # Importa librerie LlamaIndex
 try:
-    from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, StorageContext
     from llama_index.core.node_parser import SentenceSplitter
+    from llama_index.core.schema import Document, MetadataMode, TextNode
     from llama_index.vector_stores.qdrant import QdrantVectorStore
-    from llama_index.embeddings.openai import OpenAIEmbedding
-    from qdrant_client import QdrantClient
+    import openai
+    from pypdf import PdfReader
+    from openai import AsyncOpenAI
+    from qdrant_client import QdrantClient, AsyncQdrantClient, models
+    from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
 except ImportError as e:
     print(f"Errore: libreria mancante. Installa con: pip install -r requirements.txt")
     print(f"Dettaglio: {e}")
     sys.exit(1)
 
+from answer_cache import bump_corpus_version
+from embedding_cache import SQLiteEmbeddingStore, open_embedding_store, text_hash
+from hybrid_search import HYBRID_SEARCH, SPARSE_VECTOR_NAME, sparse_doc_fn, sparse_query_fn
+from qdrant_collection import CollectionSettings, create_collection, embedding_dimension
+
 # Configurazione logging
 logging.basicConfig(
     level=logging.INFO,
@@ -40,6 +98,7 @@ QDRANT_URL = os.getenv('QDRANT_URL')
 QDRANT_API_KEY = os.getenv('QDRANT_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 COLLECTION_NAME = os.getenv('QDRANT_COLLECTION_NAME', 'dataclinic_docs')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-small')
 
 # Validazione: verifica che le variabili essenziali siano configurate
 if not QDRANT_URL or not QDRANT_API_KEY:
@@ -52,114 +111,685 @@ if not QDRANT_URL or not QDRANT_API_KEY:
 CHUNK_SIZE = 1000  # Caratteri per chunk
 CHUNK_OVERLAP = 200  # Overlap tra chunk
 
-def setup_vector_store():
-    """Setup del vector store Qdrant con LlamaIndex."""
+# Configurazione pipeline
+DEFAULT_WORKERS = int(os.getenv('INGEST_WORKERS', str(os.cpu_count() or 1)))
+DEFAULT_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '100'))  # Chunk per richiesta di embedding/upsert
+DEFAULT_EMBED_CONCURRENCY = int(os.getenv('INGEST_EMBED_CONCURRENCY', '4'))  # Richieste di embedding in parallelo
+DEFAULT_PAGES_PER_TASK = int(os.getenv('INGEST_PAGES_PER_TASK', '20'))  # Pagine estratte per task del pool
+
+# Manifest dei file già caricati (hash del contenuto per collection)
+INGEST_MANIFEST = os.getenv('INGEST_MANIFEST', '.ingest_manifest.json')
+
+# Checkpoint degli embedding già calcolati (SQLite), per riprendere un'ingestion interrotta
+INGEST_CHECKPOINT = os.getenv('INGEST_CHECKPOINT', '.ingest_checkpoint.sqlite')
+
+# Retry con backoff esponenziale sugli errori temporanei di OpenAI e Qdrant
+INGEST_MAX_RETRIES = int(os.getenv('INGEST_MAX_RETRIES', '6'))
+INGEST_RETRY_BASE_DELAY = float(os.getenv('INGEST_RETRY_BASE_DELAY', '1.0'))  # Secondi, raddoppia a ogni tentativo
+INGEST_RETRY_MAX_DELAY = float(os.getenv('INGEST_RETRY_MAX_DELAY', '60'))
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Namespace degli ID deterministici dei punti
+POINT_ID_NAMESPACE = uuid.UUID('6f1c7a52-3d0e-4b8f-9a41-5c2e8d7b0f13')
+
+def chunk_settings(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                   embedding_model: str = EMBEDDING_MODEL) -> Dict:
+    """Impostazioni che determinano il contenuto dei chunk (e quindi i loro ID)."""
+    return {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "embedding_model": embedding_model}
+
+def point_id(source: str, text: str, settings: Dict) -> str:
+    """ID deterministico del punto Qdrant per un chunk."""
+    key = json.dumps([source, text, settings], sort_keys=True, ensure_ascii=False)
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, key))
+
+def file_hash(path: Path) -> str:
+    """SHA-256 del contenuto del file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class IngestManifest:
+    """
+    Manifest JSON dei file caricati, per collection:
+    {collection: {source: {"file_hash", "settings", "chunks", "ingested_at"}}}
+    """
+
+    def __init__(self, path: str = INGEST_MANIFEST, collection_name: str = COLLECTION_NAME):
+        self.path = Path(path)
+        self.collection_name = collection_name
+        self._data = {}
+        if self.path.exists():
+            try:
+                self._data = json.loads(self.path.read_text(encoding='utf-8'))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Manifest {self.path} illeggibile, verrà ricreato: {e}")
+
+    @property
+    def files(self) -> Dict[str, Dict]:
+        return self._data.setdefault(self.collection_name, {})
+
+    def is_unchanged(self, source: str, content_hash: str, settings: Dict) -> bool:
+        entry = self.files.get(source)
+        return entry is not None and entry.get("file_hash") == content_hash and entry.get("settings") == settings
+
+    def record(self, source: str, content_hash: str, settings: Dict, chunks: int):
+        self.files[source] = {
+            "file_hash": content_hash,
+            "settings": settings,
+            "chunks": chunks,
+            "ingested_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+
+    def remove(self, source: str):
+        self.files.pop(source, None)
+
+    def clear(self):
+        self.files.clear()
+
+    def save(self):
+        tmp_path = self.path.with_suffix(self.path.suffix + '.tmp')
+        tmp_path.write_text(json.dumps(self._data, indent=2, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, self.path)
+
+class IngestCheckpoint:
+    """
+    Checkpoint su disco degli embedding calcolati e non ancora confermati in Qdrant.
+
+    Ogni batch viene scritto appena OpenAI risponde (una transazione per batch), quindi
+    un'interruzione fa perdere al massimo i batch in volo. La chiave è l'ID deterministico
+    del punto, che dipende già da source, testo, chunking e modello di embedding.
+    """
+
+    def __init__(self, path: str = INGEST_CHECKPOINT):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "point_id TEXT PRIMARY KEY, source TEXT NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+        self._conn.commit()
+
+    def get_embeddings(self, ids: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        # Limite di SQLite sul numero di parametri per query
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = self._conn.execute(
+                f"SELECT point_id, vector FROM chunks WHERE point_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            for point_id, blob in rows:
+                vector = array('f')
+                vector.frombytes(blob)
+                found[point_id] = vector.tolist()
+        return found
+
+    def save_embeddings(self, source: str, embeddings: Dict[str, List[float]]):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (point_id, source, vector, created_at) VALUES (?, ?, ?, ?)",
+                [(pid, source, array('f', vector).tobytes(), now) for pid, vector in embeddings.items()],
+            )
+
+    def pending(self, source: Optional[str] = None) -> int:
+        """Numero di chunk nel checkpoint (di un file o in totale)."""
+        if source is None:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        return self._conn.execute("SELECT COUNT(*) FROM chunks WHERE source = ?", (source,)).fetchone()[0]
+
+    def clear(self, source: str):
+        """Svuota il checkpoint di un file caricato completamente."""
+        with self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+
+    def close(self):
+        self._conn.close()
+
+def is_retryable(error: Exception) -> bool:
+    """True per gli errori temporanei: rate limit, errori 5xx del server, timeout e rete."""
+    if isinstance(error, openai.APIConnectionError):  # Include i timeout
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (ResponseHandlingException, ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Secondi indicati dal server nell'header Retry-After, se presente."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or getattr(error, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return max(0.0, float(headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+# Text splitter del processo worker (creato una sola volta per processo)
+_text_splitter: Optional[SentenceSplitter] = None
+
+# Reader del PDF in corso nel processo worker: le finestre successive dello stesso file
+# non rileggono l'albero delle pagine (costo proporzionale al numero di pagine)
+_open_reader: Optional[tuple] = None
+
+def _get_reader(pdf_path: str) -> PdfReader:
+    global _open_reader
+    stat = os.stat(pdf_path)
+    key = (pdf_path, stat.st_size, stat.st_mtime_ns)
+    if _open_reader is None or _open_reader[0] != key:
+        if _open_reader is not None:
+            _open_reader[1].close()
+        # Il file viene letto su richiesta, senza caricarlo tutto in memoria
+        f = open(pdf_path, 'rb')
+        _open_reader = (key, f, PdfReader(f))
+    return _open_reader[2]
+
+def count_pages(pdf_path: str) -> int:
+    return len(_get_reader(pdf_path).pages)
+
+def iter_pages(pdf_path: str, start: int = 0, end: Optional[int] = None) -> Iterator[Document]:
+    """
+    Stadio extract: genera un Document per pagina (come il PDFReader di LlamaIndex),
+    con metadata 'source' e 'page_label'. Le pagine vengono lette una alla volta dal file,
+    senza caricare in memoria il PDF intero.
+    """
+    pdf_name = Path(pdf_path).name
+    reader = _get_reader(pdf_path)
+    end = len(reader.pages) if end is None else min(end, len(reader.pages))
+    try:
+        # page_labels ricalcola le etichette di tutte le pagine a ogni accesso: una volta sola
+        labels = reader.page_labels
+    except (ValueError, KeyError):
+        labels = []
+    for number in range(start, end):
+        label = labels[number] if number < len(labels) else str(number + 1)
+        text = reader.pages[number].extract_text() or ''
+        if not text.strip():
+            continue
+        yield Document(
+            text=text,
+            metadata={'page_label': label, 'file_name': pdf_name, 'source': pdf_name},
+            excluded_embed_metadata_keys=['file_name'],
+            excluded_llm_metadata_keys=['file_name'],
+        )
+
+def chunk_documents(documents: Iterable[Document], chunk_size: int = CHUNK_SIZE,
+                    chunk_overlap: int = CHUNK_OVERLAP) -> List[TextNode]:
+    """
+    Stadio chunk: divide i documenti in chunk con ID deterministici (senza duplicati).
+    I documenti vengono consumati uno alla volta, quindi un generatore di pagine non
+    viene mai materializzato per intero.
+    """
+    global _text_splitter
+    if _text_splitter is None:
+        # Configura text splitter con le stesse dimensioni del codice originale
+        _text_splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    # ID deterministici: lo stesso chunk ha sempre lo stesso ID (niente duplicati in Qdrant)
+    settings = chunk_settings(chunk_size, chunk_overlap)
+    unique_nodes = {}
+    for document in documents:
+        for node in _text_splitter.get_nodes_from_documents([document]):
+            node.id_ = point_id(node.metadata['source'], node.text, settings)
+            unique_nodes.setdefault(node.id_, node)
+    return list(unique_nodes.values())
+
+def extract_chunks(pdf_path: str, start: int = 0, end: Optional[int] = None, chunk_size: int = CHUNK_SIZE,
+                   chunk_overlap: int = CHUNK_OVERLAP) -> List[TextNode]:
+    """
+    Stadi extract e chunk delle pagine [start, end) di un PDF. Eseguita nei processi del pool.
+
+    Returns:
+        Lista di TextNode (senza embedding) con metadata 'source' e 'page_label'
+    """
+    return chunk_documents(iter_pages(pdf_path, start, end), chunk_size, chunk_overlap)
+
+async def stream_chunks(pool, pdf_path: Path, pages_per_task: int = DEFAULT_PAGES_PER_TASK,
+                        window_slots: Optional[asyncio.Semaphore] = None, lookahead: int = 2) -> AsyncIterator[List[TextNode]]:
+    """
+    Genera i chunk di un PDF a finestre di `pages_per_task` pagine, estratte nel pool di processi.
+
+    Al massimo `lookahead` finestre sono in estrazione mentre le precedenti vengono caricate;
+    `window_slots` limita le finestre in memoria tra tutti i file. Chi consuma il generatore
+    deve rilasciare uno slot dopo aver caricato ogni finestra.
+    """
+    loop = asyncio.get_running_loop()
+    page_count = await loop.run_in_executor(pool, count_pages, str(pdf_path))
+    starts = iter(range(0, page_count, pages_per_task))
+    pending = deque()
+    try:
+        while True:
+            # Senza finestre in corso si attende uno slot; altrimenti si anticipa solo se c'è posto,
+            # così un file non trattiene slot mentre aspetta quelli degli altri
+            while len(pending) < lookahead and (
+                    not pending or window_slots is None or not window_slots.locked()):
+                start = next(starts, None)
+                if start is None:
+                    break
+                if window_slots is not None:
+                    await window_slots.acquire()
+                pending.append(loop.run_in_executor(
+                    pool, extract_chunks, str(pdf_path), start, start + pages_per_task, CHUNK_SIZE, CHUNK_OVERLAP
+                ))
+            if not pending:
+                return
+            future = pending.popleft()
+            try:
+                nodes = await future
+            except BaseException:
+                if window_slots is not None:
+                    window_slots.release()
+                raise
+            yield nodes
+    finally:
+        for future in pending:
+            future.cancel()
+            if window_slots is not None:
+                window_slots.release()
+
+def setup_vector_store(batch_size: int = DEFAULT_BATCH_SIZE, hybrid: bool = HYBRID_SEARCH):
+    """
+    Setup del vector store Qdrant con LlamaIndex (client condivisi per tutta l'ingestion).
+    Con hybrid=True ogni chunk viene caricato anche con il vettore sparso BM25.
+    """
     qdrant_client = QdrantClient(
         url=QDRANT_URL,
         api_key=QDRANT_API_KEY,
     )
-    
+    qdrant_aclient = AsyncQdrantClient(
+        url=QDRANT_URL,
+        api_key=QDRANT_API_KEY,
+    )
+
     vector_store = QdrantVectorStore(
         client=qdrant_client,
-        collection_name=COLLECTION_NAME
-    )
-    
-    return vector_store, qdrant_client
-
-def process_pdf(pdf_path: Path):
-    """Processa un PDF e lo carica su Qdrant usando LlamaIndex."""
-    pdf_name = pdf_path.name
-    
-    logger.info(f"\n{'='*60}")
-    logger.info(f"Processando: {pdf_name}")
-    logger.info(f"{'='*60}")
-    
-    # Setup vector store
-    vector_store, qdrant_client = setup_vector_store()
-    
-    # Setup embedding model
-    embed_model = OpenAIEmbedding(
-        model="text-embedding-3-small",
-        api_key=OPENAI_API_KEY
-    )
-    
-    # Configura text splitter con le stesse dimensioni del codice originale
-    text_splitter = SentenceSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP
-    )
-    
-    # Carica PDF (LlamaIndex gestisce automaticamente estrazione e chunking)
-    logger.info(f"Caricando PDF: {pdf_path}")
-    documents = SimpleDirectoryReader(
-        input_files=[str(pdf_path)]
-    ).load_data()
-    
-    logger.info(f"Caricati {len(documents)} documenti dal PDF")
-    
-    # Aggiungi metadata source a tutti i documenti
-    for doc in documents:
-        if not doc.metadata.get('source'):
-            doc.metadata['source'] = pdf_name
-    
-    # Crea storage context
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
-    
-    # Crea index e carica su Qdrant (tutto automatico!)
-    # LlamaIndex gestisce:
-    # - Chunking con SentenceSplitter
-    # - Generazione embeddings in batch
-    # - Upload su Qdrant con metadata
-    logger.info("Creando index e caricando su Qdrant...")
-    index = VectorStoreIndex.from_documents(
-        documents,
-        storage_context=storage_context,
-        embed_model=embed_model,
-        transformations=[text_splitter],  # Usa il nostro text splitter configurato
-        show_progress=True  # Mostra progresso
+        aclient=qdrant_aclient,
+        collection_name=COLLECTION_NAME,
+        batch_size=batch_size,
+        # I retry (con backoff) sono gestiti da IngestionPipeline
+        max_retries=1,
+        enable_hybrid=hybrid,
+        sparse_doc_fn=sparse_doc_fn if hybrid else None,
+        sparse_query_fn=sparse_query_fn if hybrid else None,
+        sparse_vector_name=SPARSE_VECTOR_NAME,
     )
-    
-    # Conta i nodi caricati
-    num_nodes = len(index.docstore.docs)
-    logger.info(f"✅ {pdf_name} caricato su Qdrant con successo!")
-    logger.info(f"   Totale chunk caricati: {num_nodes}\n")
+
+    return vector_store, qdrant_client, qdrant_aclient
+
+class IngestionPipeline:
+    """
+    Stadi embed e upsert dei chunk. Un'unica istanza serve tutti i PDF, così client OpenAI,
+    client Qdrant, checkpoint, archivio degli embedding e limite di concorrenza sono condivisi.
+    """
+
+    def __init__(self, vector_store, qdrant_aclient, openai_client, batch_size: int = DEFAULT_BATCH_SIZE,
+                 embed_concurrency: int = DEFAULT_EMBED_CONCURRENCY, embedding_model: str = EMBEDDING_MODEL,
+                 collection_name: str = COLLECTION_NAME, checkpoint: Optional[IngestCheckpoint] = None,
+                 embedding_store: Optional[SQLiteEmbeddingStore] = None,
+                 max_retries: int = INGEST_MAX_RETRIES, retry_base_delay: float = INGEST_RETRY_BASE_DELAY,
+                 retry_max_delay: float = INGEST_RETRY_MAX_DELAY):
+        self.vector_store = vector_store
+        self.qdrant_aclient = qdrant_aclient
+        self.collection_name = collection_name
+        self.openai_client = openai_client
+        self.batch_size = batch_size
+        self.embedding_model = embedding_model
+        self.checkpoint = checkpoint
+        self.embedding_store = embedding_store
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._embed_semaphore = asyncio.Semaphore(embed_concurrency)
+        # La prima scrittura può creare la collection: le altre attendono
+        self._collection_lock = asyncio.Lock()
+        self._collection_ready = False
+        self.embedding_requests = 0
+        self.checkpoint_hits = 0
+        self.store_hits = 0
+        self.retries = 0
+
+    async def with_retry(self, operation: Callable[[], Awaitable], description: str):
+        """Esegue `operation` ripetendola con backoff esponenziale e jitter sugli errori temporanei."""
+        attempt = 0
+        while True:
+            try:
+                return await operation()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"{description}: errore temporaneo ({e}), nuovo tentativo "
+                               f"{attempt}/{self.max_retries} tra {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embedding di un batch di testi con una sola richiesta."""
+        async def request():
+            async with self._embed_semaphore:
+                self.embedding_requests += 1
+                return await self.openai_client.embeddings.create(model=self.embedding_model, input=texts)
+
+        response = await self.with_retry(request, "Embedding")
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def embed_nodes(self, source: str, nodes: List[TextNode]):
+        """
+        Stadio embed: assegna l'embedding ai chunk, riusando quelli nel checkpoint e, per
+        testo, quelli nell'archivio persistente degli embedding (anche se calcolati con un altro
+        chunking o per un'altra collection). I nuovi embedding vengono salvati in entrambi
+        prima dell'upsert.
+        """
+        embeddings = self.checkpoint.get_embeddings([node.id_ for node in nodes]) if self.checkpoint else {}
+        self.checkpoint_hits += len(embeddings)
+        # Stesso testo usato da LlamaIndex per l'embedding (contenuto + metadata non esclusi)
+        texts = {node.id_: node.get_content(metadata_mode=MetadataMode.EMBED)
+                 for node in nodes if node.id_ not in embeddings}
+        if not texts:
+            self._assign(nodes, embeddings)
+            return
+
+        keys = {pid: text_hash(text) for pid, text in texts.items()}
+        stored = {}
+        if self.embedding_store is not None:
+            try:
+                stored = self.embedding_store.get_many(self.embedding_model, list(set(keys.values())))
+            except Exception as e:
+                logger.warning(f"Errore lettura dall'archivio embedding: {e}")
+        for pid, key in keys.items():
+            if key in stored:
+                embeddings[pid] = stored[key]
+                self.store_hits += 1
+
+        missing = [pid for pid in texts if pid not in embeddings]
+        if missing:
+            computed = dict(zip(missing, await self.embed([texts[pid] for pid in missing])))
+            if self.checkpoint:
+                self.checkpoint.save_embeddings(source, computed)
+            if self.embedding_store is not None:
+                try:
+                    self.embedding_store.set_many(
+                        self.embedding_model, {keys[pid]: vector for pid, vector in computed.items()}
+                    )
+                except Exception as e:
+                    logger.warning(f"Errore scrittura nell'archivio embedding: {e}")
+            embeddings.update(computed)
+        self._assign(nodes, embeddings)
+
+    @staticmethod
+    def _assign(nodes: List[TextNode], embeddings: Dict[str, List[float]]):
+        for node in nodes:
+            node.embedding = embeddings[node.id_]
+
+    async def upsert(self, nodes: List[TextNode]):
+        """Stadio upsert: caricamento dei chunk con embedding su Qdrant."""
+        async def add():
+            if self._collection_ready:
+                await self.vector_store.async_add(nodes)
+                return
+            async with self._collection_lock:
+                await self.vector_store.async_add(nodes)
+                self._collection_ready = True
+
+        await self.with_retry(add, "Upsert su Qdrant")
+
+    async def _process_batch(self, source: str, nodes: List[TextNode]):
+        await self.embed_nodes(source, nodes)
+        await self.upsert(nodes)
+
+    async def collection_exists(self) -> bool:
+        return await self.with_retry(
+            lambda: self.qdrant_aclient.collection_exists(self.collection_name), "Lettura da Qdrant"
+        )
+
+    async def existing_ids(self, ids: List[str]) -> set:
+        """ID già presenti nella collection (chunk già caricati con lo stesso contenuto)."""
+        if not ids or not await self.collection_exists():
+            return set()
+        found = set()
+        for i in range(0, len(ids), self.batch_size):
+            batch = ids[i:i + self.batch_size]
+            points = await self.with_retry(lambda: self.qdrant_aclient.retrieve(
+                self.collection_name, ids=batch, with_payload=False, with_vectors=False
+            ), "Lettura da Qdrant")
+            found.update(str(point.id) for point in points)
+        return found
+
+    async def delete_stale(self, source: str, keep_ids: List[str]):
+        """Rimuove i punti del file che non fanno parte dei chunk attuali."""
+        if not await self.collection_exists():
+            return
+        must_not = [models.HasIdCondition(has_id=keep_ids)] if keep_ids else None
+        await self.with_retry(lambda: self.qdrant_aclient.delete(
+            self.collection_name,
+            points_selector=models.FilterSelector(filter=models.Filter(
+                must=[models.FieldCondition(key='source', match=models.MatchValue(value=source))],
+                must_not=must_not,
+            )),
+        ), "Cancellazione da Qdrant")
+
+    async def ingest_nodes(self, source: str, nodes: List[TextNode]) -> int:
+        """
+        Embedding e upsert dei chunk di un file, in batch concorrenti.
+        I chunk già presenti in Qdrant (stesso ID) vengono saltati, quelli già
+        nel checkpoint vengono caricati senza ricalcolare l'embedding.
+
+        Returns:
+            Numero di chunk nuovi caricati
+        """
+        existing = await self.existing_ids([node.id_ for node in nodes])
+        nodes = [node for node in nodes if node.id_ not in existing]
+        batches = [nodes[i:i + self.batch_size] for i in range(0, len(nodes), self.batch_size)]
+        await asyncio.gather(*(self._process_batch(source, batch) for batch in batches))
+        return len(nodes)
+
+async def ingest(pdf_paths: List[Path], workers: int = DEFAULT_WORKERS, batch_size: int = DEFAULT_BATCH_SIZE,
+                 embed_concurrency: int = DEFAULT_EMBED_CONCURRENCY, prune: bool = False, force: bool = False,
+                 manifest: Optional[IngestManifest] = None, checkpoint: Optional[IngestCheckpoint] = None,
+                 vector_store=None, qdrant_aclient=None, openai_client=None,
+                 pages_per_task: int = DEFAULT_PAGES_PER_TASK,
+                 embedding_store: Optional[SQLiteEmbeddingStore] = None, use_embedding_store: bool = True) -> int:
+    """
+    Carica i PDF su Qdrant in modo incrementale e riprendibile.
+
+    Args:
+        pdf_paths: PDF da caricare
+        prune: Rimuove da Qdrant e dal manifest i file non presenti in pdf_paths
+        force: Ignora il manifest e ricontrolla tutti i file
+        pages_per_task: Pagine per finestra di estrazione; la memoria di picco dipende da
+            questo valore e dal numero di worker, non dalla dimensione dei PDF
+        use_embedding_store: Consulta e aggiorna l'archivio persistente degli embedding
+            (`embedding_store`, default quello in EMBEDDING_CACHE_PATH)
+
+    Returns:
+        Numero di file il cui contenuto in Qdrant è cambiato
+    """
+    if vector_store is None:
+        vector_store, _, qdrant_aclient = setup_vector_store(batch_size)
+    if openai_client is None:
+        # Nessun retry nel client: backoff e numero di tentativi sono quelli della pipeline
+        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+    if manifest is None:
+        manifest = IngestManifest()
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint()
+    pending = checkpoint.pending()
+    if pending:
+        logger.info(f"Checkpoint {checkpoint.path}: {pending} embedding di un'esecuzione interrotta verranno riusati")
+    if use_embedding_store and embedding_store is None:
+        embedding_store = open_embedding_store()
+    pipeline = IngestionPipeline(vector_store, qdrant_aclient, openai_client, batch_size, embed_concurrency,
+                                 checkpoint=checkpoint, embedding_store=embedding_store if use_embedding_store else None)
+    settings = chunk_settings()
+    loop = asyncio.get_running_loop()
+
+    hybrid = getattr(vector_store, 'enable_hybrid', False)
+    # Se la collection non esiste (es. è stata ricreata) il manifest non è più valido
+    if await pipeline.collection_exists():
+        if hybrid:
+            info = await pipeline.with_retry(
+                lambda: qdrant_aclient.get_collection(pipeline.collection_name), "Lettura da Qdrant"
+            )
+            if SPARSE_VECTOR_NAME not in (info.config.params.sparse_vectors or {}):
+                raise ValueError(
+                    f"La collection {pipeline.collection_name} non ha il vettore sparso '{SPARSE_VECTOR_NAME}' "
+                    f"richiesto da HYBRID_SEARCH: ricreala con 'python qdrant_collection.py create --recreate "
+                    f"--hybrid' e ricarica i PDF"
+                )
+    else:
+        manifest.clear()
+        # Collection creata con quantizzazione, HNSW e indice su 'source' (vedi qdrant_collection.py)
+        vector_size = embedding_dimension(EMBEDDING_MODEL)
+        if vector_size:
+            collection_settings = CollectionSettings.from_env(vector_size)
+            collection_settings.sparse_vector = SPARSE_VECTOR_NAME if hybrid else None
+            await create_collection(qdrant_aclient, pipeline.collection_name, collection_settings)
+        else:
+            logger.warning(f"Dimensione dei vettori di '{EMBEDDING_MODEL}' sconosciuta (imposta EMBEDDING_DIM): "
+                           f"la collection verrà creata con le impostazioni di default")
+
+    failed = []
+    # Finestre di pagine in memoria (in estrazione o in caricamento) tra tutti i file
+    window_slots = asyncio.Semaphore(max(2, workers + embed_concurrency))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        async def process_pdf(pdf_path: Path) -> bool:
+            """
+            Processa un PDF in streaming: le finestre di pagine vengono estratte e divise in chunk
+            nel pool di processi e vengono caricate (embedding e upsert dei soli chunk nuovi) mentre
+            le successive sono in estrazione. Le finestre in memoria sono al massimo `window_slots`.
+            """
+            pdf_name = pdf_path.name
+            try:
+                content_hash = await loop.run_in_executor(None, file_hash, pdf_path)
+                if not force and manifest.is_unchanged(pdf_name, content_hash, settings):
+                    logger.info(f"{pdf_name}: invariato, saltato")
+                    return False
+
+                logger.info(f"{pdf_name}: estrazione, embedding e caricamento su Qdrant...")
+                chunk_ids = set()
+
+                async def ingest_window(nodes: List[TextNode]) -> int:
+                    try:
+                        return await pipeline.ingest_nodes(pdf_name, nodes)
+                    finally:
+                        window_slots.release()
+
+                # Le finestre vengono caricate in parallelo (fino agli slot disponibili)
+                tasks = []
+                try:
+                    async with aclosing(stream_chunks(pool, pdf_path, pages_per_task, window_slots)) as windows:
+                        async for nodes in windows:
+                            # Chunk identici in finestre diverse vengono caricati una volta sola
+                            nodes = [node for node in nodes if node.id_ not in chunk_ids]
+                            chunk_ids.update(node.id_ for node in nodes)
+                            tasks.append(asyncio.create_task(ingest_window(nodes)))
+                finally:
+                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                errors = [result for result in results if isinstance(result, BaseException)]
+                if errors:
+                    raise errors[0]
+                added = sum(results)
+                # Prima si caricano i chunk nuovi, poi si rimuovono i vecchi: il file resta sempre cercabile
+                await pipeline.delete_stale(pdf_name, list(chunk_ids))
+                changed = added > 0 or not manifest.is_unchanged(pdf_name, content_hash, settings)
+                # File completato: il manifest viene salvato subito e il checkpoint non serve più
+                manifest.record(pdf_name, content_hash, settings, len(chunk_ids))
+                manifest.save()
+                checkpoint.clear(pdf_name)
+            except Exception as e:
+                logger.error(f"Errore durante il processing di {pdf_path}: {e}")
+                failed.append(pdf_name)
+                import traceback
+                traceback.print_exc()
+                return False
+            logger.info(f"✅ {pdf_name} caricato su Qdrant con successo! "
+                        f"Chunk totali: {len(chunk_ids)}, nuovi: {added}, già presenti: {len(chunk_ids) - added}")
+            return changed
+
+        results = await asyncio.gather(*(process_pdf(p) for p in pdf_paths))
+
+    changed = sum(results)
+    if prune:
+        current = {p.name for p in pdf_paths}
+        for source in [s for s in manifest.files if s not in current]:
+            logger.info(f"{source}: non più presente, rimozione da Qdrant")
+            await pipeline.delete_stale(source, [])
+            manifest.remove(source)
+            changed += 1
+
+    manifest.save()
+    if failed:
+        logger.warning(f"File non completati: {', '.join(failed)}. Rilancia lo stesso comando per riprendere: "
+                       f"{checkpoint.pending()} embedding restano nel checkpoint")
+    logger.info(f"Richieste di embedding: {pipeline.embedding_requests}, "
+                f"embedding ripresi dal checkpoint: {pipeline.checkpoint_hits}, "
+                f"dall'archivio: {pipeline.store_hits}, retry: {pipeline.retries}")
+    return changed
 
 def main():
     """Funzione principale."""
+    parser = argparse.ArgumentParser(
+        description="Carica PDF su Qdrant",
+        epilog="Esempio: python upload_pdf.py documenti/dataclinic.pdf documenti/info.pdf"
+    )
+    parser.add_argument('pdfs', nargs='+', help="PDF (o cartelle di PDF) da caricare")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Processi per estrazione e chunking (default: numero di CPU)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Chunk per richiesta di embedding e per upsert")
+    parser.add_argument('--pages-per-task', type=int, default=DEFAULT_PAGES_PER_TASK,
+                        help="Pagine estratte e caricate per volta (limita la memoria con PDF molto grandi)")
+    parser.add_argument('--embed-concurrency', type=int, default=DEFAULT_EMBED_CONCURRENCY,
+                        help="Richieste di embedding in parallelo")
+    parser.add_argument('--no-embedding-cache', action='store_true',
+                        help="Non usa l'archivio persistente degli embedding (EMBEDDING_CACHE_PATH)")
+    parser.add_argument('--prune', action='store_true',
+                        help="Rimuove da Qdrant i file caricati in precedenza ma non indicati ora")
+    parser.add_argument('--force', action='store_true',
+                        help="Ricontrolla anche i file invariati secondo il manifest")
+    args = parser.parse_args()
+
     # Verifica configurazione
     if not OPENAI_API_KEY:
         logger.error("OPENAI_API_KEY non trovata nelle variabili d'ambiente!")
         sys.exit(1)
-    
+
     if not QDRANT_API_KEY:
         logger.error("QDRANT_API_KEY non trovata nelle variabili d'ambiente!")
         sys.exit(1)
-    
-    # Processa PDF
-    if len(sys.argv) < 2:
-        logger.error("Uso: python upload_pdf.py <path_to_pdf> [altri_pdf...]")
-        logger.info("Esempio: python upload_pdf.py documenti/dataclinic.pdf documenti/info.pdf")
-        sys.exit(1)
-    
-    pdf_paths = [Path(p) for p in sys.argv[1:]]
-    
-    for pdf_path in pdf_paths:
+
+    candidates = []
+    for path in map(Path, args.pdfs):
+        candidates.extend(sorted(path.glob('*.pdf')) if path.is_dir() else [path])
+
+    pdf_paths = []
+    for pdf_path in candidates:
         if not pdf_path.exists():
             logger.error(f"File non trovato: {pdf_path}")
             continue
-        
+
         if pdf_path.suffix.lower() != '.pdf':
             logger.warning(f"Ignorando file non-PDF: {pdf_path}")
             continue
-        
-        try:
-            process_pdf(pdf_path)
-        except Exception as e:
-            logger.error(f"Errore durante il processing di {pdf_path}: {e}")
-            import traceback
-            traceback.print_exc()
-            continue
-    
+
+        pdf_paths.append(pdf_path)
+
+    processed = asyncio.run(ingest(
+        pdf_paths, args.workers, args.batch_size, args.embed_concurrency, prune=args.prune, force=args.force,
+        pages_per_task=args.pages_per_task, use_embedding_store=not args.no_embedding_cache
+    ))
+
+    # Il corpus è cambiato: invalida le risposte in cache del chatbot
+    if processed:
+        bump_corpus_version()
+
     logger.info("\n✅ Processo completato!")
 
 if __name__ == "__main__":